@@ -1,4 +1,11 @@
 CONTROLLER_HEART_BEAT_EXPIRATION = 90
 WORKER_HEART_BEAT_INTERVAL = 30
+SESSION_EXPIRATION = 600
+
+# A worker rejected the request because it could not start in time. It can be
+# retried later or on another worker.
+WORKER_OVERLOADED_ERROR_CODE = 5
+# The request has an invalid parameter. Retrying it does not help.
+INVALID_REQUEST_ERROR_CODE = 6
 
 LOGDIR = "./logs"
@@ -1,6 +1,6 @@
 import argparse
-import json
-import pathlib
+
+from fastchat.data.records import read_records, write_records
 
 # Prompt from stanford alpaca's training script
 PROMPT_DICT = {
@@ -17,44 +17,35 @@ PROMPT_DICT = {
 }
 
 
-def main(args):
-    data_path = pathlib.Path(args.data_path)
-    with data_path.open() as f:
-        data = json.load(f)
-
+def convert(data):
     prompt_input, prompt_no_input = (
         PROMPT_DICT["prompt_input"],
         PROMPT_DICT["prompt_no_input"],
     )
-    sources = [
-        prompt_input.format_map(example)
-        if example.get("input", "") != ""
-        else prompt_no_input.format_map(example)
-        for example in data
-    ]
-    targets = [example["output"] for example in data]
-
-    new_data = []
-    cnt = 1
-    for s, t in zip(sources, targets):
-        new_data.append(
-            {
-                "id": str(cnt),
-                "conversations": [
-                    {
-                        "from": "human",
-                        "value": s,
-                    },
-                    {
-                        "from": "gpt",
-                        "value": t,
-                    },
-                ],
-            }
+    for cnt, example in enumerate(data, start=1):
+        s = (
+            prompt_input.format_map(example)
+            if example.get("input", "") != ""
+            else prompt_no_input.format_map(example)
         )
-        cnt += 1
+        t = example["output"]
+        yield {
+            "id": str(cnt),
+            "conversations": [
+                {
+                    "from": "human",
+                    "value": s,
+                },
+                {
+                    "from": "gpt",
+                    "value": t,
+                },
+            ],
+        }
+
 
-    json.dump(new_data, open(args.output_path, "w"), indent=2)
+def main(args):
+    write_records(convert(read_records(args.data_path)), args.output_path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,130 @@
+"""
+Tokenize conversations for fine-tuning with a pool of processes.
+
+The conversations are formatted, tokenized and masked like
+fastchat.train.train.preprocess, and written to a memory-mapped dataset (see
+fastchat.data.tokenized_dataset). Pass its directory as --data_path to
+fastchat/train/train.py to skip the tokenization when training starts.
+
+Usage:
+python3 -m fastchat.data.build_dataset --in sharegpt_split.json --out sharegpt_tokenized --model-name-or-path ~/model_weights/llama-7b --model-max-length 2048
+"""
+import argparse
+import itertools
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import tqdm
+import transformers
+
+from fastchat.data.records import imap_bounded, read_records
+from fastchat.data.tokenized_dataset import TokenizedDatasetWriter
+from fastchat.train.train import (
+    IGNORE_TOKEN_ID,
+    apply_prompt_template,
+    mask_targets,
+)
+
+# The tokenizer of each worker process
+tokenizer = None
+
+
+def load_tokenizer(model_name_or_path, model_max_length):
+    # The same as fastchat.train.train
+    tokenizer = transformers.AutoTokenizer.from_pretrained(
+        model_name_or_path,
+        model_max_length=model_max_length,
+        padding_side="right",
+        use_fast=False,
+    )
+    tokenizer.pad_token = tokenizer.unk_token
+    return tokenizer
+
+
+def init_worker(model_name_or_path, model_max_length):
+    global tokenizer
+    tokenizer = load_tokenizer(model_name_or_path, model_max_length)
+
+
+def tokenize_samples(samples):
+    """Return the token ids, the loss mask and whether the masking matched
+    the tokenization, for each sample."""
+    conversations = apply_prompt_template([s["conversations"] for s in samples])
+    results = []
+    for conversation in conversations:
+        input_ids = np.array(
+            tokenizer(
+                conversation, max_length=tokenizer.model_max_length, truncation=True
+            ).input_ids,
+            dtype=np.int64,
+        )
+        labels = input_ids.copy()
+        cur_len = mask_targets(conversation, labels, tokenizer)
+        total_len = int((input_ids != tokenizer.pad_token_id).sum())
+        mismatch = cur_len < tokenizer.model_max_length and cur_len != total_len
+        results.append((input_ids, labels != IGNORE_TOKEN_ID, mismatch))
+    return results
+
+
+def main(args):
+    content = read_records(args.in_file)
+    tokenizer = load_tokenizer(args.model_name_or_path, args.model_max_length)
+    writer = TokenizedDatasetWriter(
+        args.out_dir,
+        vocab_size=len(tokenizer),
+        pad_token_id=tokenizer.pad_token_id,
+        model_max_length=args.model_max_length,
+        shard_size=args.shard_size,
+        model_name_or_path=args.model_name_or_path,
+    )
+    chunks = iter(lambda: list(itertools.islice(content, args.chunk_size)), [])
+    num_samples = num_tokens = num_mismatches = 0
+
+    tic = time.time()
+    with multiprocessing.Pool(
+        args.num_workers,
+        initializer=init_worker,
+        initargs=(args.model_name_or_path, args.model_max_length),
+    ) as pool, tqdm.tqdm() as pbar:
+        # The results are in the order of the conversations.
+        for results in imap_bounded(
+            pool, tokenize_samples, chunks, max_pending=4 * args.num_workers
+        ):
+            for input_ids, loss_mask, mismatch in results:
+                writer.add(input_ids, loss_mask)
+                num_tokens += len(input_ids)
+                num_mismatches += mismatch
+            num_samples += len(results)
+            pbar.update(len(results))
+    writer.close()
+
+    print(
+        f"Tokenized {num_samples} conversations, {num_tokens} tokens in "
+        f"{time.time() - tic:.1f} s into {len(writer.shards)} shards. "
+        f"Tokenization mismatches: {num_mismatches}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--in-file", type=str, required=True)
+    parser.add_argument("--out-dir", type=str, required=True)
+    parser.add_argument("--model-name-or-path", type=str, required=True)
+    parser.add_argument("--model-max-length", type=int, default=2048)
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=64,
+        help="The number of conversations sent to a worker at a time.",
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=2**28,
+        help="The maximum number of tokens in a shard.",
+    )
+    args = parser.parse_args()
+    main(args)
@@ -4,18 +4,27 @@
 
 Usage:
 python3 -m fastchat.data.clean_sharegpt --in sharegpt_html.json --out sharegpt_clean.json
+python3 -m fastchat.data.clean_sharegpt --in sharegpt_html.json --out sharegpt_clean.json --num-workers 64
 """
 import argparse
-import json
+import collections
+import contextlib
+import hashlib
+import itertools
 import logging
+import multiprocessing
+import os
 import re
+import time
 from typing import Dict, Union
 
 import bs4
 import markdownify  # == 0.11.6
 import tqdm
 
+from fastchat.data.records import imap_bounded, read_records, write_records
 
+# The patterns are compiled once per process, when it imports this module.
 div_pattern = re.compile("<div.*?>")
 span_pattern = re.compile("<span.*?>")
 code_lang_pattern = re.compile(
@@ -26,6 +35,11 @@ regenerate_pattern = re.compile("\d+ / \d+")
 copy_chars_pattern = re.compile("Copy\d+ chars / \d+ words")
 copy_code_pattern = re.compile("```(.*?)Copy code\s*```")
 
+# Print the first converted value and exit
+debug = False
+# The number of samples sent to a worker at a time
+CHUNK_SIZE = 16
+
 
 def reformat_code(val: str) -> str:
     # Input code format is:
@@ -34,32 +48,32 @@ def reformat_code(val: str) -> str:
     #
     # ```
     # This function convert it into the correct markdown format
-    return re.sub(code_lang_pattern, code_lang_format, val)
+    return code_lang_pattern.sub(code_lang_format, val)
 
 
 def html_to_markdown(val: str) -> str:
     # Remove all <div>. This is required to make intent work in code blocks.
-    val = re.sub(div_pattern, "", val)
+    val = div_pattern.sub("", val)
     # Remove all <span>. This is required to make underscores work in code blocks.
-    val = re.sub(span_pattern, "", val)
+    val = span_pattern.sub("", val)
     # Markdown to html
     val = markdownify.markdownify(val).strip()
     # Reformat code
     val = reformat_code(val)
 
     # Remove noisy "[number] / [number]" at the beginning
-    noise = re.search(regenerate_pattern, val)
+    noise = regenerate_pattern.search(val)
     if noise and noise.start() == 0:
         val = val[noise.end() :]
     # Remove noisy "Copy[number] chars / [number] words"
-    val = re.sub(copy_chars_pattern, "", val)
+    val = copy_chars_pattern.sub("", val)
     # Remove empty code block ```\nCopy code\n```
-    val = re.sub(copy_code_pattern, "", val)
+    val = copy_code_pattern.sub("", val)
 
     # Strip
     val = val.replace("\n\n\n", "\n").strip()
 
-    if args.debug:
+    if debug:
         print(val)
         exit()
 
@@ -74,17 +88,96 @@ def should_filter(val: str) -> bool:
     return False
 
 
-def clean_html_source(content, begin, end, check_tag, check_num):
+def clean_sample(sample, check_tag=None, num_tags=0):
+    """
+    Filter the turns of a sample and convert them to markdown in place.
+
+    Returns:
+        "ok", "filter" or "error", and the number of turns logged because they
+        contain `check_tag`, up to `num_tags`.
+    """
+    BARRIER = "\n" + "=" * 20 + "\n"
+    cnt_tag = 0
+    for c in sample["conversations"]:
+        if should_filter(c["value"]):
+            return "filter", cnt_tag
+
+        try:
+            new_val = html_to_markdown(c["value"])
+        except (bs4.builder.ParserRejectedMarkup, AssertionError):
+            return "error", cnt_tag
+
+        c["value"] = new_val
+
+        # Debug
+        if check_tag is not None and check_tag in c["value"] and cnt_tag < num_tags:
+            logging.debug(
+                BARRIER + c["value"] + "\n" + BARRIER + new_val + "\n" + BARRIER + "\n"
+            )
+            cnt_tag += 1
+            if cnt_tag == num_tags:
+                break
+    return "ok", cnt_tag
+
+
+def clean_samples(samples):
+    """Clean a chunk of samples in a worker process. Return each sample with
+    its status and the CPU seconds spent on it."""
+    results = []
+    for sample in samples:
+        tic = time.process_time()
+        status, _ = clean_sample(sample)
+        results.append((sample, status, time.process_time() - tic))
+    return results
+
+
+class StageTimer:
+    """Add up the seconds spent in each stage of the cleaning."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.seconds = collections.defaultdict(float)
+
+    @contextlib.contextmanager
+    def __call__(self, stage):
+        tic = time.perf_counter()
+        yield
+        self.seconds[stage] += time.perf_counter() - tic
+
+    def timed(self, iterable, stage):
+        """Yield from `iterable`, timing each next() as `stage`."""
+        iterator = iter(iterable)
+        while True:
+            with self(stage):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def summary(self):
+        stages = ", ".join(f"{k}: {v:.1f} s" for k, v in self.seconds.items())
+        return f"time: {time.perf_counter() - self.start:.1f} s ({stages})"
+
+
+def clean_html_source(content, begin, end, check_tag, check_num, num_workers=1):
     """
     Clean the input json content.
 
     Args:
-        content: json file loaded in memory.
+        content: an iterable of the samples of the json file.
         check_tag: a debug purpose arg. If a conversation contains the tag, log
           it before and after cleaning.
         check_num: number of matched conversations logged.
+        num_workers: the number of processes that convert html to markdown.
+          The deduplication runs in this process, so the samples, their order
+          and the counts are the same for any number of workers.
+
+    Yields:
+        The cleaned samples. The counts and the time spent in each stage are
+        printed when they are exhausted. The html_to_markdown time is the
+        CPU time added up over the workers.
     """
-    BARRIER = "\n" + "=" * 20 + "\n"
+    cnt_total = 0
     cnt_skip = 0
     cnt_too_short = 0
     cnt_id_duplication = 0
@@ -92,89 +185,112 @@ def clean_html_source(content, begin, end, check_tag, check_num):
     cnt_filter = 0
     cnt_tag = 0
     visited = {}
+    timer = StageTimer()
+    # The deduplication reads ahead of the conversion. Its messages wait here
+    # with the number of samples kept before them, and are printed after the
+    # messages of those samples, so that all messages are in input order.
+    messages = collections.deque()
+    num_kept = 0
 
-    content = content[begin:end]
-    new_content = []
-
-    for sample in tqdm.tqdm(content):
-        skipped = False
-        cid = sample["id"]
-
-        if len(sample["conversations"]) <= 1:
-            print(f"id {cid} is too short")
-            cnt_too_short += 1
-            skipped = True
-        elif cid in visited:
-            print(f"id {cid} is an id duplication of {visited[cid]}")
-            cnt_id_duplication += 1
-            skipped = True
-        elif (
-            sample["conversations"][1]["value"],
-            len(sample["conversations"]),
-        ) in visited:
-            key = (sample["conversations"][1]["value"], len(sample["conversations"]))
-            print(f"id {cid} is a value duplication of {visited[key]}")
-            cnt_value_duplication += 1
-            skipped = True
-        else:
-            key = (sample["conversations"][1]["value"], len(sample["conversations"]))
-            visited[cid] = visited[key] = cid
-
-            for c in sample["conversations"]:
-                if should_filter(c["value"]):
-                    print(f"id {cid} is filtered out")
-                    cnt_filter += 1
-                    skipped = True
-                    break
-
-                try:
-                    new_val = html_to_markdown(c["value"])
-                except (bs4.builder.ParserRejectedMarkup, AssertionError):
-                    skipped = True
-                    break
-
-                c["value"] = new_val
-
-                # Debug
-                if (
-                    check_tag is not None
-                    and check_tag in c["value"]
-                    and cnt_tag < check_num
-                ):
-                    logging.debug(
-                        BARRIER
-                        + c["value"]
-                        + "\n"
-                        + BARRIER
-                        + new_val
-                        + "\n"
-                        + BARRIER
-                        + "\n"
-                    )
-                    cnt_tag += 1
-                    if cnt_tag == check_num:
-                        break
-
-        if not skipped:
-            new_content.append(sample)
+    def print_messages(num_done):
+        while messages and messages[0][0] <= num_done:
+            print(messages.popleft()[1])
+
+    def deduplicate(content):
+        nonlocal cnt_total, cnt_skip, cnt_too_short
+        nonlocal cnt_id_duplication, cnt_value_duplication, num_kept
+        for sample in tqdm.tqdm(timer.timed(content, "read")):
+            cnt_total += 1
+            with timer("deduplicate"):
+                skipped = True
+                cid = sample["id"]
+                if len(sample["conversations"]) <= 1:
+                    messages.append((num_kept, f"id {cid} is too short"))
+                    cnt_too_short += 1
+                elif cid in visited:
+                    message = f"id {cid} is an id duplication of {visited[cid]}"
+                    messages.append((num_kept, message))
+                    cnt_id_duplication += 1
+                elif value_key(sample) in visited:
+                    key = value_key(sample)
+                    message = f"id {cid} is a value duplication of {visited[key]}"
+                    messages.append((num_kept, message))
+                    cnt_value_duplication += 1
+                else:
+                    key = value_key(sample)
+                    visited[cid] = visited[key] = cid
+                    skipped = False
+
+            if skipped:
+                cnt_skip += 1
+            else:
+                num_kept += 1
+                yield sample
+
+    def clean_serially(content):
+        nonlocal cnt_tag
+        for i, sample in enumerate(content):
+            print_messages(i)
+            tic = time.process_time()
+            status, num_tags = clean_sample(sample, check_tag, check_num - cnt_tag)
+            cnt_tag += num_tags
+            yield sample, status, time.process_time() - tic
+
+    content = deduplicate(itertools.islice(content, begin, end))
+    with contextlib.ExitStack() as stack:
+        # Debugging needs the order of the conversion, and exits in it.
+        if num_workers <= 1 or check_tag is not None or debug:
+            results = clean_serially(content)
         else:
-            cnt_skip += 1
+            pool = stack.enter_context(multiprocessing.Pool(num_workers))
+            chunks = iter(lambda: list(itertools.islice(content, CHUNK_SIZE)), [])
+            results = itertools.chain.from_iterable(
+                imap_bounded(pool, clean_samples, chunks, 4 * num_workers)
+            )
+
+        for i, (sample, status, seconds) in enumerate(results):
+            print_messages(i)
+            timer.seconds["html_to_markdown"] += seconds
+            if status == "filter":
+                print(f"id {sample['id']} is filtered out")
+                cnt_filter += 1
+            if status == "ok":
+                yield sample
+            else:
+                cnt_skip += 1
+        print_messages(num_kept)
 
     print(
-        f"total: {len(content)}, skip: {cnt_skip}, new: {len(new_content)}, "
+        f"total: {cnt_total}, skip: {cnt_skip}, new: {cnt_total - cnt_skip}, "
         f"cnt_too_short: {cnt_too_short}, cnt_id_duplication: {cnt_id_duplication}, "
         f"cnt_value_duplication: {cnt_value_duplication}, cnt_filter: {cnt_filter}"
     )
+    print(timer.summary())
 
-    return new_content
+
+def value_key(sample):
+    # A digest instead of the first reply keeps the memory of deduplication
+    # small.
+    value = sample["conversations"][1]["value"]
+    return (
+        hashlib.md5(value.encode("utf-8", "surrogatepass")).digest(),
+        len(sample["conversations"]),
+    )
 
 
 def main(args):
-    content = json.load(open(args["in_file"], "r"))
+    global debug
+    debug = args["debug"]
+    content = read_records(args["in_file"])
     content = clean_html_source(
-        content, args["begin"], args["end"], args["check_tag"], args["check_num"]
+        content,
+        args["begin"],
+        args["end"],
+        args["check_tag"],
+        args["check_num"],
+        args["num_workers"],
     )
-    json.dump(content, open(args["out_file"], "w"), indent=2)
+    write_records(content, args["out_file"])
 
 
 if __name__ == "__main__":
@@ -186,5 +302,11 @@ if __name__ == "__main__":
     parser.add_argument("--debug", action="store_true")
     parser.add_argument("--check-tag", type=str)
     parser.add_argument("--check-num", type=int, default=1)
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=os.cpu_count(),
+        help="The number of processes that convert html to markdown.",
+    )
     args = parser.parse_args()
     main(vars(args))
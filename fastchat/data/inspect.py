@@ -3,10 +3,12 @@ Usage:
 python3 -m fastchat.data.inspect --in sharegpt_20230322_clean_lang_split.json
 """
 import argparse
-import json
+import itertools
 
 import tqdm
 
+from fastchat.data.records import read_records
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -14,8 +16,8 @@ if __name__ == "__main__":
     parser.add_argument("--begin", type=int)
     args = parser.parse_args()
 
-    content = json.load(open(args.in_file, "r"))
-    for sample in tqdm.tqdm(content[args.begin :]):
+    content = read_records(args.in_file)
+    for sample in tqdm.tqdm(itertools.islice(content, args.begin, None)):
         print(f"id: {sample['id']}")
         for conv in sample["conversations"]:
             print(conv["from"] + ": ")
@@ -5,9 +5,11 @@ Usage: python3 -m fastchat.data.merge --in file1.json file2.json --out merged.js
 """
 
 import argparse
-import json
+import itertools
 from typing import Dict, Sequence, Optional
 
+from fastchat.data.records import read_records, write_records
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -15,9 +17,7 @@ if __name__ == "__main__":
     parser.add_argument("--out-file", type=str, default="merged.json")
     args = parser.parse_args()
 
-    new_content = []
-    for in_file in args.in_file:
-        content = json.load(open(in_file, "r"))
-        new_content.extend(content)
-
-    json.dump(new_content, open(args.out_file, "w"), indent=2)
+    new_content = itertools.chain.from_iterable(
+        read_records(in_file) for in_file in args.in_file
+    )
+    write_records(new_content, args.out_file)
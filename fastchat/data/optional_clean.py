@@ -9,7 +9,6 @@ Requirement:
 pip3 install polyglot icu pyicu pycld2 morfessor
 """
 import argparse
-import json
 import re
 
 import polyglot
@@ -17,6 +16,8 @@ from polyglot.detect import Detector
 import pycld2
 from tqdm import tqdm
 
+from fastchat.data.records import RecordCounter, read_records, write_records
+
 
 def skip(conv, args):
     # Remove certain languages
@@ -78,13 +79,8 @@ if __name__ == "__main__":
             out_file += "_reduce_rep"
         out_file += ".json"
 
-    content = json.load(open(in_file, "r"))
-    num_conv = len(content)
-
-    new_content = []
-    for conv in tqdm(content):
-        if not skip(conv, args):
-            new_content.append(conv)
+    content = RecordCounter(read_records(in_file))
+    new_content = (conv for conv in tqdm(content) if not skip(conv, args))
+    num_new = write_records(new_content, out_file)
 
-    print(f"return {len(new_content)} out of {len(content)}, start dump ...")
-    json.dump(new_content, open(out_file, "w"), indent=2)
+    print(f"return {num_new} out of {content.count}")
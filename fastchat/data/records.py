@@ -0,0 +1,139 @@
+"""
+Read and write streams of records, such as conversations.
+
+A file of records is a JSON array or JSON Lines. Both are read and written
+one record at a time, so a pipeline of generators over them runs in constant
+memory and starts before the whole file is parsed.
+"""
+import collections
+import itertools
+import json
+import re
+from typing import Iterable, Iterator
+
+CHUNK_SIZE = 1 << 20
+
+decoder = json.JSONDecoder()
+whitespace = re.compile(r"[ \t\n\r]*")
+number_chars = re.compile(r"[0-9.eE+-]*")
+
+
+def read_records(path: str) -> Iterator:
+    """Yield the records of JSON Lines if `path` ends with .jsonl or does not
+    start with a bracket, and of a JSON array otherwise."""
+    with open(path, "r") as fin:
+        buf = fin.read(CHUNK_SIZE)
+        start = whitespace.match(buf).end()
+        while start == len(buf):
+            chunk = fin.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            buf += chunk
+            start = whitespace.match(buf, start).end()
+        if not path.endswith(".jsonl") and buf[start : start + 1] == "[":
+            yield from read_array(fin, buf[start + 1 :])
+            return
+
+        # Complete the last line of the buffer.
+        lines = (buf + fin.readline()).split("\n")
+        for line in itertools.chain(lines, fin):
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_array(fin, buf: str) -> Iterator:
+    """Yield the values of a JSON array from `fin`, after its opening bracket
+    and the characters already read into `buf`. Raise `json.JSONDecodeError`
+    for invalid JSON, like `json.load`, including text after the array."""
+    pos, eof, first = 0, False, True
+    while True:
+        pos = whitespace.match(buf, pos).end()
+        if pos < len(buf) and first and buf[pos] == "]":
+            pos += 1
+            break
+
+        # The next value and the delimiter after it must both be in the
+        # buffer, since a value at its end may be cut.
+        after = len(buf)
+        if pos < len(buf):
+            try:
+                record, end = decoder.raw_decode(buf, pos)
+                # A number cut by the end of the buffer may still decode.
+                if not number_chars.fullmatch(buf, end):
+                    after = whitespace.match(buf, end).end()
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+        if after == len(buf):
+            if eof:
+                raise json.JSONDecodeError("Unterminated array", buf, after)
+            # Read at least as much as is buffered, so that a long record
+            # is decoded a logarithmic number of times.
+            chunk = fin.read(max(CHUNK_SIZE, len(buf) - pos))
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0
+            continue
+        if buf[after] not in ",]":
+            raise json.JSONDecodeError("Expecting ',' delimiter", buf, after)
+
+        yield record
+        first = False
+        pos = after + 1
+        if buf[after] == "]":
+            break
+
+    # Only whitespace may follow the array.
+    while True:
+        pos = whitespace.match(buf, pos).end()
+        if pos < len(buf):
+            raise json.JSONDecodeError("Extra data", buf, pos)
+        buf, pos = fin.read(CHUNK_SIZE), 0
+        if not buf:
+            return
+
+
+def write_records(records: Iterable, path: str, indent: int = 2) -> int:
+    """Write the records as JSON Lines if `path` ends with .jsonl, and as a
+    JSON array like `json.dump(list(records), indent=indent)` otherwise.
+    Return the number of records."""
+    num_records = 0
+    with open(path, "w") as fout:
+        if path.endswith(".jsonl"):
+            for record in records:
+                fout.write(json.dumps(record) + "\n")
+                num_records += 1
+            return num_records
+
+        prefix = " " * indent
+        for record in records:
+            fout.write("[\n" if num_records == 0 else ",\n")
+            text = json.dumps(record, indent=indent)
+            fout.write(prefix + text.replace("\n", "\n" + prefix))
+            num_records += 1
+        fout.write("\n]" if num_records else "[]")
+    return num_records
+
+
+class RecordCounter:
+    """Count the records that pass through."""
+
+    def __init__(self, records: Iterable):
+        self.records = records
+        self.count = 0
+
+    def __iter__(self):
+        for record in self.records:
+            self.count += 1
+            yield record
+
+
+def imap_bounded(pool, func, iterable: Iterable, max_pending: int) -> Iterator:
+    """Like `pool.imap`, but read at most `max_pending` items of `iterable`
+    ahead of the results, which `pool.imap` does not limit."""
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
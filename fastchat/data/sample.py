@@ -4,9 +4,11 @@ Sample some conversations from a file.
 Usage: python3 -m fastchat.data.sample --in sharegpt.json --out sampled.json
 """
 import argparse
-import json
+import itertools
 from typing import Dict, Sequence, Optional
 
+from fastchat.data.records import read_records, write_records
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -17,17 +19,15 @@ if __name__ == "__main__":
     parser.add_argument("--max-length", type=int, default=128)
     args = parser.parse_args()
 
-    content = json.load(open(args.in_file, "r"))
-    new_content = []
-    for i in range(args.begin, args.end):
-        sample = content[i]
-        concat = ""
-        for s in sample["conversations"]:
-            concat += s["value"]
+    def sample_content(content):
+        for sample in itertools.islice(content, args.begin, args.end):
+            concat = ""
+            for s in sample["conversations"]:
+                concat += s["value"]
 
-        if len(concat) > args.max_length:
-            continue
+            if len(concat) > args.max_length:
+                continue
 
-        new_content.append(sample)
+            yield sample
 
-    json.dump(new_content, open(args.out_file, "w"), indent=2)
+    write_records(sample_content(read_records(args.in_file)), args.out_file)
@@ -7,7 +7,7 @@ Usage: python3 -m fastchat.data.split_long_conversation \
     --model-name-or-path $<model-name>
 """
 import argparse
-import json
+import itertools
 from typing import Dict, Sequence, Optional
 
 import transformers
@@ -15,6 +15,8 @@ import tqdm
 
 from fastchat import conversation as conversation_lib
 from fastchat.conversation import conv_vicuna_v1_1
+from fastchat.data.records import RecordCounter, read_records, write_records
+
 
 def split_sample(sample, start_idx, end_idx):
     assert (end_idx - start_idx) % 2 == 0
@@ -33,8 +35,7 @@ def split_contents(content, begin, end, tokenizer, max_length, prefix=""):
     else:
         prefix_tokenized_len = len(tokenizer(prefix).input_ids) + 2
 
-    content = content[begin:end]
-    new_content = []
+    content = itertools.islice(content, begin, end)
 
     for sample in tqdm.tqdm(content):
         tokenized_lens = []
@@ -51,20 +52,17 @@ def split_contents(content, begin, end, tokenizer, max_length, prefix=""):
         for i in range(0, len(conversations), 2):
             tmp_len = tokenized_lens[i] + tokenized_lens[i + 1]
             if cur_len + tmp_len > max_length:
-                new_content.append(split_sample(sample, start_idx, i))
+                yield split_sample(sample, start_idx, i)
                 # skip long content
                 start_idx = (i+2) if prefix_tokenized_len + tmp_len > max_length else i
                 cur_len = prefix_tokenized_len
             elif i == len(conversations) - 2:
-                new_content.append(split_sample(sample, start_idx, i + 2))
+                yield split_sample(sample, start_idx, i + 2)
 
             cur_len += tmp_len
 
-    return new_content
-
 
 def filter_invalid_roles(content):
-    new_content = []
     for i, c in enumerate(content):
         roles = ["human", "gpt"]
         if len(c["conversations"]) <= 0:
@@ -77,13 +75,11 @@ def filter_invalid_roles(content):
                 break
 
         if valid:
-            new_content.append(c)
-
-    return new_content
+            yield c
 
 
 def main(args):
-    content = json.load(open(args.in_file, "r"))
+    content = RecordCounter(read_records(args.in_file))
     tokenizer = transformers.AutoTokenizer.from_pretrained(
         args.model_name_or_path,
         model_max_length=args.max_length,
@@ -95,9 +91,9 @@ def main(args):
         content, args.begin, args.end, tokenizer, args.max_length, conv_vicuna_v1_1.system
     )
     new_content = filter_invalid_roles(new_content)
+    num_new = write_records(new_content, args.out_file)
 
-    print(f"total: {len(content)}, new: {len(new_content)}")
-    json.dump(new_content, open(args.out_file, "w"), indent=2)
+    print(f"total: {content.count}, new: {num_new}")
 
 
 if __name__ == "__main__":
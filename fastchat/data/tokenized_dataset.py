@@ -0,0 +1,124 @@
+"""
+A memory-mapped store of tokenized conversations.
+
+A dataset is a directory with
+- meta.json: the dtype of the token ids, the pad token, the max length and the
+  names of the shards.
+- index.npy: int64 [num_samples, 3] of the shard, offset and length of each
+  sample.
+- <shard>.ids and <shard>.mask: the token ids of consecutive samples, and a
+  uint8 mask that is 1 where the label is the token and 0 where it is ignored.
+
+Opening a dataset only reads the index. The shards are mapped into memory, so
+all ranks of a training job share their pages.
+"""
+import json
+import os
+from typing import List, Tuple
+
+import numpy as np
+
+META_FILE = "meta.json"
+INDEX_FILE = "index.npy"
+
+
+def is_tokenized_dataset(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, META_FILE))
+
+
+class TokenizedDatasetWriter:
+    """Append samples to a new dataset at `path`.
+
+    A shard is closed when it would exceed `shard_size` tokens. The index and
+    meta.json are written by `close`, so a dataset is only readable once it
+    is complete.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        vocab_size: int,
+        pad_token_id: int,
+        model_max_length: int,
+        shard_size: int = 2**28,
+        **metadata,
+    ):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.dtype = np.uint16 if vocab_size <= 2**16 else np.int32
+        self.shard_size = shard_size
+        self.meta = dict(
+            metadata,
+            vocab_size=vocab_size,
+            pad_token_id=pad_token_id,
+            model_max_length=model_max_length,
+            dtype=np.dtype(self.dtype).name,
+        )
+
+        self.shards: List[str] = []
+        self.index: List[Tuple[int, int, int]] = []
+        self.shard_len = 0
+        self.ids_file = self.mask_file = None
+
+    def add(self, input_ids, loss_mask):
+        if self.ids_file is None or self.shard_len + len(input_ids) > self.shard_size:
+            self.next_shard()
+        np.asarray(input_ids, dtype=self.dtype).tofile(self.ids_file)
+        np.asarray(loss_mask, dtype=np.uint8).tofile(self.mask_file)
+        self.index.append((len(self.shards) - 1, self.shard_len, len(input_ids)))
+        self.shard_len += len(input_ids)
+
+    def next_shard(self):
+        self.close_shard()
+        name = f"shard-{len(self.shards):05d}"
+        self.shards.append(name)
+        self.ids_file = open(os.path.join(self.path, name + ".ids"), "wb")
+        self.mask_file = open(os.path.join(self.path, name + ".mask"), "wb")
+        self.shard_len = 0
+
+    def close_shard(self):
+        if self.ids_file is not None:
+            self.ids_file.close()
+            self.mask_file.close()
+
+    def close(self):
+        self.close_shard()
+        index = np.array(self.index, dtype=np.int64).reshape(-1, 3)
+        np.save(os.path.join(self.path, INDEX_FILE), index)
+        meta = dict(self.meta, num_samples=len(index), shards=self.shards)
+        with open(os.path.join(self.path, META_FILE), "w") as fout:
+            json.dump(meta, fout, indent=2)
+
+
+class TokenizedDataset:
+    """Read the samples of a dataset as numpy views of its shards."""
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, META_FILE)) as fin:
+            self.meta = json.load(fin)
+        self.index = np.load(os.path.join(path, INDEX_FILE))
+        dtype = np.dtype(self.meta["dtype"])
+        self.ids = [
+            np.memmap(os.path.join(path, name + ".ids"), dtype=dtype, mode="r")
+            for name in self.meta["shards"]
+        ]
+        self.masks = [
+            np.memmap(os.path.join(path, name + ".mask"), dtype=np.uint8, mode="r")
+            for name in self.meta["shards"]
+        ]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """The number of tokens of each sample."""
+        return self.index[:, 2]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the token ids and the loss mask of sample `i`."""
+        shard, offset, length = self.index[i]
+        return (
+            self.ids[shard][offset : offset + length],
+            self.masks[shard][offset : offset + length],
+        )
@@ -0,0 +1,36 @@
+"""
+Quantize a model once and save the compressed weights, so that workers can
+load them directly without running `compress_module` at every start.
+
+Usage:
+python3 -m fastchat.model.compress_model --in-checkpoint in-folder --out-checkpoint out-folder --num-bits 8
+python3 -m fastchat.serve.model_worker --model-path out-folder
+"""
+import argparse
+
+from transformers import AutoTokenizer, AutoModelForCausalLM
+import torch
+
+from fastchat.serve.compression import save_compressed_model
+
+
+def compress_model(in_checkpoint, out_checkpoint, num_bits, group_size):
+    tokenizer = AutoTokenizer.from_pretrained(in_checkpoint, use_fast=False)
+    model = AutoModelForCausalLM.from_pretrained(
+        in_checkpoint, torch_dtype=torch.float16, low_cpu_mem_usage=True
+    )
+    save_compressed_model(model, out_checkpoint, num_bits, group_size)
+    tokenizer.save_pretrained(out_checkpoint)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--in-checkpoint", type=str, help="Path to the model")
+    parser.add_argument("--out-checkpoint", type=str, help="Path to the output model")
+    parser.add_argument("--num-bits", type=int, choices=[4, 8], default=8)
+    parser.add_argument("--group-size", type=int, default=256)
+    args = parser.parse_args()
+
+    compress_model(
+        args.in_checkpoint, args.out_checkpoint, args.num_bits, args.group_size
+    )
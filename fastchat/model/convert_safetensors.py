@@ -0,0 +1,27 @@
+"""
+Convert a checkpoint to safetensors once, so that workers can memory-map it.
+
+Usage:
+python3 -m fastchat.model.convert_safetensors --in-checkpoint in-folder --out-checkpoint out-folder
+"""
+import argparse
+
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+
+def convert_safetensors(in_checkpoint, out_checkpoint):
+    tokenizer = AutoTokenizer.from_pretrained(in_checkpoint, use_fast=False)
+    model = AutoModelForCausalLM.from_pretrained(
+        in_checkpoint, torch_dtype="auto", low_cpu_mem_usage=True
+    )
+    model.save_pretrained(out_checkpoint, safe_serialization=True)
+    tokenizer.save_pretrained(out_checkpoint)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--in-checkpoint", type=str, help="Path to the model")
+    parser.add_argument("--out-checkpoint", type=str, help="Path to the output model")
+    args = parser.parse_args()
+
+    convert_safetensors(args.in_checkpoint, args.out_checkpoint)
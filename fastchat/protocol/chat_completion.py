@@ -7,13 +7,16 @@ from pydantic import BaseModel, Field
 
 
 class ChatCompletionRequest(BaseModel):
-    # TODO: support streaming, stop with a list of text etc.
+    # TODO: support stop with a list of text etc.
     model: str
     messages: List[Dict[str, str]]
     temperature: Optional[float] = 0.7
+    top_p: Optional[float] = None
     n: int = 1
     max_tokens: Optional[int] = None
     stop: Optional[str] = None
+    stream: Optional[bool] = False
+    frequency_penalty: Optional[float] = None
 
 
 class ChatMessage(BaseModel):
@@ -27,9 +30,38 @@ class ChatCompletionResponseChoice(BaseModel):
     finish_reason: str
 
 
+class UsageInfo(BaseModel):
+    prompt_tokens: int
+    completion_tokens: int
+    total_tokens: int
+    # Seconds to the first token and to decode the remaining tokens
+    ttft: Optional[float] = None
+    decode_time: Optional[float] = None
+
+
 class ChatCompletionResponse(BaseModel):
     id: str = Field(default_factory=shortuuid.random)
     object: str = "chat.completion"
     created: int = Field(default_factory=lambda: int(time.time()))
     choices: List[ChatCompletionResponseChoice]
-    usage: Optional[Dict[str, int]] = None
+    usage: Optional[UsageInfo] = None
+
+
+class DeltaMessage(BaseModel):
+    role: Optional[str] = None
+    content: Optional[str] = None
+
+
+class ChatCompletionResponseStreamChoice(BaseModel):
+    index: int
+    delta: DeltaMessage
+    finish_reason: Optional[str] = None
+
+
+class ChatCompletionStreamResponse(BaseModel):
+    id: str = Field(default_factory=shortuuid.random)
+    object: str = "chat.completion.chunk"
+    created: int = Field(default_factory=lambda: int(time.time()))
+    choices: List[ChatCompletionResponseStreamChoice]
+    # Only set in the last chunk, which has no choices.
+    usage: Optional[UsageInfo] = None
@@ -0,0 +1,97 @@
+"""
+The streaming format of `/worker_generate_stream`.
+
+The worker sends JSON chunks separated by b"\0". In version 1, every chunk
+carries the whole text so far, including the prompt. In version 2, requested
+with `"stream_version": 2`, a chunk carries only the new generated text
+together with the token usage and the finish reason, so the bytes sent grow
+linearly with the output length instead of quadratically. When `n` samples
+are requested, their chunks are interleaved and carry the sample `index`.
+
+The usage of the final chunk of a sample also reports the seconds to the first
+token (`ttft`) and to decode the remaining tokens (`decode_time`).
+"""
+import json
+import time
+
+STREAM_VERSION = 2
+DELIMITER = b"\0"
+
+
+def get_usage(prompt_tokens, completion_tokens, start_time, first_token_time, done):
+    """Return the token counts of a completion, and its timing once it is done."""
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+    if done:
+        # Time to the first token, and the time to decode the remaining ones.
+        usage["ttft"] = first_token_time - start_time
+        usage["decode_time"] = time.time() - first_token_time
+    return usage
+
+
+class StreamEncoder:
+    """Encode the outputs of `generate_stream` as chunks of a stream version.
+
+    For version 2, the outputs must be generated with `echo=False`.
+    """
+
+    def __init__(self, stream_version: int = 1):
+        self.stream_version = stream_version
+        # Dict[index -> number of characters sent]
+        self.num_sent = {}
+
+    def encode(self, output):
+        if self.stream_version >= 2:
+            index = output.get("index", 0)
+            num_sent = self.num_sent.get(index, 0)
+            ret = {
+                "text": output["text"][num_sent:],
+                "error_code": 0,
+                "usage": output["usage"],
+                "finish_reason": output["finish_reason"],
+                "index": index,
+                "stream_version": 2,
+            }
+            self.num_sent[index] = len(output["text"])
+        else:
+            ret = {
+                "text": output["text"],
+                "error_code": 0,
+            }
+        return json.dumps(ret).encode() + DELIMITER
+
+
+class StreamDecoder:
+    """Split a worker stream into chunks and rebuild the text so far.
+
+    Both versions are accepted, so that clients can talk to workers which do
+    not know version 2 yet. The prompt echoed by version 1 is skipped with
+    `skip_echo_len`, so the text is always the generated output.
+    """
+
+    def __init__(self, skip_echo_len: int = 0):
+        self.skip_echo_len = skip_echo_len
+        # Dict[index -> text so far]
+        self.texts = {}
+        self.buffer = b""
+
+    def feed(self, raw: bytes):
+        """Return the chunks completed by `raw`."""
+        *chunks, self.buffer = (self.buffer + raw).split(DELIMITER)
+        return [self.decode(chunk) for chunk in chunks if chunk]
+
+    def decode(self, chunk: bytes):
+        """Decode one chunk and replace its text with the whole text so far."""
+        data = json.loads(chunk)
+        if data["error_code"] != 0:
+            return data
+        index = data.setdefault("index", 0)
+        if data.get("stream_version", 1) >= 2:
+            text = self.texts.get(index, "") + data["text"]
+        else:
+            text = data["text"][self.skip_echo_len :]
+        self.texts[index] = data["text"] = text
+        return data
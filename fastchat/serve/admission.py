@@ -0,0 +1,136 @@
+"""
+Admission control for the requests of a model worker.
+
+A worker runs a fixed number of requests at once. The others wait in a bounded
+queue, ordered by their priority class and then by arrival. A request that
+cannot start before its deadline is rejected at once instead of adding to the
+latency of everyone behind it, so that the client can retry on another worker.
+"""
+import asyncio
+from collections import deque
+import heapq
+import itertools
+import time
+
+# Lower values start first.
+PRIORITIES = {"interactive": 0, "batch": 1}
+
+
+class RequestRejected(Exception):
+    """A request that could not start before its deadline."""
+
+
+class AdmissionQueue:
+    """A bounded priority queue in front of `max_concurrency` slots.
+
+    A request is rejected when the queue is full, when its estimated wait
+    already exceeds its timeout, or when the timeout passes while it waits.
+    All methods must be called from the event loop of the worker.
+    """
+
+    def __init__(self, max_concurrency, max_queue_size, window=64):
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self.num_running = 0
+        # A min-heap of (priority, arrival order, future) of waiting requests
+        self.waiters = []
+        self.counter = itertools.count()
+
+        # Seconds waited by and seconds holding a slot of recent requests
+        self.wait_times = deque(maxlen=window)
+        self.service_times = deque(maxlen=window)
+        self.num_admitted = 0
+        self.num_rejected = 0
+
+    @property
+    def queue_length(self):
+        """The number of running and waiting requests."""
+        return self.num_running + len(self.waiters)
+
+    def estimate_wait(self, priority):
+        """Seconds until a new request of `priority` gets a slot."""
+        if not self.service_times:
+            return 0.0
+        ahead = sum(1 for waiter in self.waiters if waiter[0] <= priority)
+        mean_service_time = sum(self.service_times) / len(self.service_times)
+        return (ahead + 1) * mean_service_time / self.max_concurrency
+
+    async def acquire(self, priority, timeout):
+        """Wait for a slot and return the time it was granted.
+
+        Raise `RequestRejected` if the request cannot start within `timeout`
+        seconds.
+        """
+        arrival = time.time()
+        if self.num_running < self.max_concurrency and not self.waiters:
+            self.num_running += 1
+            return self.admit(arrival)
+        if len(self.waiters) >= self.max_queue_size:
+            self.reject("the queue is full")
+        if self.estimate_wait(priority) > timeout:
+            self.reject(f"it cannot start within {timeout} s")
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (priority, next(self.counter), future)
+        heapq.heappush(self.waiters, waiter)
+        timer = loop.call_later(timeout, self.expire, waiter, timeout)
+        try:
+            # `release` passes its slot on by resolving the future.
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self.remove(waiter)
+            else:
+                self.release()
+            raise
+        finally:
+            timer.cancel()
+        return self.admit(arrival)
+
+    def release(self, start_time=None):
+        """Free the slot granted at `start_time` or pass it to the next waiter."""
+        if start_time is not None:
+            self.service_times.append(time.time() - start_time)
+        while self.waiters:
+            future = heapq.heappop(self.waiters)[2]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.num_running -= 1
+
+    def admit(self, arrival):
+        now = time.time()
+        self.wait_times.append(now - arrival)
+        self.num_admitted += 1
+        return now
+
+    def reject(self, reason):
+        self.num_rejected += 1
+        raise RequestRejected(f"The request is rejected because {reason}.")
+
+    def expire(self, waiter, timeout):
+        future = waiter[2]
+        if not future.done():
+            self.remove(waiter)
+            self.num_rejected += 1
+            future.set_exception(
+                RequestRejected(f"The request did not start within {timeout} s.")
+            )
+
+    def remove(self, waiter):
+        # `release` may have already dropped a cancelled waiter.
+        if waiter in self.waiters:
+            self.waiters.remove(waiter)
+            heapq.heapify(self.waiters)
+
+    def get_status(self):
+        wait_times = list(self.wait_times)
+        return {
+            "num_running": self.num_running,
+            "num_waiting": len(self.waiters),
+            "num_admitted": self.num_admitted,
+            "num_rejected": self.num_rejected,
+            "mean_wait_time": sum(wait_times) / len(wait_times) if wait_times else 0.0,
+            "max_wait_time": max(wait_times, default=0.0),
+        }
@@ -6,15 +6,20 @@ python3 -m fastchat.serve.api
 
 Reference: https://platform.openai.com/docs/api-reference/chat/create
 """
-import asyncio
+from collections import defaultdict
 from typing import Union, Dict, List, Any
 
 import argparse
+import asyncio
 import json
 import logging
+import random
+import time
 
 import fastapi
+from fastapi.responses import JSONResponse, StreamingResponse
 import httpx
+import shortuuid
 import uvicorn
 from pydantic import BaseSettings
 
@@ -23,9 +28,19 @@ from fastchat.protocol.chat_completion import (
     ChatCompletionResponse,
     ChatMessage,
     ChatCompletionResponseChoice,
+    ChatCompletionResponseStreamChoice,
+    ChatCompletionStreamResponse,
+    DeltaMessage,
+    UsageInfo,
+)
+from fastchat.protocol.worker_stream import StreamDecoder, STREAM_VERSION
+from fastchat.constants import (
+    INVALID_REQUEST_ERROR_CODE,
+    WORKER_OVERLOADED_ERROR_CODE,
 )
 from fastchat.conversation import get_default_conv_template, SeparatorStyle
-from fastchat.serve.inference import compute_skip_echo_len
+from fastchat.serve.inference import compute_skip_echo_len, partial_stop_length
+from fastchat.serve.metrics import APIMetrics, metrics_response
 
 logger = logging.getLogger(__name__)
 
@@ -33,11 +48,135 @@ logger = logging.getLogger(__name__)
 class AppSettings(BaseSettings):
     # The address of the model controller.
     FASTCHAT_CONTROLLER_URL: str = "http://localhost:21001"
+    # Seconds to cache the workers of a model. The API server then picks the
+    # workers itself, which approximates the default shortest_queue dispatch of
+    # the controller. With 0, or if the controller uses another
+    # --dispatch-method, the controller picks the worker of every request.
+    FASTCHAT_WORKER_ADDRESS_TTL: float = 2.0
 
 
 app_settings = AppSettings()
 app = fastapi.FastAPI()
 headers = {"User-Agent": "FastChat API Server"}
+client = None
+worker_address_cache = None
+metrics = APIMetrics()
+
+
+class WorkerOverloaded(Exception):
+    """The worker rejected the request before generating anything."""
+
+
+class APIError(Exception):
+    """An error returned to the client in the format of the OpenAI API."""
+
+    def __init__(
+        self,
+        status_code: int,
+        message: str,
+        type: str = "server_error",
+        code: Union[str, None] = None,
+    ):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.type = type
+        self.code = code
+
+    def to_dict(self):
+        return {
+            "error": {"message": self.message, "type": self.type, "code": self.code}
+        }
+
+
+class WorkerAddressCache:
+    """Cache the workers of each model for a short time.
+
+    A request goes to the cached worker with the fewest requests in flight from
+    this server relative to its speed. The workers of a model are fetched again
+    when the entry expires or one of its workers fails, and all entries are
+    dropped when the controller reports a changed registry.
+
+    This only stands in for the shortest_queue dispatch of the controller. If
+    the controller reports another dispatch method, every request is
+    dispatched by the controller.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        # Dict[str -> (List[str], List[float], float)]. The addresses and speeds
+        # of the workers of each model, and the expiration time.
+        self.entries = {}
+        self.registry_version = None
+        self.dispatch_method = None
+        # Dict[str -> int]. The number of requests in flight to each worker.
+        self.in_flight = defaultdict(int)
+
+    async def get_worker_address(
+        self, model_name: str, max_new_tokens: int = None, exclude=()
+    ):
+        controller_url = app_settings.FASTCHAT_CONTROLLER_URL
+        entry = None
+        if self.ttl > 0:
+            entry = self.entries.get(model_name, None)
+            if entry is None or entry[2] < time.time():
+                ret = await client.post(
+                    controller_url + "/list_workers", json={"model": model_name}
+                )
+                data = ret.json()
+                if data["registry_version"] != self.registry_version:
+                    self.entries = {}
+                    self.registry_version = data["registry_version"]
+                self.dispatch_method = data.get("dispatch_method", "shortest_queue")
+                entry = (data["addresses"], data["speeds"], time.time() + self.ttl)
+                self.entries[model_name] = entry
+
+        if entry is None or self.dispatch_method != "shortest_queue":
+            ret = await client.post(
+                controller_url + "/get_worker_address",
+                json={"model": model_name, "max_new_tokens": max_new_tokens},
+            )
+            return ret.json()["address"]
+
+        candidates = [
+            (addr, speed)
+            for addr, speed in zip(entry[0], entry[1])
+            if addr not in exclude and speed > 0
+        ]
+        if not candidates:
+            return ""
+        # Break ties randomly, so that idle workers share the load.
+        random.shuffle(candidates)
+        return min(candidates, key=lambda c: (self.in_flight[c[0]] + 1) / c[1])[0]
+
+    def invalidate(self, model_name: str):
+        self.entries.pop(model_name, None)
+
+
+@app.on_event("startup")
+async def startup():
+    global client, worker_address_cache
+    # A shared client keeps a pool of keep-alive connections to the controller
+    # and the workers.
+    client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=None, max_keepalive_connections=1024)
+    )
+    worker_address_cache = WorkerAddressCache(app_settings.FASTCHAT_WORKER_ADDRESS_TTL)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await client.aclose()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return metrics_response(metrics.registry)
+
+
+@app.exception_handler(APIError)
+async def handle_api_error(request: fastapi.Request, e: APIError):
+    return JSONResponse(e.to_dict(), status_code=e.status_code)
 
 
 @app.post("/v1/chat/completions")
@@ -49,33 +188,24 @@ async def create_chat_completion(request: ChatCompletionRequest):
         temperature=request.temperature,
         max_tokens=request.max_tokens,
         stop=request.stop,
+        n=request.n,
+        top_p=request.top_p,
+        frequency_penalty=request.frequency_penalty,
     )
 
-    choices = []
-    # TODO: batch the requests. maybe not necessary if using CacheFlow worker
-    chat_completions = []
-    for i in range(request.n):
-        content = asyncio.create_task(chat_completion(request.model, payload, skip_echo_len))
-        chat_completions.append(content)
-
-    for i, content_task in enumerate(chat_completions):
-        content = await content_task
-        choices.append(
-            ChatCompletionResponseChoice(
-                index=i,
-                message=ChatMessage(role="assistant", content=content),
-                # TODO: support other finish_reason
-                finish_reason="stop",
-            )
-        )
+    if request.stream:
+        events = chat_completion_stream(request.model, payload, skip_echo_len)
+        # Find a worker and wait for its first event before the response
+        # starts, so that errors until then still get an HTTP status.
+        try:
+            first_events = [await events.__anext__()]
+        except StopAsyncIteration:
+            first_events = []
+        generator = chat_completion_stream_generator(payload["n"], first_events, events)
+        return StreamingResponse(generator, media_type="text/event-stream")
 
-    # TODO: support usage field
-    # "usage": {
-    #     "prompt_tokens": 9,
-    #     "completion_tokens": 12,
-    #     "total_tokens": 21
-    # }
-    return ChatCompletionResponse(choices=choices)
+    choices, usage = await chat_completion(request.model, payload, skip_echo_len)
+    return ChatCompletionResponse(choices=choices, usage=usage)
 
 
 def generate_payload(
@@ -85,6 +215,9 @@ def generate_payload(
     temperature: float,
     max_tokens: int,
     stop: Union[str, None],
+    n: int = 1,
+    top_p: Union[float, None] = None,
+    frequency_penalty: Union[float, None] = None,
 ):
     is_chatglm = "chatglm" in model_name.lower()
     # TODO(suquark): The template is currently a reference. Here we have to make a copy.
@@ -128,44 +261,252 @@ def generate_payload(
         "temperature": temperature,
         "max_new_tokens": max_tokens,
         "stop": stop,
+        "n": n,
+        "stream_version": STREAM_VERSION,
     }
+    # Workers fall back to their own defaults, e.g. top_p of ChatGLM.
+    if top_p is not None:
+        payload["top_p"] = top_p
+    if frequency_penalty is not None:
+        payload["frequency_penalty"] = frequency_penalty
 
     logger.debug(f"==== request ====\n{payload}")
     return payload, skip_echo_len
 
 
+async def chat_completion_stream_generator(
+    n: int, first_events: List[Dict[str, Any]], events
+):
+    """Relay the new text of each choice as OpenAI-style server-sent events.
+
+    `first_events` were already taken from `events`. An error after them ends
+    the stream with an error event.
+    """
+    completion_id = f"chatcmpl-{shortuuid.random()}"
+    created = int(time.time())
+
+    def make_event(choice=None, usage=None):
+        chunk = ChatCompletionStreamResponse(
+            id=completion_id,
+            created=created,
+            choices=[] if choice is None else [choice],
+            usage=usage,
+        )
+        return f"data: {chunk.json(exclude_none=True, ensure_ascii=False)}\n\n"
+
+    # The first chunk of a choice carries the role, the following ones only
+    # new text.
+    for i in range(n):
+        yield make_event(
+            ChatCompletionResponseStreamChoice(
+                index=i, delta=DeltaMessage(role="assistant")
+            )
+        )
+
+    async def all_events():
+        for event in first_events:
+            yield event
+        async for event in events:
+            yield event
+
+    usages = {}
+    try:
+        async for event in all_events():
+            if "delta" in event:
+                choice = ChatCompletionResponseStreamChoice(
+                    index=event["index"], delta=DeltaMessage(content=event["delta"])
+                )
+            else:
+                choice = ChatCompletionResponseStreamChoice(
+                    index=event["index"],
+                    delta=DeltaMessage(),
+                    finish_reason=event["finish_reason"],
+                )
+                usages[event["index"]] = event["usage"]
+            yield make_event(choice)
+    except APIError as e:
+        yield f"data: {json.dumps(e.to_dict(), ensure_ascii=False)}\n\n"
+        yield "data: [DONE]\n\n"
+        return
+
+    # The usage of all choices follows in a chunk without choices.
+    usage = merge_usages(usages)
+    if usage is not None:
+        yield make_event(usage=usage)
+    yield "data: [DONE]\n\n"
+
+
 async def chat_completion(model_name: str, payload: Dict[str, Any], skip_echo_len: int):
-    controller_url = app_settings.FASTCHAT_CONTROLLER_URL
-    async with httpx.AsyncClient() as client:
-        ret = await client.post(
-            controller_url + "/get_worker_address", json={"model": model_name}
+    """Return all choices of a completion and their total usage."""
+    contents = defaultdict(list)
+    finish_reasons = {}
+    usages = {}
+    async for event in chat_completion_stream(model_name, payload, skip_echo_len):
+        if "delta" in event:
+            contents[event["index"]].append(event["delta"])
+        else:
+            finish_reasons[event["index"]] = event["finish_reason"]
+            usages[event["index"]] = event["usage"]
+
+    choices = [
+        ChatCompletionResponseChoice(
+            index=i,
+            message=ChatMessage(role="assistant", content="".join(contents[i])),
+            finish_reason=finish_reason,
         )
-        worker_addr = ret.json()["address"]
-        # No available worker
-        if worker_addr == "":
-            raise ValueError(f"No available worker for {model_name}")
-
-        logger.debug(f"model_name: {model_name}, worker_addr: {worker_addr}")
-
-        output = ""
-        delimiter = b"\0"
-        async with client.stream(
-            "POST",
-            worker_addr + "/worker_generate_stream",
-            headers=headers,
-            json=payload,
-            timeout=20,
-        ) as response:
-            content = await response.aread()
-
-        for chunk in content.split(delimiter):
-            if not chunk:
-                continue
-            data = json.loads(chunk.decode())
-            if data["error_code"] == 0:
-                output = data["text"][skip_echo_len:].strip()
-
-        return output
+        for i, finish_reason in sorted(finish_reasons.items())
+    ]
+
+    return choices, merge_usages(usages)
+
+
+def merge_usages(usages: Dict[int, Any]):
+    """Return the total usage of the choices, or None if a worker did not report it."""
+    if not usages or None in usages.values():
+        return None
+    usages = list(usages.values())
+    # The prompt is shared by all choices, so it is counted once.
+    prompt_tokens = usages[0]["prompt_tokens"]
+    completion_tokens = sum(u["completion_tokens"] for u in usages)
+    usage = UsageInfo(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+    )
+    # The choices are decoded together, so the first token of any choice ends
+    # the wait and the last choice to finish ends the decoding.
+    if all("ttft" in u for u in usages):
+        usage.ttft = min(u["ttft"] for u in usages)
+        usage.decode_time = max(u["decode_time"] for u in usages)
+    return usage
+
+
+async def chat_completion_stream(
+    model_name: str, payload: Dict[str, Any], skip_echo_len: int
+):
+    """Yield the events of a completion from any available worker."""
+    start_time = time.time()
+    outcome = "error"
+    # Workers that failed to accept this request.
+    exclude = set()
+    try:
+        while True:
+            worker_addr = await worker_address_cache.get_worker_address(
+                model_name, payload["max_new_tokens"], exclude
+            )
+            # No available worker
+            if worker_addr == "" and not exclude:
+                raise APIError(
+                    404,
+                    f"No worker serves the model {model_name}.",
+                    "invalid_request_error",
+                    "model_not_found",
+                )
+            if worker_addr == "" or worker_addr in exclude:
+                # Every worker was overloaded or unreachable, which may pass.
+                raise APIError(
+                    503,
+                    f"All workers of the model {model_name} are overloaded or "
+                    "unreachable. Please retry later.",
+                )
+
+            logger.debug(f"model_name: {model_name}, worker_addr: {worker_addr}")
+
+            worker_address_cache.in_flight[worker_addr] += 1
+            try:
+                async for event in worker_chat_completion_stream(
+                    worker_addr, payload, skip_echo_len
+                ):
+                    if "finish_reason" in event:
+                        metrics.usage.observe(event["usage"])
+                    yield event
+                metrics.dispatch.labels(worker_addr, "ok").inc()
+                outcome = "ok"
+                metrics.latency.observe(time.time() - start_time)
+                return
+            except httpx.ConnectError as e:
+                # Nothing was generated yet, so another worker can take the request.
+                logger.warning(f"Connect to worker fails: {worker_addr}, {e}")
+                metrics.dispatch.labels(worker_addr, "failed").inc()
+                worker_address_cache.invalidate(model_name)
+                exclude.add(worker_addr)
+            except WorkerOverloaded:
+                logger.info(f"Worker is overloaded: {worker_addr}")
+                metrics.dispatch.labels(worker_addr, "overloaded").inc()
+                exclude.add(worker_addr)
+            except httpx.HTTPError as e:
+                metrics.dispatch.labels(worker_addr, "failed").inc()
+                worker_address_cache.invalidate(model_name)
+                raise APIError(502, f"The worker failed: {e!r}") from e
+            finally:
+                worker_address_cache.in_flight[worker_addr] -= 1
+    except (asyncio.CancelledError, GeneratorExit):
+        # The client disconnected.
+        outcome = "aborted"
+        raise
+    finally:
+        metrics.requests.labels(model_name, outcome).inc()
+
+
+async def worker_chat_completion_stream(
+    worker_addr: str, payload: Dict[str, Any], skip_echo_len: int
+):
+    """Yield the new text and the end of each choice as soon as the worker sends it.
+
+    The events are `{"index", "delta"}` for new text and, once per choice,
+    `{"index", "finish_reason", "usage"}`. Older workers may still remove a
+    partially generated stop string, and the trailing whitespace is stripped at
+    the end, so that part is held back until more text arrives or the choice
+    ends.
+    """
+    # Dict[index -> output] of the unfinished choices
+    outputs = {}
+    num_sent = defaultdict(int)
+    decoder = StreamDecoder(skip_echo_len)
+    async with client.stream(
+        "POST",
+        worker_addr + "/worker_generate_stream",
+        headers=headers,
+        json=payload,
+        timeout=20,
+    ) as response:
+        async for raw in response.aiter_raw():
+            for data in decoder.feed(raw):
+                if data["error_code"] == WORKER_OVERLOADED_ERROR_CODE:
+                    raise WorkerOverloaded(worker_addr)
+                if data["error_code"] == INVALID_REQUEST_ERROR_CODE:
+                    raise APIError(400, data["text"], "invalid_request_error")
+                if data["error_code"] != 0:
+                    raise APIError(
+                        500, f"{data['text']} (error_code: {data['error_code']})"
+                    )
+                index = data["index"]
+                output = data["text"].lstrip()
+                finish_reason = data.get("finish_reason")
+                sendable = output.rstrip()
+                if finish_reason is None:
+                    stop_len = partial_stop_length(sendable, payload["stop"])
+                    sendable = sendable[: len(sendable) - stop_len].rstrip()
+                    outputs[index] = output
+                else:
+                    outputs.pop(index, None)
+
+                if len(sendable) > num_sent[index]:
+                    yield {"index": index, "delta": sendable[num_sent[index] :]}
+                    num_sent[index] = len(sendable)
+                if finish_reason is not None:
+                    yield {
+                        "index": index,
+                        "finish_reason": finish_reason,
+                        "usage": data["usage"],
+                    }
+
+    # Older workers do not send the finish reason.
+    for index, output in sorted(outputs.items()):
+        output = output.rstrip()
+        if len(output) > num_sent[index]:
+            yield {"index": index, "delta": output[num_sent[index] :]}
+        yield {"index": index, "finish_reason": "stop", "usage": None}
 
 
 if __name__ == "__main__":
@@ -28,6 +28,8 @@ from cacheflow.sampling_params import SamplingParams
 from cacheflow.sequence import Sequence, SequenceGroup
 from cacheflow.utils import Counter, get_gpu_memory, get_cpu_memory
 from fastchat.constants import WORKER_HEART_BEAT_INTERVAL
+from fastchat.protocol.worker_stream import get_usage
+from fastchat.serve.metrics import WorkerMetrics, metrics_response
 from fastchat.utils import build_logger, pretty_print_semaphore
 
 GB = 1 << 30
@@ -102,6 +104,7 @@ class CacheFlowWorker:
         self.running_seq_groups: Dict[int, SequenceGroup] = {}
         self.sequence_group_events: Dict[int, asyncio.Event] = {}
         self.is_server_running = False
+        self.metrics = WorkerMetrics(self.get_queue_length)
 
         if not no_register:
             self.register_to_controller()
@@ -195,12 +198,12 @@ class CacheFlowWorker:
         # make sampling params in cacheflow
         sampling_params = SamplingParams.from_dict(params)
         sampling_params.stop_token_ids.add(tokenizer.eos_token_id)
-        sampling_params.n = 1
+        sampling_params.n = int(params.get("n", 1))
         sampling_params.max_num_steps = max_new_tokens
         sampling_params.temperature = temperature
         if stop_str is not None:
             sampling_params.stop_str = stop_str
-        # we might sample multiple sequences, but in chatbot, this is one
+        # The `n` samples share the prompt as one sequence group.
         seqs: List[Sequence] = []
         for _ in range(sampling_params.n):
             seq_id = next(self.seq_counter)
@@ -215,6 +218,7 @@ class CacheFlowWorker:
         self.running_seq_groups[group_id] = seq_group
         self.sequence_group_events[group_id] = group_event
         self.server.add_sequence_groups([(seq_group, sampling_params)])
+        first_token_time = None
         while True:
             if not self.is_server_running:
                 await self.server_step()
@@ -226,21 +230,33 @@ class CacheFlowWorker:
                 pass
             group_event.clear()
             seq_group = self.running_seq_groups[group_id]
-            all_outputs = []
-            for seq in seq_group.seqs:
+            if first_token_time is None:
+                first_token_time = time.time()
+            finished = seq_group.is_finished()
+            for i, seq in enumerate(seq_group.seqs):
                 token_ids = seq.get_token_ids()
                 output = self.tokenizer.decode(token_ids, skip_special_tokens=True)
                 if stop_str is not None:
                     if output.endswith(stop_str):
                         output = output[: -len(stop_str)]
-                all_outputs.append(output)
-            assert len(seq_group.seqs) == 1
-            ret = {
-                "text": all_outputs[0],
-                "error_code": 0,
-            }
-            yield (json.dumps(ret) + "\0").encode("utf-8")
-            if seq_group.is_finished():
+                ret = {
+                    "text": output,
+                    "error_code": 0,
+                    "index": i,
+                }
+                if finished:
+                    ret["finish_reason"] = "stop"
+                    ret["usage"] = get_usage(
+                        len(input_ids),
+                        len(token_ids) - len(input_ids),
+                        arrival_time,
+                        first_token_time,
+                        True,
+                    )
+                    self.metrics.usage.observe(ret["usage"])
+                yield (json.dumps(ret) + "\0").encode("utf-8")
+            if finished:
+                self.metrics.requests.labels("finished").inc()
                 del self.running_seq_groups[group_id]
                 del self.sequence_group_events[group_id]
                 break
@@ -276,6 +292,11 @@ async def get_status(request: Request):
     return worker.get_status()
 
 
+@app.get("/metrics")
+async def get_metrics():
+    return metrics_response(worker.metrics.registry)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", type=str, default="localhost")
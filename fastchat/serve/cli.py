@@ -124,6 +124,10 @@ def main(args):
             args.max_new_tokens,
             chatio,
             args.debug,
+            args.load_4bit,
+            args.draft_model_path,
+            args.num_speculative_tokens,
+            args.tile_cache_gb,
         )
     except KeyboardInterrupt:
         print("exit...")
@@ -155,6 +159,16 @@ if __name__ == "__main__":
     parser.add_argument(
         "--load-8bit", action="store_true", help="Use 8-bit quantization."
     )
+    parser.add_argument(
+        "--load-4bit", action="store_true", help="Use 4-bit quantization."
+    )
+    parser.add_argument(
+        "--tile-cache-gb",
+        type=float,
+        default=0,
+        help="Memory budget in GiB for keeping dequantized weights of the "
+        "8-bit or 4-bit layers. 0 disables it.",
+    )
     parser.add_argument(
         "--conv-template", type=str, default=None, help="Conversation prompt template."
     )
@@ -167,6 +181,18 @@ if __name__ == "__main__":
         choices=["simple", "rich"],
         help="Display style.",
     )
+    parser.add_argument(
+        "--draft-model-path",
+        type=str,
+        default=None,
+        help="A small model with the same tokenizer for speculative decoding.",
+    )
+    parser.add_argument(
+        "--num-speculative-tokens",
+        type=int,
+        default=4,
+        help="The number of tokens the draft model proposes per step.",
+    )
     parser.add_argument("--debug", action="store_true")
     args = parser.parse_args()
     main(args)
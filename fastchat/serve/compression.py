@@ -1,10 +1,22 @@
 import dataclasses
+import json
+import os
 
+from safetensors.torch import save_file
 import torch
 from torch import Tensor
 import torch.nn as nn
 from torch.nn import functional as F
 
+from fastchat.serve.safetensors_loader import (
+    check_no_meta_tensors,
+    init_empty_model,
+    load_tensors,
+)
+
+COMPRESSION_CONFIG_NAME = "compression_config.json"
+COMPRESSED_WEIGHTS_NAME = "compressed_model.safetensors"
+
 
 @dataclasses.dataclass
 class CompressionConfig:
@@ -36,17 +48,201 @@ class CLinear(nn.Module):
         return F.linear(input, weight, self.bias)
 
 
-def compress_module(module, target_device):
+class TileCache:
+    """A cache of dequantized weight tiles with a memory budget in bytes.
+
+    Tiles are admitted until the budget is full and then kept. Decoding visits
+    every layer once per token, and for such a cyclic access pattern keeping a
+    fixed subset is better than LRU, which would evict every tile before reuse.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes_held = 0
+        self.tiles = {}
+
+    def get(self, key):
+        return self.tiles.get(key, None)
+
+    def put(self, key, tile):
+        nbytes = tile.numel() * tile.element_size()
+        if self.bytes_held + nbytes <= self.max_bytes:
+            self.tiles[key] = tile
+            self.bytes_held += nbytes
+
+
+class QLinear(nn.Module):
+    """Linear layer with packed int8 or int4 weights.
+
+    The weight is quantized group-wise along the input dimension. Int4 values
+    are packed two per byte. The forward pass dequantizes `block_size` output
+    rows at a time, so the full floating-point weight is never materialized.
+    """
+
+    def __init__(
+        self,
+        weight,
+        bias,
+        device,
+        num_bits=8,
+        group_size=256,
+        block_size=1024,
+        tile_cache=None,
+    ):
+        super().__init__()
+        assert num_bits in (4, 8)
+        self.out_features, self.in_features = weight.shape
+        self.num_bits = num_bits
+        self.group_size = group_size
+        self.block_size = block_size
+        self.tile_cache = tile_cache
+
+        qweight, scale = quantize_weight(weight.data.to(device), num_bits, group_size)
+        self.register_buffer("qweight", qweight)
+        self.register_buffer("scale", scale)
+        self.bias = bias
+
+    def dequantize(self, start, end, dtype):
+        """Dequantize the output rows [start, end) of the weight."""
+        qweight = self.qweight[start:end]
+        if self.num_bits == 4:
+            qweight = torch.stack([qweight & 0xF, qweight >> 4], dim=-1)
+            qweight = qweight.view(end - start, -1, self.group_size).to(dtype) - 8
+        else:
+            qweight = qweight.to(dtype)
+        weight = qweight * self.scale[start:end].to(dtype)
+        return weight.view(end - start, -1)[:, : self.in_features]
+
+    def get_tile(self, start, end, dtype):
+        if self.tile_cache is None:
+            return self.dequantize(start, end, dtype)
+        key = (id(self), start, dtype)
+        tile = self.tile_cache.get(key)
+        if tile is None:
+            tile = self.dequantize(start, end, dtype)
+            self.tile_cache.put(key, tile)
+        return tile
+
+    def forward(self, input: Tensor) -> Tensor:
+        if self.out_features <= self.block_size:
+            weight = self.get_tile(0, self.out_features, input.dtype)
+            return F.linear(input, weight, self.bias)
+
+        output = input.new_empty(input.shape[:-1] + (self.out_features,))
+        for start in range(0, self.out_features, self.block_size):
+            end = min(start + self.block_size, self.out_features)
+            weight = self.get_tile(start, end, input.dtype)
+            bias = None if self.bias is None else self.bias[start:end]
+            output[..., start:end] = F.linear(input, weight, bias)
+        return output
+
+
+def quantize_weight(weight, num_bits, group_size):
+    """Symmetric group-wise quantization of a [out, in] weight.
+
+    Returns the int8 data (or uint8 with two int4 values per byte) of shape
+    [out, num_groups, group_size] (or group_size // 2) and the scales of shape
+    [out, num_groups, 1].
+    """
+    out_features, in_features = weight.shape
+    pad_len = (group_size - in_features % group_size) % group_size
+    if pad_len:
+        weight = F.pad(weight, (0, pad_len))
+    data = weight.view(out_features, -1, group_size).float()
+
+    B = 2 ** (num_bits - 1) - 1
+    scale = data.abs().amax(dim=-1, keepdim=True) / B
+    data = (data / scale.clamp(min=1e-8)).round_().clamp_(-B, B)
+    scale = scale.to(weight.dtype)
+
+    if num_bits == 4:
+        data = (data + 8).to(torch.uint8)
+        return data[..., 0::2] | (data[..., 1::2] << 4), scale
+    return data.to(torch.int8), scale
+
+
+def enable_tile_cache(model, max_bytes):
+    """Share a `TileCache` of `max_bytes` among all `QLinear` layers of `model`.
+
+    The tiles of the layers run first are kept, so a budget smaller than the
+    dequantized model speeds up a prefix of the layers.
+    """
+    tile_cache = TileCache(max_bytes)
+    for module in model.modules():
+        if isinstance(module, QLinear):
+            module.tile_cache = tile_cache
+    return tile_cache
+
+
+def compress_module(module, target_device, num_bits=8, tile_cache=None, group_size=256):
     for attr_str in dir(module):
         target_attr = getattr(module, attr_str)
         if type(target_attr) == torch.nn.Linear:
             setattr(
                 module,
                 attr_str,
-                CLinear(target_attr.weight, target_attr.bias, target_device),
+                QLinear(
+                    target_attr.weight,
+                    target_attr.bias,
+                    target_device,
+                    num_bits=num_bits,
+                    group_size=group_size,
+                    tile_cache=tile_cache,
+                ),
             )
     for name, child in module.named_children():
-        compress_module(child, target_device)
+        compress_module(child, target_device, num_bits, tile_cache, group_size)
+
+
+def save_compressed_model(model, out_path, num_bits=8, group_size=256):
+    """Quantize a model in place and save the packed weights and scales."""
+    compress_module(model, "cpu", num_bits, group_size=group_size)
+
+    os.makedirs(out_path, exist_ok=True)
+    model.config.save_pretrained(out_path)
+    state_dict = {k: v.contiguous() for k, v in model.state_dict().items()}
+    save_file(state_dict, os.path.join(out_path, COMPRESSED_WEIGHTS_NAME))
+    with open(os.path.join(out_path, COMPRESSION_CONFIG_NAME), "w") as fout:
+        compression_config = {
+            "num_bits": num_bits,
+            "group_size": group_size,
+            "torch_dtype": str(model.dtype).split(".")[-1],
+        }
+        json.dump(compression_config, fout, indent=2)
+
+
+def is_compressed_checkpoint(model_path):
+    return os.path.exists(os.path.join(model_path, COMPRESSION_CONFIG_NAME))
+
+
+def load_compressed_model(model_path, device):
+    """Load a checkpoint written by `save_compressed_model`.
+
+    The model is built on the meta device and every tensor is read from the
+    memory-mapped file straight to its target device, so the peak host memory
+    stays close to the size of the compressed weights.
+    """
+    with open(os.path.join(model_path, COMPRESSION_CONFIG_NAME)) as fin:
+        compression_config = json.load(fin)
+    if device == "cpu":
+        dtype = torch.float32
+    else:
+        dtype = getattr(torch, compression_config["torch_dtype"])
+
+    model = init_empty_model(model_path, dtype)
+    compress_module(
+        model,
+        "meta",
+        compression_config["num_bits"],
+        group_size=compression_config["group_size"],
+    )
+    load_tensors(
+        model, [os.path.join(model_path, COMPRESSED_WEIGHTS_NAME)], device, dtype
+    )
+    check_no_meta_tensors(model, model_path)
+    # `from_config` builds the model in training mode, with dropout on.
+    model.eval()
+    return model
 
 
 def compress(tensor, config):
@@ -0,0 +1,456 @@
+"""
+Iteration-level (continuous) batching for decoder-only models.
+
+A single scheduler thread owns the model. At every decoding step it merges all
+active requests into one left-padded batch. New requests are prefilled and
+join at the next step, and finished requests leave the batch without waiting
+for the others.
+
+Sampled tokens stay on the device and are fed to the next step directly. They
+are copied to the host every `stream_interval` steps, and before the batch
+changes, to check the stop conditions and stream the outputs.
+"""
+import dataclasses
+import inspect
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import torch
+from torch.nn import functional as F
+
+from fastchat.protocol.worker_stream import get_usage
+from fastchat.serve.inference import decode_incrementally, partial_stop_length
+from fastchat.serve.sampling import Sampler, SamplingParams
+
+
+@dataclasses.dataclass
+class BatchRequest:
+    params: Dict[str, Any]
+    # Output chunks, followed by None when the request is finished. The `n`
+    # samples of one prompt share this queue.
+    outputs: queue.Queue = dataclasses.field(default_factory=queue.Queue)
+    index: int = 0
+    # Set when the client is gone. The samples of one prompt share it.
+    abort_event: threading.Event = dataclasses.field(default_factory=threading.Event)
+    # The (truncated) prompt fed to the model and all prompt + output ids.
+    input_ids: List[int] = dataclasses.field(default_factory=list)
+    output_ids: List[int] = dataclasses.field(default_factory=list)
+    max_new_tokens: int = 256
+    stop_str: Optional[str] = None
+    stop_token_ids: List[int] = dataclasses.field(default_factory=list)
+    echo: bool = True
+    start_time: float = dataclasses.field(default_factory=time.time)
+    first_token_time: float = 0.0
+    num_generated: int = 0
+    prompt_output: str = ""
+    generated_output: str = ""
+    prefix_offset: int = 0
+    read_offset: int = 0
+
+
+def left_pad_past_key_values(past_key_values, pad_len):
+    """Left-pad every key/value tensor of shape [batch, heads, seq, dim]."""
+    return tuple(
+        tuple(F.pad(t, (0, 0, pad_len, 0)) for t in layer) for layer in past_key_values
+    )
+
+
+class ContinuousBatchingEngine:
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        device,
+        context_len=2048,
+        stream_interval=2,
+        max_batch_size=8,
+        prefix_cache=None,
+        session_cache=None,
+    ):
+        if model.config.is_encoder_decoder:
+            raise ValueError("Continuous batching only supports decoder-only models.")
+
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.context_len = context_len
+        self.stream_interval = stream_interval
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.session_cache = session_cache
+        # Models like LLaMA cannot infer positions from a padded attention mask.
+        self.accepts_position_ids = (
+            "position_ids" in inspect.signature(model.forward).parameters
+        )
+
+        self.pending = queue.Queue()
+        # Active requests, aligned with the rows of the batched kv cache.
+        self.requests = []
+        self.past_key_values = None
+        self.attention_mask = None
+        self.sampler = None
+        # The last sampled token of each row on the device, [batch]
+        self.next_tokens = None
+        # Sampled tokens of each step since the last host sync
+        self.pending_tokens = []
+
+        self.loop_thread = threading.Thread(target=self.loop, daemon=True)
+        self.loop_thread.start()
+
+    def generate_stream(self, params, abort_event=None):
+        """Submit a request and yield its outputs like `generate_stream`.
+
+        The request leaves the batch before the next decoding step once
+        `abort_event` is set or this generator is closed early.
+        """
+        n = int(params.get("n", 1))
+        if n > 1:
+            # The samples do not continue a single conversation.
+            params = dict(params, conv_id=None)
+        if abort_event is None:
+            abort_event = threading.Event()
+        outputs = queue.Queue()
+        self.pending.put(
+            [BatchRequest(params, outputs, i, abort_event) for i in range(n)]
+        )
+        num_finished = 0
+        try:
+            while num_finished < n:
+                output = outputs.get()
+                if output is None:
+                    num_finished += 1
+                    continue
+                if isinstance(output, Exception):
+                    raise output
+                yield output
+        finally:
+            abort_event.set()
+
+    def loop(self):
+        while True:
+            # An error may leave the batch half updated, so it fails all its
+            # requests, and the loop goes on with the next ones.
+            try:
+                self.run_iteration()
+            except Exception as e:
+                self.abort_all(e)
+
+    def run_iteration(self):
+        # Block while idle so that the loop does not spin.
+        if not self.requests:
+            self.add_pending(self.pending.get())
+        while len(self.requests) < self.max_batch_size:
+            try:
+                requests = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            self.add_pending(requests)
+
+        self.drop_aborted()
+        if self.requests:
+            self.step()
+
+    def add_pending(self, requests: List[BatchRequest]):
+        try:
+            self.add_requests(requests)
+        except Exception as e:
+            # The samples share the output queue of the request.
+            requests[0].outputs.put(e)
+            raise
+
+    @torch.inference_mode()
+    def add_requests(self, requests: List[BatchRequest]):
+        """Prefill the prompt of the `n` samples of a request once."""
+        request = requests[0]
+        if request.abort_event.is_set():
+            for _ in requests:
+                request.outputs.put(None)
+            return
+        # Rows only change after the pending tokens are processed.
+        self.flush()
+        try:
+            params = request.params
+            max_new_tokens = int(params.get("max_new_tokens", 256))
+            request.stop_str = params.get("stop", None)
+            request.stop_token_ids = params.get(
+                "stop_ids", [self.tokenizer.eos_token_id]
+            )
+            request.echo = params.get("echo", True)
+
+            input_ids = self.tokenizer(params["prompt"]).input_ids
+            request.output_ids = list(input_ids)
+            request.prompt_output = self.tokenizer.decode(
+                input_ids, skip_special_tokens=True
+            )
+            request.prefix_offset = max(len(input_ids) - 5, 0)
+            request.read_offset = len(input_ids)
+
+            max_src_len = self.context_len - max_new_tokens - 8
+            input_ids = input_ids[-max_src_len:]
+            request.input_ids = input_ids
+            request.max_new_tokens = min(
+                max_new_tokens, self.context_len - len(input_ids) - 8
+            )
+
+            conv_id = params.get("conv_id", None)
+            prefix_len, past_key_values = 0, None
+            if self.session_cache is not None and conv_id:
+                prefix_len, past_key_values = self.session_cache.lookup(
+                    conv_id, input_ids
+                )
+            if prefix_len == 0 and self.prefix_cache is not None:
+                prefix_len, past_key_values = self.prefix_cache.lookup(input_ids)
+            out = self.model(
+                torch.as_tensor([input_ids[prefix_len:]], device=self.device),
+                use_cache=True,
+                past_key_values=past_key_values,
+            )
+            if self.prefix_cache is not None:
+                self.prefix_cache.insert(input_ids, out.past_key_values)
+
+            for sample in requests[1:]:
+                sample.stop_str = request.stop_str
+                sample.stop_token_ids = request.stop_token_ids
+                sample.echo = request.echo
+                sample.output_ids = list(request.output_ids)
+                sample.prompt_output = request.prompt_output
+                sample.prefix_offset = request.prefix_offset
+                sample.read_offset = request.read_offset
+                sample.input_ids = request.input_ids
+                sample.max_new_tokens = request.max_new_tokens
+            logits = out.logits[:, -1, :].expand(len(requests), -1)
+            if self.device == "mps":
+                # Switch to CPU by avoiding some bugs in mps backend.
+                logits = logits.float().to("cpu")
+            sampler = Sampler.create(
+                [SamplingParams.from_dict(params)] * len(requests),
+                [input_ids] * len(requests),
+                logits.shape[-1],
+                logits.device,
+            )
+            tokens = sampler(logits)
+            # Stream the first tokens at once.
+            token_list = tokens.tolist()
+        except Exception as e:
+            request.outputs.put(e)
+            return
+
+        for row, (sample, token) in enumerate(zip(requests, token_list)):
+            if not self.process_tokens(sample, [token]):
+                self.join_batch(
+                    sample,
+                    out.past_key_values,
+                    sampler.index_select([row]),
+                    tokens[row : row + 1],
+                )
+            elif self.session_cache is not None and conv_id:
+                self.session_cache.insert(conv_id, input_ids, out.past_key_values)
+
+    @torch.inference_mode()
+    def step(self):
+        batch_size = len(self.requests)
+        input_ids = self.next_tokens.unsqueeze(1).to(self.device)
+        attention_mask = torch.cat(
+            [
+                self.attention_mask,
+                self.attention_mask.new_ones((batch_size, 1)),
+            ],
+            dim=1,
+        )
+        kwargs = {}
+        if self.accepts_position_ids:
+            kwargs["position_ids"] = self.attention_mask.sum(dim=1, keepdim=True)
+
+        out = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            past_key_values=self.past_key_values,
+            use_cache=True,
+            **kwargs,
+        )
+        self.past_key_values = out.past_key_values
+        self.attention_mask = attention_mask
+
+        logits = out.logits[:, -1, :]
+        if self.device == "mps":
+            # Switch to CPU by avoiding some bugs in mps backend.
+            logits = logits.float().to("cpu")
+        self.next_tokens = self.sampler(logits)
+        self.pending_tokens.append(self.next_tokens)
+
+        num_pending = len(self.pending_tokens)
+        if num_pending >= self.stream_interval or any(
+            r.num_generated + num_pending >= r.max_new_tokens for r in self.requests
+        ):
+            self.flush()
+
+    def flush(self):
+        """Copy the pending tokens to the host and process them."""
+        if not self.pending_tokens:
+            return
+        # One device-to-host copy for the whole batch and interval
+        rows = torch.stack(self.pending_tokens, dim=1).tolist()
+        self.pending_tokens = []
+        finished = [
+            i
+            for i, (request, token_ids) in enumerate(zip(self.requests, rows))
+            if self.process_tokens(request, token_ids)
+        ]
+        if finished:
+            self.leave_batch(finished)
+
+    def process_tokens(self, request: BatchRequest, token_ids: List[int]):
+        """Append new tokens, stream the output and return whether done."""
+        if request.num_generated == 0:
+            request.first_token_time = time.time()
+        stopped = False
+        for token in token_ids:
+            request.output_ids.append(token)
+            request.num_generated += 1
+            if token in request.stop_token_ids:
+                # Tokens sampled after the stop token are dropped.
+                stopped = True
+                break
+
+        new_text, prefix_offset, read_offset = decode_incrementally(
+            self.tokenizer,
+            request.output_ids,
+            request.prefix_offset,
+            request.read_offset,
+            stopped or request.num_generated >= request.max_new_tokens,
+        )
+        request.prefix_offset, request.read_offset = prefix_offset, read_offset
+        if new_text:
+            stop_str = request.stop_str
+            search_start = max(
+                len(request.generated_output) - len(stop_str or "") + 1, 0
+            )
+            request.generated_output += new_text
+            if stop_str:
+                pos = request.generated_output.find(stop_str, search_start)
+                if pos != -1:
+                    request.generated_output = request.generated_output[:pos]
+                    stopped = True
+
+        done = stopped or request.num_generated >= request.max_new_tokens
+        if done or not partial_stop_length(request.generated_output, request.stop_str):
+            self.put_output(request, "stop" if stopped else "length", done)
+
+        if done:
+            request.outputs.put(None)
+        return done
+
+    def put_output(self, request: BatchRequest, finish_reason, done):
+        if request.echo:
+            text = request.prompt_output + request.generated_output
+        else:
+            text = request.generated_output
+        request.outputs.put(
+            {
+                "text": text,
+                "usage": get_usage(
+                    len(request.input_ids),
+                    request.num_generated,
+                    request.start_time,
+                    request.first_token_time,
+                    done,
+                ),
+                "finish_reason": finish_reason if done else None,
+                "index": request.index,
+            }
+        )
+
+    def join_batch(self, request: BatchRequest, past_key_values, sampler, token):
+        past_len = past_key_values[0][0].shape[2]
+        mask = torch.ones((1, past_len), dtype=torch.long, device=self.device)
+
+        if self.past_key_values is None:
+            self.past_key_values = past_key_values
+            self.attention_mask = mask
+            self.sampler = sampler
+            self.next_tokens = token
+        else:
+            diff = self.attention_mask.shape[1] - past_len
+            if diff > 0:
+                past_key_values = left_pad_past_key_values(past_key_values, diff)
+                mask = F.pad(mask, (diff, 0))
+            elif diff < 0:
+                self.past_key_values = left_pad_past_key_values(
+                    self.past_key_values, -diff
+                )
+                self.attention_mask = F.pad(self.attention_mask, (-diff, 0))
+            self.past_key_values = tuple(
+                tuple(torch.cat([a, b], dim=0) for a, b in zip(layer_a, layer_b))
+                for layer_a, layer_b in zip(self.past_key_values, past_key_values)
+            )
+            self.attention_mask = torch.cat([self.attention_mask, mask], dim=0)
+            self.sampler = Sampler.cat([self.sampler, sampler])
+            self.next_tokens = torch.cat([self.next_tokens, token])
+        self.requests.append(request)
+
+    def drop_aborted(self):
+        if not any(r.abort_event.is_set() for r in self.requests):
+            return
+        self.flush()
+        aborted = [i for i, r in enumerate(self.requests) if r.abort_event.is_set()]
+        if aborted:
+            for i in aborted:
+                self.requests[i].outputs.put(None)
+            self.leave_batch(aborted, save_session=False)
+
+    def leave_batch(self, finished, save_session=True):
+        if self.session_cache is not None and save_session:
+            for i in finished:
+                self.save_session(i)
+
+        keep = [i for i in range(len(self.requests)) if i not in set(finished)]
+        if not keep:
+            self.reset_batch()
+            return
+
+        index = torch.as_tensor(keep, device=self.device)
+        attention_mask = self.attention_mask.index_select(0, index)
+        # Drop the leading columns that are padding for every remaining row.
+        num_pad = int(torch.argmax(attention_mask.any(dim=0).int()))
+        self.past_key_values = tuple(
+            tuple(t.index_select(0, index)[:, :, num_pad:] for t in layer)
+            for layer in self.past_key_values
+        )
+        self.attention_mask = attention_mask[:, num_pad:]
+        self.requests = [self.requests[i] for i in keep]
+        self.sampler = self.sampler.index_select(keep)
+        self.next_tokens = self.next_tokens.index_select(
+            0, index.to(self.next_tokens.device)
+        )
+
+    def save_session(self, i):
+        """Store the kv of row `i` for the next turn of its conversation."""
+        request = self.requests[i]
+        conv_id = request.params.get("conv_id", None)
+        if not conv_id:
+            return
+
+        num_pad = int(torch.argmax(self.attention_mask[i]))
+        # Clone so that the cache does not keep the whole batch alive.
+        past_key_values = tuple(
+            tuple(t[i : i + 1, :, num_pad:].clone() for t in layer)
+            for layer in self.past_key_values
+        )
+        prompt_len = len(request.output_ids) - request.num_generated
+        session_ids = request.input_ids + request.output_ids[prompt_len:]
+        self.session_cache.insert(conv_id, session_ids, past_key_values)
+
+    def reset_batch(self):
+        self.requests = []
+        self.past_key_values = None
+        self.attention_mask = None
+        self.sampler = None
+        self.next_tokens = None
+        self.pending_tokens = []
+
+    def abort_all(self, e: Exception):
+        for request in self.requests:
+            request.outputs.put(e)
+        self.reset_batch()
@@ -4,21 +4,25 @@ It sends worker addresses to clients.
 """
 import argparse
 import asyncio
+import bisect
 import dataclasses
 from enum import Enum, auto
+import heapq
+import itertools
 import json
 import logging
+import random
 import time
 from typing import List, Union
 import threading
 
 from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
-import numpy as np
-import requests
+import httpx
 import uvicorn
 
-from fastchat.constants import CONTROLLER_HEART_BEAT_EXPIRATION
+from fastchat.constants import CONTROLLER_HEART_BEAT_EXPIRATION, SESSION_EXPIRATION
+from fastchat.serve.metrics import ControllerMetrics, metrics_response
 from fastchat.utils import build_logger, server_error_msg
 
 
@@ -28,6 +32,7 @@ logger = build_logger("controller", "controller.log")
 class DispatchMethod(Enum):
     LOTTERY = auto()
     SHORTEST_QUEUE = auto()
+    SHORTEST_COMPLETION_TIME = auto()
 
     @classmethod
     def from_str(cls, name):
@@ -35,6 +40,8 @@ class DispatchMethod(Enum):
             return cls.LOTTERY
         elif name == "shortest_queue":
             return cls.SHORTEST_QUEUE
+        elif name == "shortest_completion_time":
+            return cls.SHORTEST_COMPLETION_TIME
         else:
             raise ValueError(f"Invalid dispatch method")
 
@@ -42,10 +49,12 @@ class DispatchMethod(Enum):
 @dataclasses.dataclass
 class WorkerInfo:
     model_names: List[str]
-    speed: int
+    speed: float
     queue_length: int
     check_heart_beat: bool
     last_heart_beat: str
+    # Seconds to the first token, measured by the worker.
+    ttft: float = 0.0
 
 
 def heart_beat_controller(controller):
@@ -58,16 +67,37 @@ class Controller:
     def __init__(self, dispatch_method: str):
         # Dict[str -> WorkerInfo]
         self.worker_info = {}
+        # Dict[str -> Set[str]]. The workers serving each model.
+        self.model_workers = {}
+        # Dict[str -> (List[str], List[float])]. Worker names and cumulative
+        # speeds for lottery dispatch, rebuilt lazily after a worker changes.
+        self.lottery_tables = {}
+        # Dict[str -> List[(float, str)]]. A min-heap of (queue_length / speed,
+        # worker_name) per model. Outdated entries are dropped lazily.
+        self.queue_heaps = {}
+        # Incremented whenever the set of workers of a model changes, so that
+        # clients caching the worker addresses can tell when to refresh them.
+        self.registry_version = 0
+        # The registry is updated by both request handlers and the heart beat thread.
+        self.lock = threading.RLock()
+        # Dict[str -> (worker_name, last_access)]. A conversation is routed back
+        # to the worker that keeps the kv cache of its last turn.
+        self.session_workers = {}
         self.dispatch_method = DispatchMethod.from_str(dispatch_method)
+        self.metrics = ControllerMetrics(self.get_worker_queue_lengths)
+        # A shared client keeps a pool of keep-alive connections to each worker.
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=1024)
+        )
 
         self.heart_beat_thread = threading.Thread(
-            target=heart_beat_controller, args=(self,)
+            target=heart_beat_controller, args=(self,), daemon=True
         )
         self.heart_beat_thread.start()
 
         logger.info("Init controller")
 
-    def register_worker(
+    async def register_worker(
         self, worker_name: str, check_heart_beat: bool, worker_status: dict
     ):
         if worker_name not in self.worker_info:
@@ -76,25 +106,31 @@ class Controller:
             logger.info(f"Register an existing worker: {worker_name}")
 
         if not worker_status:
-            worker_status = self.get_worker_status(worker_name)
+            worker_status = await self.get_worker_status(worker_name)
         if not worker_status:
             return False
 
-        self.worker_info[worker_name] = WorkerInfo(
+        w_info = WorkerInfo(
             worker_status["model_names"],
             worker_status["speed"],
             worker_status["queue_length"],
             check_heart_beat,
             time.time(),
+            worker_status.get("ttft", 0.0),
         )
+        with self.lock:
+            if worker_name in self.worker_info:
+                self.remove_from_index(worker_name, self.worker_info[worker_name])
+            self.worker_info[worker_name] = w_info
+            self.add_to_index(worker_name, w_info)
 
         logger.info(f"Register done: {worker_name}, {worker_status}")
         return True
 
-    def get_worker_status(self, worker_name: str):
+    async def get_worker_status(self, worker_name: str):
         try:
-            r = requests.post(worker_name + "/worker_get_status", timeout=5)
-        except requests.exceptions.RequestException as e:
+            r = await self.client.post(worker_name + "/worker_get_status", timeout=5)
+        except httpx.HTTPError as e:
             logger.error(f"Get status fails: {worker_name}, {e}")
             return None
 
@@ -105,99 +141,219 @@ class Controller:
         return r.json()
 
     def remove_worker(self, worker_name: str):
-        del self.worker_info[worker_name]
-
-    def refresh_all_workers(self):
+        with self.lock:
+            self.remove_from_index(worker_name, self.worker_info.pop(worker_name))
+
+    def add_to_index(self, worker_name: str, w_info: WorkerInfo):
+        for model_name in w_info.model_names:
+            workers = self.model_workers.setdefault(model_name, set())
+            if worker_name not in workers:
+                workers.add(worker_name)
+                self.registry_version += 1
+            self.lottery_tables.pop(model_name, None)
+        self.push_queue_length(worker_name, w_info)
+
+    def remove_from_index(self, worker_name: str, w_info: WorkerInfo):
+        for model_name in w_info.model_names:
+            workers = self.model_workers.get(model_name, set())
+            if worker_name in workers:
+                workers.discard(worker_name)
+                self.registry_version += 1
+            if not workers:
+                self.model_workers.pop(model_name, None)
+                self.queue_heaps.pop(model_name, None)
+            self.lottery_tables.pop(model_name, None)
+
+    def push_queue_length(self, worker_name: str, w_info: WorkerInfo):
+        # A worker without a positive speed is not dispatched to.
+        if self.dispatch_method != DispatchMethod.SHORTEST_QUEUE or w_info.speed <= 0:
+            return
+        key = w_info.queue_length / w_info.speed
+        for model_name in w_info.model_names:
+            heap = self.queue_heaps.setdefault(model_name, [])
+            heapq.heappush(heap, (key, worker_name))
+            # Compact the heap when outdated entries pile up.
+            if len(heap) > 2 * len(self.model_workers[model_name]) + 16:
+                heap = [
+                    (self.worker_info[w].queue_length / self.worker_info[w].speed, w)
+                    for w in self.model_workers[model_name]
+                    if self.worker_info[w].speed > 0
+                ]
+                heapq.heapify(heap)
+                self.queue_heaps[model_name] = heap
+
+    async def refresh_all_workers(self):
         old_info = dict(self.worker_info)
-        self.worker_info = {}
+        # Query all workers concurrently, each with its own timeout.
+        all_status = await asyncio.gather(
+            *[self.get_worker_status(w_name) for w_name in old_info]
+        )
 
-        for w_name, w_info in old_info.items():
-            if not self.register_worker(w_name, w_info.check_heart_beat, None):
+        with self.lock:
+            self.worker_info = {}
+            self.model_workers = {}
+            self.lottery_tables = {}
+            self.queue_heaps = {}
+        for (w_name, w_info), worker_status in zip(old_info.items(), all_status):
+            if not await self.register_worker(
+                w_name, w_info.check_heart_beat, worker_status
+            ):
                 logger.info(f"Remove stale worker: {w_name}")
 
     def list_models(self):
-        model_names = set()
-
-        for w_name, w_info in self.worker_info.items():
-            model_names.update(w_info.model_names)
-
-        return list(model_names)
-
-    def get_worker_address(self, model_name: str):
-        if self.dispatch_method == DispatchMethod.LOTTERY:
-            worker_names = []
-            worker_speeds = []
-            for w_name, w_info in self.worker_info.items():
-                if model_name in w_info.model_names:
-                    worker_names.append(w_name)
-                    worker_speeds.append(w_info.speed)
-            worker_speeds = np.array(worker_speeds, dtype=np.float32)
-            norm = np.sum(worker_speeds)
-            if norm < 1e-4:
-                return ""
-            worker_speeds = worker_speeds / norm
-            if True:  # Directly return address
-                pt = np.random.choice(np.arange(len(worker_names)), p=worker_speeds)
-                worker_name = worker_names[pt]
-                return worker_name
-
-            # Check status before returning
-            while True:
-                pt = np.random.choice(np.arange(len(worker_names)), p=worker_speeds)
-                worker_name = worker_names[pt]
-
-                if self.get_worker_status(worker_name):
-                    break
-                else:
-                    self.remove_worker(worker_name)
-                    worker_speeds[pt] = 0
-                    norm = np.sum(worker_speeds)
-                    if norm < 1e-4:
-                        return ""
-                    worker_speeds = worker_speeds / norm
-                    continue
-            return worker_name
-        elif self.dispatch_method == DispatchMethod.SHORTEST_QUEUE:
-            worker_names = []
-            worker_qlen = []
-            for w_name, w_info in self.worker_info.items():
-                if model_name in w_info.model_names:
-                    worker_names.append(w_name)
-                    worker_qlen.append(w_info.queue_length / w_info.speed)
-            if len(worker_names) == 0:
-                return ""
-            min_index = np.argmin(worker_qlen)
-            w_name = worker_names[min_index]
-            self.worker_info[w_name].queue_length += 1
-            logger.info(
-                f"names: {worker_names}, queue_lens: {worker_qlen}, ret: {w_name}"
-            )
-            return w_name
-        else:
-            raise ValueError(f"Invalid dispatch method: {self.dispatch_method}")
+        return list(self.model_workers)
 
-    def receive_heart_beat(self, worker_name: str, queue_length: int):
-        if worker_name not in self.worker_info:
-            logger.info(f"Receive unknown heart beat. {worker_name}")
-            return False
+    def list_workers(self, model_name: str):
+        """Return the addresses and speeds of the workers serving a model."""
+        with self.lock:
+            worker_names = list(self.model_workers.get(model_name, ()))
+            speeds = [self.worker_info[w].speed for w in worker_names]
+            return worker_names, speeds, self.registry_version
 
-        self.worker_info[worker_name].queue_length = queue_length
-        self.worker_info[worker_name].last_heart_beat = time.time()
+    def get_worker_address(
+        self, model_name: str, session_id: str = None, max_new_tokens: int = None
+    ):
+        worker_name = ""
+        if session_id:
+            worker_name = self.get_session_worker(model_name, session_id)
+        if not worker_name:
+            worker_name = self.dispatch_worker(model_name, max_new_tokens)
+            if session_id and worker_name:
+                self.session_workers[session_id] = (worker_name, time.time())
+        self.metrics.dispatch.labels(model_name, worker_name).inc()
+        return worker_name
+
+    def get_worker_queue_lengths(self):
+        """Return (worker_name, model_name, queue_length) of every worker."""
+        with self.lock:
+            return [
+                (w_name, model_name, w_info.queue_length)
+                for w_name, w_info in self.worker_info.items()
+                for model_name in w_info.model_names
+            ]
+
+    def get_session_worker(self, model_name: str, session_id: str):
+        if session_id not in self.session_workers:
+            return ""
+        worker_name = self.session_workers[session_id][0]
+        w_info = self.worker_info.get(worker_name, None)
+        if w_info is None or model_name not in w_info.model_names:
+            self.session_workers.pop(session_id, None)
+            return ""
+        self.session_workers[session_id] = (worker_name, time.time())
+        return worker_name
+
+    def dispatch_worker(self, model_name: str, max_new_tokens: int = None):
+        with self.lock:
+            if self.dispatch_method == DispatchMethod.LOTTERY:
+                return self.dispatch_lottery(model_name)
+            elif self.dispatch_method == DispatchMethod.SHORTEST_QUEUE:
+                return self.dispatch_shortest_queue(model_name)
+            elif self.dispatch_method == DispatchMethod.SHORTEST_COMPLETION_TIME:
+                return self.dispatch_shortest_completion_time(
+                    model_name, max_new_tokens or 256
+                )
+            else:
+                raise ValueError(f"Invalid dispatch method: {self.dispatch_method}")
+
+    def dispatch_lottery(self, model_name: str):
+        if model_name not in self.lottery_tables:
+            worker_names = list(self.model_workers.get(model_name, ()))
+            cum_speeds = list(
+                itertools.accumulate(self.worker_info[w].speed for w in worker_names)
+            )
+            self.lottery_tables[model_name] = (worker_names, cum_speeds)
+
+        worker_names, cum_speeds = self.lottery_tables[model_name]
+        if not worker_names or cum_speeds[-1] < 1e-4:
+            return ""
+        pt = bisect.bisect_right(cum_speeds, random.random() * cum_speeds[-1])
+        return worker_names[min(pt, len(worker_names) - 1)]
+
+    def dispatch_shortest_queue(self, model_name: str):
+        heap = self.queue_heaps.get(model_name, [])
+        while heap:
+            key, w_name = heapq.heappop(heap)
+            w_info = self.worker_info.get(w_name, None)
+            if (
+                w_info is not None
+                and model_name in w_info.model_names
+                and w_info.speed > 0
+                and key == w_info.queue_length / w_info.speed
+            ):
+                w_info.queue_length += 1
+                self.push_queue_length(w_name, w_info)
+                return w_name
+        return ""
+
+    def dispatch_shortest_completion_time(self, model_name: str, max_new_tokens: int):
+        # Every queued request is assumed to generate `max_new_tokens` tokens.
+        best_time, best_name = None, ""
+        for w_name in self.model_workers.get(model_name, ()):
+            w_info = self.worker_info[w_name]
+            if w_info.speed <= 0:
+                continue
+            completion_time = (
+                w_info.ttft + (w_info.queue_length + 1) * max_new_tokens / w_info.speed
+            )
+            if best_time is None or completion_time < best_time:
+                best_time, best_name = completion_time, w_name
+
+        if best_name:
+            self.worker_info[best_name].queue_length += 1
+        return best_name
+
+    def receive_heart_beat(
+        self,
+        worker_name: str,
+        queue_length: int,
+        speed: float = None,
+        ttft: float = None,
+    ):
+        with self.lock:
+            w_info = self.worker_info.get(worker_name, None)
+            if w_info is None:
+                logger.info(f"Receive unknown heart beat. {worker_name}")
+                return False
+
+            w_info.queue_length = queue_length
+            w_info.last_heart_beat = time.time()
+            if speed is not None and speed != w_info.speed:
+                w_info.speed = speed
+                for model_name in w_info.model_names:
+                    self.lottery_tables.pop(model_name, None)
+            if ttft is not None:
+                w_info.ttft = ttft
+            self.push_queue_length(worker_name, w_info)
+        self.metrics.heart_beats.inc()
         logger.info(f"Receive heart beat. {worker_name}")
         return True
 
     def remove_stable_workers_by_expiration(self):
         expire = time.time() - CONTROLLER_HEART_BEAT_EXPIRATION
-        to_delete = []
-        for worker_name, w_info in self.worker_info.items():
-            if w_info.check_heart_beat and w_info.last_heart_beat < expire:
-                to_delete.append(worker_name)
-
-        for worker_name in to_delete:
-            self.remove_worker(worker_name)
-
-    def worker_api_generate_stream(self, params):
-        worker_addr = self.get_worker_address(params["model"])
+        with self.lock:
+            to_delete = []
+            for worker_name, w_info in self.worker_info.items():
+                if w_info.check_heart_beat and w_info.last_heart_beat < expire:
+                    to_delete.append(worker_name)
+
+            for worker_name in to_delete:
+                self.remove_worker(worker_name)
+
+        expire = time.time() - SESSION_EXPIRATION
+        for session_id, (worker_name, last_access) in list(
+            self.session_workers.items()
+        ):
+            if last_access < expire or worker_name not in self.worker_info:
+                self.session_workers.pop(session_id, None)
+
+    async def worker_api_generate_stream(self, params):
+        self.metrics.requests.labels(params["model"]).inc()
+        worker_addr = self.get_worker_address(
+            params["model"],
+            params.get("conv_id", None),
+            params.get("max_new_tokens", None),
+        )
         if not worker_addr:
             logger.info(f"no worker: {params['model']}")
             ret = {
@@ -205,18 +361,27 @@ class Controller:
                 "error_code": 2,
             }
             yield json.dumps(ret).encode() + b"\0"
+            return
 
+        # If the client disconnects, Starlette cancels this generator and
+        # leaving the `async with` block closes the connection to the worker,
+        # which then aborts the generation.
         try:
-            response = requests.post(
+            async with self.client.stream(
+                "POST",
                 worker_addr + "/worker_generate_stream",
                 json=params,
-                stream=True,
                 timeout=15,
-            )
-            for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
-                if chunk:
-                    yield chunk + b"\0"
-        except requests.exceptions.RequestException as e:
+            ) as response:
+                # Relay complete NUL-delimited chunks as soon as they arrive.
+                buffer = b""
+                async for data in response.aiter_bytes():
+                    buffer += data
+                    pos = buffer.rfind(b"\0")
+                    if pos != -1:
+                        yield buffer[: pos + 1]
+                        buffer = buffer[pos + 1 :]
+        except httpx.HTTPError as e:
             logger.info(f"worker timeout: {worker_addr}")
             ret = {
                 "text": server_error_msg,
@@ -226,13 +391,15 @@ class Controller:
 
     # Let the controller act as a worker to achieve hierarchical
     # management. This can be used to connect isolated sub networks.
-    def worker_api_get_status(self):
+    async def worker_api_get_status(self):
         model_names = set()
         speed = 0
         queue_length = 0
 
-        for w_name in self.worker_info:
-            worker_status = self.get_worker_status(w_name)
+        all_status = await asyncio.gather(
+            *[self.get_worker_status(w_name) for w_name in self.worker_info]
+        )
+        for worker_status in all_status:
             if worker_status is not None:
                 model_names.update(worker_status["model_names"])
                 speed += worker_status["speed"]
@@ -251,14 +418,14 @@ app = FastAPI()
 @app.post("/register_worker")
 async def register_worker(request: Request):
     data = await request.json()
-    controller.register_worker(
+    await controller.register_worker(
         data["worker_name"], data["check_heart_beat"], data.get("worker_status", None)
     )
 
 
 @app.post("/refresh_all_workers")
 async def refresh_all_workers():
-    models = controller.refresh_all_workers()
+    models = await controller.refresh_all_workers()
 
 
 @app.post("/list_models")
@@ -267,17 +434,36 @@ async def list_models():
     return {"models": models}
 
 
+@app.post("/list_workers")
+async def list_workers(request: Request):
+    data = await request.json()
+    addresses, speeds, registry_version = controller.list_workers(data["model"])
+    return {
+        "addresses": addresses,
+        "speeds": speeds,
+        "registry_version": registry_version,
+        "dispatch_method": controller.dispatch_method.name.lower(),
+    }
+
+
 @app.post("/get_worker_address")
 async def get_worker_address(request: Request):
     data = await request.json()
-    addr = controller.get_worker_address(data["model"])
+    addr = controller.get_worker_address(
+        data["model"], data.get("conv_id", None), data.get("max_new_tokens", None)
+    )
     return {"address": addr}
 
 
 @app.post("/receive_heart_beat")
 async def receive_heart_beat(request: Request):
     data = await request.json()
-    exist = controller.receive_heart_beat(data["worker_name"], data["queue_length"])
+    exist = controller.receive_heart_beat(
+        data["worker_name"],
+        data["queue_length"],
+        data.get("speed", None),
+        data.get("ttft", None),
+    )
     return {"exist": exist}
 
 
@@ -290,7 +476,17 @@ async def worker_api_generate_stream(request: Request):
 
 @app.post("/worker_get_status")
 async def worker_api_get_status(request: Request):
-    return controller.worker_api_get_status()
+    return await controller.worker_api_get_status()
+
+
+@app.get("/metrics")
+async def metrics():
+    return metrics_response(controller.metrics.registry)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await controller.client.aclose()
 
 
 if __name__ == "__main__":
@@ -300,7 +496,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "--dispatch-method",
         type=str,
-        choices=["lottery", "shortest_queue"],
+        choices=["lottery", "shortest_queue", "shortest_completion_time"],
         default="shortest_queue",
     )
     args = parser.parse_args()
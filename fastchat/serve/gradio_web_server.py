@@ -15,6 +15,7 @@ from fastchat.conversation import (
     SeparatorStyle,
 )
 from fastchat.constants import LOGDIR
+from fastchat.protocol.worker_stream import StreamDecoder, STREAM_VERSION
 from fastchat.utils import (
     build_logger,
     server_error_msg,
@@ -253,7 +254,12 @@ def http_bot(state, model_selector, temperature, max_new_tokens, request: gr.Req
 
     # Query worker address
     ret = requests.post(
-        controller_url + "/get_worker_address", json={"model": model_name}
+        controller_url + "/get_worker_address",
+        json={
+            "model": model_name,
+            "conv_id": state.conv_id,
+            "max_new_tokens": max_new_tokens,
+        },
     )
     worker_addr = ret.json()["address"]
     logger.info(f"model_name: {model_name}, worker_addr: {worker_addr}")
@@ -286,6 +292,9 @@ def http_bot(state, model_selector, temperature, max_new_tokens, request: gr.Req
         "temperature": temperature,
         "max_new_tokens": max_new_tokens,
         "stop": state.sep if state.sep_style == SeparatorStyle.SINGLE else None,
+        # Lets the worker reuse the kv cache of the previous turn.
+        "conv_id": state.conv_id,
+        "stream_version": STREAM_VERSION,
     }
     logger.info(f"==== request ====\n{pload}")
 
@@ -301,11 +310,12 @@ def http_bot(state, model_selector, temperature, max_new_tokens, request: gr.Req
             stream=True,
             timeout=20,
         )
+        decoder = StreamDecoder(skip_echo_len)
         for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
             if chunk:
-                data = json.loads(chunk.decode())
+                data = decoder.decode(chunk)
                 if data["error_code"] == 0:
-                    output = data["text"][skip_echo_len:].strip()
+                    output = data["text"].strip()
                     output = post_process_code(output)
                     state.messages[-1][-1] = output + "▌"
                     yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
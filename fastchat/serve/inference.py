@@ -1,5 +1,7 @@
 """Inference for FastChat models."""
 import abc
+import functools
+import time
 from typing import Optional
 import warnings
 
@@ -30,11 +32,26 @@ from fastchat.conversation import (
     compute_skip_echo_len,
     SeparatorStyle,
 )
-from fastchat.serve.compression import compress_module
+from fastchat.protocol.worker_stream import get_usage
+from fastchat.serve.compression import (
+    compress_module,
+    enable_tile_cache,
+    is_compressed_checkpoint,
+    load_compressed_model,
+)
 from fastchat.serve.monkey_patch_non_inplace import (
     replace_llama_attn_with_non_inplace_operations,
 )
+from fastchat.serve.safetensors_loader import (
+    get_peak_rss,
+    get_safetensors_files,
+    load_safetensors_model,
+)
+from fastchat.serve.sampling import Sampler, SamplingParams
 from fastchat.serve.serve_chatglm import chatglm_generate_stream
+from fastchat.serve.speculative import SpeculativeDecoder
+
+GB = 1 << 30
 
 
 def raise_warning_for_old_weights(model_path, model):
@@ -74,8 +91,16 @@ def get_gpu_memory(max_gpus=None):
 
 
 def load_model(
-    model_path, device, num_gpus, max_gpu_memory=None, load_8bit=False, debug=False
+    model_path,
+    device,
+    num_gpus,
+    max_gpu_memory=None,
+    load_8bit=False,
+    debug=False,
+    load_4bit=False,
+    tile_cache_gb=0,
 ):
+    tik = time.time()
     if device == "cpu":
         kwargs = {}
     elif device == "cuda":
@@ -105,7 +130,12 @@ def load_model(
     else:
         raise ValueError(f"Invalid device: {device}")
 
-    if "chatglm" in model_path:
+    if is_compressed_checkpoint(model_path):
+        # Pre-quantized with `fastchat.model.compress_model`.
+        tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False)
+        model = load_compressed_model(model_path, device)
+        load_8bit = load_4bit = False
+    elif "chatglm" in model_path:
         tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
         model = AutoModel.from_pretrained(
             model_path, trust_remote_code=True, **kwargs
@@ -117,25 +147,24 @@ def load_model(
         )
     elif "dolly" in model_path:
         tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
-        model = AutoModelForCausalLM.from_pretrained(
-            model_path, low_cpu_mem_usage=True, **kwargs
-        )
+        model = load_causal_lm(model_path, device, kwargs, load_8bit or load_4bit)
         # 50277 means "### End"
         tokenizer.eos_token_id = 50277
     elif "pythia" in model_path or "stablelm" in model_path:
         tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
-        model = AutoModelForCausalLM.from_pretrained(
-            model_path, low_cpu_mem_usage=True, **kwargs
-        )
+        model = load_causal_lm(model_path, device, kwargs, load_8bit or load_4bit)
     else:
         tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False)
-        model = AutoModelForCausalLM.from_pretrained(
-            model_path, low_cpu_mem_usage=True, **kwargs
-        )
+        model = load_causal_lm(model_path, device, kwargs, load_8bit or load_4bit)
         raise_warning_for_old_weights(model_path, model)
 
     if load_8bit:
         compress_module(model, device)
+    elif load_4bit:
+        compress_module(model, device, num_bits=4)
+    if tile_cache_gb > 0:
+        # Keep dequantized weights of the quantized layers within the budget.
+        enable_tile_cache(model, int(tile_cache_gb * GB))
 
     if (device == "cuda" and num_gpus == 1) or device == "mps":
         model.to(device)
@@ -143,29 +172,146 @@ def load_model(
     if debug:
         print(model)
 
+    print(
+        f"Loaded the model in {time.time() - tik:.1f} s, "
+        f"peak RSS: {get_peak_rss() / GB:.2f} GB"
+    )
     return model, tokenizer
 
 
+def load_causal_lm(model_path, device, kwargs, compress=False):
+    # When quantizing at startup, the memory-mapped pages of the full weights
+    # would stay resident. Use `fastchat.model.compress_model` instead.
+    mmap = not compress and "device_map" not in kwargs
+    if mmap and get_safetensors_files(model_path):
+        return load_safetensors_model(
+            model_path, device, kwargs.get("torch_dtype", torch.float32)
+        )
+    return AutoModelForCausalLM.from_pretrained(
+        model_path, low_cpu_mem_usage=True, **kwargs
+    )
+
+
+def decode_incrementally(
+    tokenizer, output_ids, prefix_offset, read_offset, final=False
+):
+    """Decode the tokens after `read_offset` using a short lookback window.
+
+    Only `output_ids[prefix_offset:]` is decoded, so the cost per call does not
+    grow with the length of the conversation. The lookback tokens are needed
+    because tokenizers like sentencepiece decode a token differently depending
+    on its left neighbour. Returns the newly finalized text and the updated
+    offsets. The text is always finalized when `final` is set, even if it ends
+    with an incomplete character.
+    """
+    prefix_text = tokenizer.decode(
+        output_ids[prefix_offset:read_offset], skip_special_tokens=True
+    )
+    new_text = tokenizer.decode(output_ids[prefix_offset:], skip_special_tokens=True)
+    if final or (len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd")):
+        # The last token is a complete character, so the text is final.
+        return new_text[len(prefix_text) :], read_offset, len(output_ids)
+    return "", prefix_offset, read_offset
+
+
+def partial_stop_length(output: str, stop_str: Optional[str]):
+    """Return the length of the longest suffix of `output` that starts `stop_str`."""
+    for i in range(min(len(stop_str or ""), len(output)), 0, -1):
+        if output.endswith(stop_str[:i]):
+            return i
+    return 0
+
+
 @torch.inference_mode()
 def generate_stream(
-    model, tokenizer, params, device, context_len=2048, stream_interval=2
+    model,
+    tokenizer,
+    params,
+    device,
+    context_len=2048,
+    stream_interval=2,
+    prefix_cache=None,
+    session_cache=None,
+    abort_event=None,
+    draft_model=None,
+    num_speculative_tokens=4,
 ):
+    """Yield the outputs of a request.
+
+    Generation stops before the next decoding step once `abort_event` is set,
+    e.g. when the client disconnects. With a `draft_model`, tokens are decoded
+    speculatively when the request allows it.
+    """
+    if int(params.get("n", 1)) > 1:
+        yield from generate_n_stream(
+            model,
+            tokenizer,
+            params,
+            device,
+            context_len,
+            stream_interval,
+            prefix_cache,
+            abort_event,
+        )
+        return
+    if (
+        draft_model is not None
+        and not model.config.is_encoder_decoder
+        and not SamplingParams.from_dict(params).has_penalties
+    ):
+        yield from generate_speculative_stream(
+            model,
+            draft_model,
+            tokenizer,
+            params,
+            device,
+            context_len,
+            stream_interval,
+            prefix_cache,
+            session_cache,
+            abort_event,
+            num_speculative_tokens,
+        )
+        return
+
+    start_time = time.time()
     prompt = params["prompt"]
-    l_prompt = len(prompt)
-    temperature = float(params.get("temperature", 1.0))
     max_new_tokens = int(params.get("max_new_tokens", 256))
     stop_str = params.get("stop", None)
     stop_token_ids = params.get("stop_ids", [tokenizer.eos_token_id])
+    conv_id = params.get("conv_id", None)
+    echo = params.get("echo", True)
 
     input_ids = tokenizer(prompt).input_ids
     output_ids = list(input_ids)
+    l_prompt_ids = len(output_ids)
+
+    # The prompt is decoded once. Generated tokens are decoded incrementally.
+    prompt_output = tokenizer.decode(output_ids, skip_special_tokens=True)
+    generated_output = ""
+    prefix_offset = max(len(output_ids) - 5, 0)
+    read_offset = len(output_ids)
 
     max_src_len = context_len - max_new_tokens - 8
     input_ids = input_ids[-max_src_len:]
 
-    max_new_tokens = context_len - len(input_ids) - 8
+    max_new_tokens = min(max_new_tokens, context_len - len(input_ids) - 8)
+    if max_new_tokens <= 0:
+        # Nothing may be generated, e.g., the prompt fills the context.
+        yield {
+            "text": prompt_output if echo else "",
+            "usage": get_usage(len(input_ids), 0, start_time, start_time, True),
+            "finish_reason": "length",
+        }
+        return
 
+    sampler = None
+    # Sampled tokens stay on the device and are copied to the host together
+    # every `stream_interval` steps, where the stop conditions are checked.
+    pending_tokens = []
     for i in range(max_new_tokens):
+        if abort_event is not None and abort_event.is_set():
+            return
         if i == 0:
             if model.config.is_encoder_decoder:
                 encoder_outputs = model.encoder(
@@ -183,59 +329,433 @@ def generate_stream(
                 logits = out.logits
                 past_key_values = out.past_key_values
             else:
-                out = model(torch.as_tensor([input_ids], device=device), use_cache=True)
+                prefix_len, past_key_values = 0, None
+                if session_cache is not None and conv_id:
+                    prefix_len, past_key_values = session_cache.lookup(
+                        conv_id, input_ids
+                    )
+                if prefix_len == 0 and prefix_cache is not None:
+                    prefix_len, past_key_values = prefix_cache.lookup(input_ids)
+                out = model(
+                    torch.as_tensor([input_ids[prefix_len:]], device=device),
+                    use_cache=True,
+                    past_key_values=past_key_values,
+                )
                 logits = out.logits
                 past_key_values = out.past_key_values
+                if prefix_cache is not None:
+                    prefix_cache.insert(input_ids, past_key_values)
         else:
             if model.config.is_encoder_decoder:
                 out = model(
                     input_ids=torch.as_tensor([input_ids], device=device),
                     use_cache=True,
                     encoder_outputs=encoder_outputs,
-                    decoder_input_ids=torch.as_tensor([[token]], device=device),
+                    decoder_input_ids=token.view(1, 1).to(device),
                     past_key_values=past_key_values,
                 )
                 logits = out.logits
                 past_key_values = out.past_key_values
             else:
                 out = model(
-                    input_ids=torch.as_tensor([[token]], device=device),
+                    input_ids=token.view(1, 1).to(device),
                     use_cache=True,
                     past_key_values=past_key_values,
                 )
                 logits = out.logits
                 past_key_values = out.past_key_values
 
-        last_token_logits = logits[0][-1]
+        last_token_logits = logits[:, -1, :]
 
         if device == "mps":
             # Switch to CPU by avoiding some bugs in mps backend.
             last_token_logits = last_token_logits.float().to("cpu")
 
-        if temperature < 1e-4:
-            token = int(torch.argmax(last_token_logits))
+        if sampler is None:
+            sampler = Sampler.create(
+                [SamplingParams.from_dict(params)],
+                [input_ids],
+                last_token_logits.shape[-1],
+                last_token_logits.device,
+            )
+        token = sampler(last_token_logits)
+        pending_tokens.append(token)
+        if i % stream_interval != 0 and i != max_new_tokens - 1:
+            continue
+
+        # The only host sync of the interval
+        new_tokens = torch.cat(pending_tokens).tolist()
+        pending_tokens = []
+        if i == 0:
+            first_token_time = time.time()
+        stopped = False
+        for token_id in new_tokens:
+            output_ids.append(token_id)
+            if token_id in stop_token_ids:
+                # Tokens sampled after the stop token are dropped.
+                stopped = True
+                break
+        num_generated = len(output_ids) - l_prompt_ids
+
+        new_text, prefix_offset, read_offset = decode_incrementally(
+            tokenizer,
+            output_ids,
+            prefix_offset,
+            read_offset,
+            stopped or i == max_new_tokens - 1,
+        )
+        if new_text:
+            # A stop string can only end inside the new text, so only the
+            # tail of the previous output needs to be searched again.
+            search_start = max(len(generated_output) - len(stop_str or "") + 1, 0)
+            generated_output += new_text
+            if stop_str:
+                pos = generated_output.find(stop_str, search_start)
+                if pos != -1:
+                    generated_output = generated_output[:pos]
+                    stopped = True
+
+        if stopped or i == max_new_tokens - 1:
+            finish_reason = "stop" if stopped else "length"
+        elif partial_stop_length(generated_output, stop_str):
+            # Hold back a partial stop string, so the text only grows.
+            continue
         else:
-            probs = torch.softmax(last_token_logits / temperature, dim=-1)
-            token = int(torch.multinomial(probs, num_samples=1))
+            finish_reason = None
+        yield {
+            "text": prompt_output + generated_output if echo else generated_output,
+            "usage": get_usage(
+                len(input_ids),
+                num_generated,
+                start_time,
+                first_token_time,
+                finish_reason is not None,
+            ),
+            "finish_reason": finish_reason,
+        }
+
+        if stopped:
+            break
 
-        output_ids.append(token)
+    if session_cache is not None and conv_id and not model.config.is_encoder_decoder:
+        # Keep the kv of the prompt and the fed output tokens for the next turn.
+        # The kv may extend past a stop token; lookups only use the prefix
+        # shared with `session_ids`.
+        session_ids = input_ids + output_ids[l_prompt_ids:]
+        session_cache.insert(conv_id, session_ids, past_key_values)
 
-        if token in stop_token_ids:
-            stopped = True
-        else:
-            stopped = False
+    del past_key_values
 
-        if i % stream_interval == 0 or i == max_new_tokens - 1 or stopped:
-            output = tokenizer.decode(output_ids, skip_special_tokens=True)
+
+@torch.inference_mode()
+def generate_speculative_stream(
+    model,
+    draft_model,
+    tokenizer,
+    params,
+    device,
+    context_len=2048,
+    stream_interval=2,
+    prefix_cache=None,
+    session_cache=None,
+    abort_event=None,
+    num_speculative_tokens=4,
+):
+    """Yield the outputs of a request like `generate_stream`, with tokens
+    proposed by `draft_model` and verified by `model` several at a time.
+
+    Greedy outputs are the same as those of `generate_stream`.
+    """
+    start_time = time.time()
+    prompt = params["prompt"]
+    max_new_tokens = int(params.get("max_new_tokens", 256))
+    stop_str = params.get("stop", None)
+    stop_token_ids = params.get("stop_ids", [tokenizer.eos_token_id])
+    conv_id = params.get("conv_id", None)
+    echo = params.get("echo", True)
+
+    input_ids = tokenizer(prompt).input_ids
+    output_ids = list(input_ids)
+    l_prompt_ids = len(output_ids)
+
+    prompt_output = tokenizer.decode(output_ids, skip_special_tokens=True)
+    generated_output = ""
+    prefix_offset = max(len(output_ids) - 5, 0)
+    read_offset = len(output_ids)
+
+    max_src_len = context_len - max_new_tokens - 8
+    input_ids = input_ids[-max_src_len:]
+
+    max_new_tokens = min(max_new_tokens, context_len - len(input_ids) - 8)
+
+    prefix_len, past_key_values = 0, None
+    if session_cache is not None and conv_id:
+        prefix_len, past_key_values = session_cache.lookup(conv_id, input_ids)
+    if prefix_len == 0 and prefix_cache is not None:
+        prefix_len, past_key_values = prefix_cache.lookup(input_ids)
+    decoder = SpeculativeDecoder(
+        model,
+        draft_model,
+        SamplingParams.from_dict(params),
+        device,
+        num_speculative_tokens,
+    )
+    new_tokens = [decoder.prefill(input_ids, prefix_len, past_key_values)]
+    if prefix_cache is not None:
+        prefix_cache.insert(input_ids, decoder.past_key_values)
+    first_token_time = time.time()
+
+    num_generated = 0
+    num_streamed = 0
+    while True:
+        stopped = False
+        for token in new_tokens[: max_new_tokens - num_generated]:
+            output_ids.append(token)
+            num_generated += 1
+            if token in stop_token_ids:
+                stopped = True
+                break
+
+        new_text, prefix_offset, read_offset = decode_incrementally(
+            tokenizer,
+            output_ids,
+            prefix_offset,
+            read_offset,
+            stopped or num_generated >= max_new_tokens,
+        )
+        if new_text:
+            search_start = max(len(generated_output) - len(stop_str or "") + 1, 0)
+            generated_output += new_text
             if stop_str:
-                pos = output.rfind(stop_str, l_prompt)
+                pos = generated_output.find(stop_str, search_start)
                 if pos != -1:
-                    output = output[:pos]
+                    generated_output = generated_output[:pos]
                     stopped = True
-            yield output
 
-        if stopped:
+        done = stopped or num_generated >= max_new_tokens
+        # Stream the first token, then every `stream_interval` tokens, and
+        # hold back a partial stop string.
+        if done or (
+            (num_streamed == 0 or num_generated - num_streamed >= stream_interval)
+            and not partial_stop_length(generated_output, stop_str)
+        ):
+            num_streamed = num_generated
+            yield {
+                "text": prompt_output + generated_output if echo else generated_output,
+                "usage": get_usage(
+                    len(input_ids),
+                    num_generated,
+                    start_time,
+                    first_token_time,
+                    done,
+                ),
+                "finish_reason": ("stop" if stopped else "length") if done else None,
+            }
+        if done:
             break
+        if abort_event is not None and abort_event.is_set():
+            return
+        new_tokens = decoder.step(max_new_tokens - num_generated)
+
+    if session_cache is not None and conv_id:
+        session_ids = input_ids + output_ids[l_prompt_ids:]
+        session_cache.insert(conv_id, session_ids, decoder.past_key_values)
+
+
+def generate_sequentially(
+    generate_stream_func, model, tokenizer, params, *args, **kwargs
+):
+    """Generate `n` completions one by one, for models without batched sampling."""
+    n = int(params.get("n", 1))
+    for index in range(n):
+        for output in generate_stream_func(
+            model, tokenizer, dict(params, n=1), *args, **kwargs
+        ):
+            yield dict(output, index=index)
+
+
+@torch.inference_mode()
+def generate_n_stream(
+    model,
+    tokenizer,
+    params,
+    device,
+    context_len=2048,
+    stream_interval=2,
+    prefix_cache=None,
+    abort_event=None,
+):
+    """Sample `n` completions of one prompt as a batch.
+
+    The prompt is prefilled once and its kv cache is shared by all samples.
+    Outputs of the samples are interleaved and carry their `index`.
+    """
+    if model.config.is_encoder_decoder:
+        yield from generate_sequentially(
+            generate_stream,
+            model,
+            tokenizer,
+            params,
+            device,
+            context_len,
+            abort_event=abort_event,
+        )
+        return
+
+    start_time = time.time()
+    prompt = params["prompt"]
+    n = int(params["n"])
+    max_new_tokens = int(params.get("max_new_tokens", 256))
+    stop_str = params.get("stop", None)
+    stop_token_ids = params.get("stop_ids", [tokenizer.eos_token_id])
+    echo = params.get("echo", True)
+
+    input_ids = tokenizer(prompt).input_ids
+    l_prompt_ids = len(input_ids)
+    prompt_output = tokenizer.decode(input_ids, skip_special_tokens=True)
+    samples = [
+        {
+            "output_ids": list(input_ids),
+            "generated_output": "",
+            "prefix_offset": max(len(input_ids) - 5, 0),
+            "read_offset": len(input_ids),
+        }
+        for _ in range(n)
+    ]
+
+    max_src_len = context_len - max_new_tokens - 8
+    input_ids = input_ids[-max_src_len:]
+    max_new_tokens = min(max_new_tokens, context_len - len(input_ids) - 8)
+    if max_new_tokens <= 0:
+        # Nothing may be generated, e.g., the prompt fills the context.
+        for index in range(n):
+            yield {
+                "text": prompt_output if echo else "",
+                "usage": get_usage(len(input_ids), 0, start_time, start_time, True),
+                "finish_reason": "length",
+                "index": index,
+            }
+        return
+
+    prefix_len, past_key_values = 0, None
+    if prefix_cache is not None:
+        prefix_len, past_key_values = prefix_cache.lookup(input_ids)
+    out = model(
+        torch.as_tensor([input_ids[prefix_len:]], device=device),
+        use_cache=True,
+        past_key_values=past_key_values,
+    )
+    if prefix_cache is not None:
+        prefix_cache.insert(input_ids, out.past_key_values)
+    # All samples attend to the same prompt kv, without copying it.
+    past_key_values = tuple(
+        tuple(t.expand(n, -1, -1, -1) for t in layer) for layer in out.past_key_values
+    )
+    last_token_logits = out.logits[:, -1, :].expand(n, -1)
+    if device == "mps":
+        # Switch to CPU by avoiding some bugs in mps backend.
+        last_token_logits = last_token_logits.float().to("cpu")
+    sampler = Sampler.create(
+        [SamplingParams.from_dict(params)] * n,
+        [input_ids] * n,
+        last_token_logits.shape[-1],
+        last_token_logits.device,
+    )
+    # Indices of the unfinished samples, aligned with the rows of the batch.
+    active = list(range(n))
+    # Sampled tokens of each step since the last host sync, [len(active)] each
+    pending_tokens = []
+
+    for i in range(max_new_tokens):
+        tokens = sampler(last_token_logits)
+        pending_tokens.append(tokens)
+        done = i == max_new_tokens - 1
+        if i % stream_interval == 0 or done:
+            # The only host sync of the interval
+            new_tokens = torch.stack(pending_tokens, dim=1).tolist()
+            pending_tokens = []
+            if i == 0:
+                first_token_time = time.time()
+
+            keep = []
+            for row, index in enumerate(active):
+                sample = samples[index]
+                stopped = False
+                for token in new_tokens[row]:
+                    sample["output_ids"].append(token)
+                    if token in stop_token_ids:
+                        stopped = True
+                        break
+
+                new_text, prefix_offset, read_offset = decode_incrementally(
+                    tokenizer,
+                    sample["output_ids"],
+                    sample["prefix_offset"],
+                    sample["read_offset"],
+                    stopped or done,
+                )
+                sample["prefix_offset"] = prefix_offset
+                sample["read_offset"] = read_offset
+                generated_output = sample["generated_output"]
+                if new_text:
+                    search_start = max(
+                        len(generated_output) - len(stop_str or "") + 1, 0
+                    )
+                    generated_output += new_text
+                    if stop_str:
+                        pos = generated_output.find(stop_str, search_start)
+                        if pos != -1:
+                            generated_output = generated_output[:pos]
+                            stopped = True
+                    sample["generated_output"] = generated_output
+
+                finished = stopped or done
+                if finished or not partial_stop_length(generated_output, stop_str):
+                    if finished:
+                        finish_reason = "stop" if stopped else "length"
+                    else:
+                        finish_reason = None
+                    num_generated = len(sample["output_ids"]) - l_prompt_ids
+                    yield {
+                        "text": (prompt_output if echo else "") + generated_output,
+                        "usage": get_usage(
+                            len(input_ids),
+                            num_generated,
+                            start_time,
+                            first_token_time,
+                            finish_reason is not None,
+                        ),
+                        "finish_reason": finish_reason,
+                        "index": index,
+                    }
+
+                if not stopped:
+                    keep.append(row)
+
+            if not keep or done:
+                break
+            if len(keep) < len(active):
+                # Finished samples leave the batch only at host syncs.
+                rows = torch.as_tensor(keep, device=device)
+                past_key_values = tuple(
+                    tuple(t.index_select(0, rows) for t in layer)
+                    for layer in past_key_values
+                )
+                active = [active[row] for row in keep]
+                sampler = sampler.index_select(keep)
+                tokens = tokens.index_select(0, rows.to(tokens.device))
+        if abort_event is not None and abort_event.is_set():
+            return
+
+        out = model(
+            input_ids=tokens.unsqueeze(1).to(device),
+            use_cache=True,
+            past_key_values=past_key_values,
+        )
+        last_token_logits = out.logits[:, -1, :]
+        if device == "mps":
+            last_token_logits = last_token_logits.float().to("cpu")
+        past_key_values = out.past_key_values
 
     del past_key_values
 
@@ -265,12 +785,26 @@ def chat_loop(
     max_new_tokens: int,
     chatio: ChatIO,
     debug: bool,
+    load_4bit: bool = False,
+    draft_model_path: Optional[str] = None,
+    num_speculative_tokens: int = 4,
+    tile_cache_gb: float = 0,
 ):
     # Model
     model, tokenizer = load_model(
-        model_path, device, num_gpus, max_gpu_memory, load_8bit, debug
+        model_path,
+        device,
+        num_gpus,
+        max_gpu_memory,
+        load_8bit,
+        debug,
+        load_4bit,
+        tile_cache_gb,
     )
     is_chatglm = "chatglm" in str(type(model)).lower()
+    draft_model = None
+    if draft_model_path and not is_chatglm:
+        draft_model, _ = load_model(draft_model_path, device, num_gpus, max_gpu_memory)
 
     # Chat
     if conv_template:
@@ -294,7 +828,11 @@ def chat_loop(
             prompt = conv.messages[conv.offset :]
             generate_stream_func = chatglm_generate_stream
         else:
-            generate_stream_func = generate_stream
+            generate_stream_func = functools.partial(
+                generate_stream,
+                draft_model=draft_model,
+                num_speculative_tokens=num_speculative_tokens,
+            )
             prompt = conv.get_prompt()
 
         skip_echo_len = compute_skip_echo_len(model_path, conv, prompt)
@@ -309,6 +847,7 @@ def chat_loop(
 
         chatio.prompt_for_output(conv.roles[1])
         output_stream = generate_stream_func(model, tokenizer, params, device)
+        output_stream = (output["text"] for output in output_stream)
         outputs = chatio.stream_output(output_stream, skip_echo_len)
         # NOTE: strip is important to align with the training data.
         conv.messages[-1][-1] = outputs.strip()
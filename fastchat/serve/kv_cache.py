@@ -0,0 +1,177 @@
+"""
+Kv caches shared across requests.
+
+Requests often repeat the same system prompt and chat history. The prefix cache
+maps the token ids of a prompt to the `past_key_values` computed for it, so that
+a new request only needs to prefill the tokens after its longest cached prefix.
+The session cache keeps the kv cache of the last turn of a conversation, so the
+next turn only prefills the newly appended message.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+
+def common_prefix_length(a, b):
+    """Binary search the length of the common prefix of two token id lists."""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def past_key_values_nbytes(past_key_values):
+    return sum(t.numel() * t.element_size() for layer in past_key_values for t in layer)
+
+
+def slice_past_key_values(past_key_values, length):
+    """Keep the first `length` positions of tensors of shape [batch, heads, seq, dim]."""
+    return tuple(tuple(t[:, :, :length] for t in layer) for layer in past_key_values)
+
+
+class PrefixKVCache:
+    """An LRU cache of `past_key_values` with a memory budget in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # OrderedDict[Tuple[int] -> (past_key_values, nbytes)], oldest first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.bytes_held = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+
+    def lookup(self, input_ids):
+        """Return the length of the longest cached prefix and its kv cache.
+
+        At least one token is always left to prefill, since the logits of the
+        last prompt token are needed to start decoding.
+        """
+        input_ids = tuple(input_ids)
+        with self.lock:
+            best_len, best_key = 0, None
+            for key in self.entries:
+                n = common_prefix_length(key, input_ids)
+                if n > best_len:
+                    best_len, best_key = n, key
+            best_len = min(best_len, len(input_ids) - 1)
+
+            if best_len <= 0:
+                self.misses += 1
+                return 0, None
+
+            self.hits += 1
+            self.hit_tokens += best_len
+            self.entries.move_to_end(best_key)
+            past_key_values = self.entries[best_key][0]
+            return best_len, slice_past_key_values(past_key_values, best_len)
+
+    def insert(self, input_ids, past_key_values):
+        key = tuple(input_ids)
+        nbytes = past_key_values_nbytes(past_key_values)
+        if nbytes > self.max_bytes:
+            return
+
+        with self.lock:
+            # Entries that are a prefix of the new one are covered by it.
+            for old_key in list(self.entries):
+                if len(old_key) <= len(key) and key[: len(old_key)] == old_key:
+                    self.bytes_held -= self.entries.pop(old_key)[1]
+
+            self.entries[key] = (past_key_values, nbytes)
+            self.bytes_held += nbytes
+            while self.bytes_held > self.max_bytes:
+                _, (_, old_nbytes) = self.entries.popitem(last=False)
+                self.bytes_held -= old_nbytes
+
+    def get_status(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_tokens": self.hit_tokens,
+            "num_entries": len(self.entries),
+            "bytes_held": self.bytes_held,
+        }
+
+
+class SessionKVCache:
+    """Keep the kv cache of the last turn of each conversation.
+
+    Entries expire after `ttl` seconds without access. When the memory budget
+    is exceeded, the least recently used sessions are dropped first.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # OrderedDict[str -> (token_ids, past_key_values, nbytes, last_access)]
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.bytes_held = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+
+    def lookup(self, session_id, input_ids):
+        """Return the number of reusable tokens of a session and their kv cache."""
+        with self.lock:
+            self.remove_expired()
+            entry = self.entries.get(session_id)
+            n = 0
+            if entry is not None:
+                n = common_prefix_length(entry[0], tuple(input_ids))
+                n = min(n, len(input_ids) - 1)
+
+            if n <= 0:
+                self.misses += 1
+                return 0, None
+
+            self.hits += 1
+            self.hit_tokens += n
+            self.entries.move_to_end(session_id)
+            self.entries[session_id] = entry[:3] + (time.time(),)
+            return n, slice_past_key_values(entry[1], n)
+
+    def insert(self, session_id, token_ids, past_key_values):
+        token_ids = tuple(token_ids[: past_key_values[0][0].shape[2]])
+        nbytes = past_key_values_nbytes(past_key_values)
+
+        with self.lock:
+            old = self.entries.pop(session_id, None)
+            if old is not None:
+                self.bytes_held -= old[2]
+            if nbytes > self.max_bytes:
+                return
+
+            self.entries[session_id] = (token_ids, past_key_values, nbytes, time.time())
+            self.bytes_held += nbytes
+            self.remove_expired()
+            while self.bytes_held > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.bytes_held -= old[2]
+
+    def remove_expired(self):
+        expire = time.time() - self.ttl
+        # Entries are ordered by last access, so expired ones come first.
+        while self.entries:
+            session_id, entry = next(iter(self.entries.items()))
+            if entry[3] >= expire:
+                break
+            del self.entries[session_id]
+            self.bytes_held -= entry[2]
+
+    def get_status(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_tokens": self.hit_tokens,
+            "num_sessions": len(self.entries),
+            "bytes_held": self.bytes_held,
+        }
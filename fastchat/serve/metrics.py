@@ -0,0 +1,191 @@
+"""
+Prometheus metrics of the serving processes.
+
+Each server exports its own registry at `GET /metrics`. The request paths
+only update counters and histograms once per request, which takes a few
+microseconds, and never per token. Gauges such as the queue length and the
+GPU memory are read when the endpoint is scraped.
+"""
+from fastapi.responses import Response
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    CONTENT_TYPE_LATEST,
+    generate_latest,
+)
+from prometheus_client.core import GaugeMetricFamily
+import torch
+
+TTFT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TIME_PER_TOKEN_BUCKETS = (0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5)
+WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60)
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+class CallbackGauge:
+    """A labelled gauge whose samples `fn` returns as (label_values, value) pairs."""
+
+    def __init__(self, name, documentation, labels, fn):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.fn = fn
+
+    def collect(self):
+        gauge = GaugeMetricFamily(self.name, self.documentation, labels=self.labels)
+        for label_values, value in self.fn():
+            gauge.add_metric(label_values, value)
+        yield gauge
+
+
+def get_gpu_memory_samples():
+    if not torch.cuda.is_available():
+        return []
+    return [
+        ((str(i), kind), fn(i))
+        for i in range(torch.cuda.device_count())
+        for kind, fn in [
+            ("allocated", torch.cuda.memory_allocated),
+            ("reserved", torch.cuda.memory_reserved),
+        ]
+    ]
+
+
+def metrics_response(registry):
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+
+class UsageMetrics:
+    """Token counts and latencies from the usage of finished completions."""
+
+    def __init__(self, prefix, registry):
+        self.prompt_tokens = Counter(
+            f"{prefix}_prompt_tokens",
+            "Prompt tokens of finished completions.",
+            registry=registry,
+        )
+        self.generated_tokens = Counter(
+            f"{prefix}_generated_tokens",
+            "Tokens generated by finished completions.",
+            registry=registry,
+        )
+        self.ttft = Histogram(
+            f"{prefix}_time_to_first_token_seconds",
+            "Seconds from the start of a request to its first token.",
+            buckets=TTFT_BUCKETS,
+            registry=registry,
+        )
+        self.time_per_token = Histogram(
+            f"{prefix}_time_per_output_token_seconds",
+            "Mean seconds per output token after the first one, per completion.",
+            buckets=TIME_PER_TOKEN_BUCKETS,
+            registry=registry,
+        )
+
+    def observe(self, usage):
+        """Record the usage of a finished completion from a worker stream."""
+        if not usage:
+            return
+        self.prompt_tokens.inc(usage["prompt_tokens"])
+        self.generated_tokens.inc(usage["completion_tokens"])
+        if "ttft" in usage:
+            self.ttft.observe(usage["ttft"])
+            if usage["completion_tokens"] > 1:
+                self.time_per_token.observe(
+                    usage["decode_time"] / (usage["completion_tokens"] - 1)
+                )
+
+
+class WorkerMetrics:
+    """Metrics of a model worker. `get_queue_length` is called on each scrape."""
+
+    def __init__(self, get_queue_length):
+        self.registry = CollectorRegistry()
+        self.requests = Counter(
+            "fastchat_worker_requests",
+            "Requests by outcome: finished, aborted, rejected or error.",
+            ["outcome"],
+            registry=self.registry,
+        )
+        self.queue_wait = Histogram(
+            "fastchat_worker_queue_wait_seconds",
+            "Seconds an admitted request waited for a slot.",
+            buckets=WAIT_BUCKETS,
+            registry=self.registry,
+        )
+        self.usage = UsageMetrics("fastchat_worker", self.registry)
+        self.registry.register(
+            CallbackGauge(
+                "fastchat_worker_queue_length",
+                "Running and waiting requests.",
+                [],
+                lambda: [((), get_queue_length())],
+            )
+        )
+        self.registry.register(
+            CallbackGauge(
+                "fastchat_gpu_memory_bytes",
+                "GPU memory allocated by tensors and reserved by the allocator.",
+                ["device", "kind"],
+                get_gpu_memory_samples,
+            )
+        )
+
+
+class ControllerMetrics:
+    """Metrics of the controller. `get_workers` returns (name, model, queue_length)."""
+
+    def __init__(self, get_workers):
+        self.registry = CollectorRegistry()
+        self.requests = Counter(
+            "fastchat_controller_stream_requests",
+            "Generation requests relayed by the controller, by model.",
+            ["model"],
+            registry=self.registry,
+        )
+        self.dispatch = Counter(
+            "fastchat_controller_dispatch",
+            'Dispatch decisions by model and chosen worker ("" when none).',
+            ["model", "worker"],
+            registry=self.registry,
+        )
+        self.heart_beats = Counter(
+            "fastchat_controller_heart_beats",
+            "Heart beats received from workers.",
+            registry=self.registry,
+        )
+        self.registry.register(
+            CallbackGauge(
+                "fastchat_controller_worker_queue_length",
+                "The queue length of each worker, as last reported or dispatched.",
+                ["worker", "model"],
+                lambda: [((w, m), q) for w, m, q in get_workers()],
+            )
+        )
+
+
+class APIMetrics:
+    """Metrics of the OpenAI-compatible API server."""
+
+    def __init__(self):
+        self.registry = CollectorRegistry()
+        self.requests = Counter(
+            "fastchat_api_requests",
+            "Chat completion requests by model and outcome: ok, error or aborted.",
+            ["model", "outcome"],
+            registry=self.registry,
+        )
+        self.latency = Histogram(
+            "fastchat_api_request_latency_seconds",
+            "Seconds to serve a chat completion request completely.",
+            buckets=LATENCY_BUCKETS,
+            registry=self.registry,
+        )
+        self.dispatch = Counter(
+            "fastchat_api_dispatch",
+            "Requests sent to each worker, by outcome: ok, overloaded or failed.",
+            ["worker", "outcome"],
+            registry=self.registry,
+        )
+        self.usage = UsageMetrics("fastchat_api", self.registry)
@@ -3,7 +3,10 @@ A model worker executes the model.
 """
 import argparse
 import asyncio
+from collections import deque
 import dataclasses
+import functools
+import inspect
 import logging
 import json
 import time
@@ -11,8 +14,9 @@ from typing import List, Union
 import threading
 import uuid
 
-from fastapi import FastAPI, Request, BackgroundTasks
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, Request
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
 import requests
 
 try:
@@ -32,10 +36,24 @@ except ImportError:
 import torch
 import uvicorn
 
-from fastchat.constants import WORKER_HEART_BEAT_INTERVAL
-from fastchat.serve.inference import load_model, generate_stream
+from fastchat.constants import (
+    INVALID_REQUEST_ERROR_CODE,
+    WORKER_HEART_BEAT_INTERVAL,
+    WORKER_OVERLOADED_ERROR_CODE,
+    SESSION_EXPIRATION,
+)
+from fastchat.protocol.worker_stream import StreamEncoder
+from fastchat.serve.admission import AdmissionQueue, PRIORITIES, RequestRejected
+from fastchat.serve.continuous_batching import ContinuousBatchingEngine
+from fastchat.serve.inference import (
+    load_model,
+    generate_stream,
+    generate_sequentially,
+)
+from fastchat.serve.kv_cache import PrefixKVCache, SessionKVCache
+from fastchat.serve.metrics import WorkerMetrics, metrics_response
 from fastchat.serve.serve_chatglm import chatglm_generate_stream
-from fastchat.utils import build_logger, server_error_msg, pretty_print_semaphore
+from fastchat.utils import build_logger, server_error_msg
 
 GB = 1 << 30
 
@@ -43,7 +61,32 @@ worker_id = str(uuid.uuid4())[:6]
 logger = build_logger("model_worker", f"model_worker_{worker_id}.log")
 global_counter = 0
 
-model_semaphore = None
+
+class SpeedMeter:
+    """Rolling averages of the decoding speed and the time to first token."""
+
+    def __init__(self, window=64):
+        # Deque[(ttft, num_decode_tokens, decode_time)] of recent requests
+        self.records = deque(maxlen=window)
+
+    def add(self, ttft, num_decode_tokens, decode_time):
+        self.records.append((ttft, num_decode_tokens, decode_time))
+
+    def get_speed(self):
+        """Tokens per second after the first token. 1 until a token after the
+        first one is measured."""
+        records = list(self.records)
+        num_decode_tokens = sum(r[1] for r in records)
+        decode_time = sum(r[2] for r in records)
+        if num_decode_tokens <= 0 or decode_time <= 0:
+            return 1
+        return num_decode_tokens / decode_time
+
+    def get_ttft(self):
+        records = list(self.records)
+        if not records:
+            return 0.0
+        return sum(r[0] for r in records) / len(records)
 
 
 def heart_beat_worker(controller):
@@ -65,6 +108,15 @@ class ModelWorker:
         num_gpus,
         max_gpu_memory,
         load_8bit=False,
+        continuous_batching=False,
+        max_batch_size=8,
+        prefix_cache_gb=0,
+        session_cache_gb=0,
+        session_cache_ttl=SESSION_EXPIRATION,
+        load_4bit=False,
+        draft_model_path=None,
+        num_speculative_tokens=4,
+        tile_cache_gb=0,
     ):
         self.controller_addr = controller_addr
         self.worker_addr = worker_addr
@@ -73,10 +125,21 @@ class ModelWorker:
             model_path = model_path[:-1]
         self.model_name = model_name or model_path.split("/")[-1]
         self.device = device
+        self.speed_meter = SpeedMeter()
+        self.admission = AdmissionQueue(
+            args.limit_model_concurrency, args.max_queue_size
+        )
+        self.metrics = WorkerMetrics(self.get_queue_length)
 
         logger.info(f"Loading the model {self.model_name} on worker {worker_id} ...")
         self.model, self.tokenizer = load_model(
-            model_path, device, num_gpus, max_gpu_memory, load_8bit
+            model_path,
+            device,
+            num_gpus,
+            max_gpu_memory,
+            load_8bit,
+            load_4bit=load_4bit,
+            tile_cache_gb=tile_cache_gb,
         )
 
         if hasattr(self.model.config, "max_sequence_length"):
@@ -87,10 +150,61 @@ class ModelWorker:
             self.context_len = 2048
 
         is_chatglm = "chatglm" in str(type(self.model)).lower()
+        self.prefix_cache = None
+        if prefix_cache_gb > 0 and not is_chatglm:
+            self.prefix_cache = PrefixKVCache(int(prefix_cache_gb * GB))
+        self.session_cache = None
+        if session_cache_gb > 0 and not is_chatglm:
+            self.session_cache = SessionKVCache(
+                int(session_cache_gb * GB), session_cache_ttl
+            )
+
+        self.draft_model = None
+        if draft_model_path:
+            if is_chatglm or self.model.config.is_encoder_decoder:
+                logger.warning(
+                    f"Speculative decoding is not supported for {self.model_name}."
+                )
+            elif continuous_batching:
+                logger.warning(
+                    "Speculative decoding is not supported with continuous batching."
+                )
+            else:
+                logger.info(f"Loading the draft model {draft_model_path} ...")
+                self.draft_model, _ = load_model(
+                    draft_model_path, device, num_gpus, max_gpu_memory
+                )
+
         if is_chatglm:
-            self.generate_stream_func = chatglm_generate_stream
+            self.generate_stream_func = functools.partial(
+                generate_sequentially, chatglm_generate_stream
+            )
         else:
-            self.generate_stream_func = generate_stream
+            self.generate_stream_func = functools.partial(
+                generate_stream,
+                prefix_cache=self.prefix_cache,
+                session_cache=self.session_cache,
+                draft_model=self.draft_model,
+                num_speculative_tokens=num_speculative_tokens,
+            )
+
+        self.engine = None
+        if continuous_batching:
+            if is_chatglm or self.model.config.is_encoder_decoder:
+                logger.warning(
+                    f"Continuous batching is not supported for {self.model_name}."
+                )
+            else:
+                self.engine = ContinuousBatchingEngine(
+                    self.model,
+                    self.tokenizer,
+                    device,
+                    self.context_len,
+                    args.stream_interval,
+                    max_batch_size,
+                    self.prefix_cache,
+                    self.session_cache,
+                )
 
         if not no_register:
             self.register_to_controller()
@@ -114,7 +228,7 @@ class ModelWorker:
     def send_heart_beat(self):
         logger.info(
             f"Send heart beat. Models: {[self.model_name]}. "
-            f"Semaphore: {pretty_print_semaphore(model_semaphore)}. "
+            f"Queue length: {self.get_queue_length()}. "
             f"global_counter: {global_counter}"
         )
 
@@ -127,6 +241,8 @@ class ModelWorker:
                     json={
                         "worker_name": self.worker_addr,
                         "queue_length": self.get_queue_length(),
+                        "speed": self.speed_meter.get_speed(),
+                        "ttft": self.speed_meter.get_ttft(),
                     },
                     timeout=5,
                 )
@@ -140,42 +256,62 @@ class ModelWorker:
             self.register_to_controller()
 
     def get_queue_length(self):
-        if (
-            model_semaphore is None
-            or model_semaphore._value is None
-            or model_semaphore._waiters is None
-        ):
-            return 0
-        else:
-            return (
-                args.limit_model_concurrency
-                - model_semaphore._value
-                + len(model_semaphore._waiters)
-            )
+        return self.admission.queue_length
 
     def get_status(self):
-        return {
+        status = {
             "model_names": [self.model_name],
-            "speed": 1,
+            "speed": self.speed_meter.get_speed(),
+            "ttft": self.speed_meter.get_ttft(),
             "queue_length": self.get_queue_length(),
+            "admission": self.admission.get_status(),
         }
-
-    def generate_stream_gate(self, params):
+        if self.prefix_cache is not None:
+            status["prefix_cache"] = self.prefix_cache.get_status()
+        if self.session_cache is not None:
+            status["session_cache"] = self.session_cache.get_status()
+        return status
+
+    def generate_stream_gate(self, params, abort_event=None):
+        # See fastchat.protocol.worker_stream for the stream versions.
+        stream_version = int(params.get("stream_version", 1))
+        if stream_version >= 2:
+            params = dict(params, echo=False)
         try:
-            for output in self.generate_stream_func(
-                self.model,
-                self.tokenizer,
-                params,
-                self.device,
-                self.context_len,
-                args.stream_interval,
-            ):
-                ret = {
-                    "text": output,
-                    "error_code": 0,
-                }
-                yield json.dumps(ret).encode() + b"\0"
+            if self.engine is not None:
+                output_iter = self.engine.generate_stream(params, abort_event)
+            else:
+                output_iter = self.generate_stream_func(
+                    self.model,
+                    self.tokenizer,
+                    params,
+                    self.device,
+                    self.context_len,
+                    args.stream_interval,
+                    abort_event=abort_event,
+                )
+            encoder = StreamEncoder(stream_version)
+            # The usage of the final output of each sample
+            usages = []
+            for output in output_iter:
+                if output["finish_reason"] is not None and output["usage"]:
+                    usages.append(output["usage"])
+                yield encoder.encode(output)
+
+            for usage in usages:
+                self.metrics.usage.observe(usage)
+            if usages:
+                self.metrics.requests.labels("finished").inc()
+                # The samples are decoded together, so they share the time to
+                # the first token and the decode time.
+                num_tokens = sum(u["completion_tokens"] for u in usages)
+                self.speed_meter.add(
+                    min(u["ttft"] for u in usages),
+                    num_tokens - len(usages),
+                    max(u["decode_time"] for u in usages),
+                )
         except torch.cuda.OutOfMemoryError:
+            self.metrics.requests.labels("error").inc()
             ret = {
                 "text": server_error_msg,
                 "error_code": 1,
@@ -186,23 +322,72 @@ class ModelWorker:
 app = FastAPI()
 
 
-def release_model_semaphore():
-    model_semaphore.release()
+async def relay_until_disconnect(generator, release):
+    """Relay a blocking generator from a thread pool and call `release` at the end.
+
+    Starlette cancels the response when the client disconnects. `release` sets
+    the abort event, which stops the generation before its next decoding step
+    instead of letting it run to `max_new_tokens` for nobody.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            chunk = await loop.run_in_executor(None, next, generator, None)
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        release()
 
 
 @app.post("/worker_generate_stream")
 async def api_generate_stream(request: Request):
-    global model_semaphore, global_counter
+    global global_counter
     global_counter += 1
     params = await request.json()
 
-    if model_semaphore is None:
-        model_semaphore = asyncio.Semaphore(args.limit_model_concurrency)
-    await model_semaphore.acquire()
-    generator = worker.generate_stream_gate(params)
-    background_tasks = BackgroundTasks()
-    background_tasks.add_task(release_model_semaphore)
-    return StreamingResponse(generator, background=background_tasks)
+    priority = params.get("priority", "interactive")
+    if priority not in PRIORITIES:
+        ret = {
+            "text": f"Invalid priority: {priority}. Choose from {list(PRIORITIES)}.",
+            "error_code": INVALID_REQUEST_ERROR_CODE,
+        }
+        return Response(json.dumps(ret).encode() + b"\0")
+    priority = PRIORITIES[priority]
+    timeout = float(params.get("queue_timeout", args.queue_timeout))
+    arrival_time = time.time()
+    try:
+        start_time = await worker.admission.acquire(priority, timeout)
+    except RequestRejected as e:
+        worker.metrics.requests.labels("rejected").inc()
+        logger.info(f"{e} Queue length: {worker.get_queue_length()}")
+        ret = {
+            "text": server_error_msg,
+            "error_code": WORKER_OVERLOADED_ERROR_CODE,
+        }
+        return Response(json.dumps(ret).encode() + b"\0")
+    worker.metrics.queue_wait.observe(start_time - arrival_time)
+
+    abort_event = threading.Event()
+    generator = worker.generate_stream_gate(params, abort_event)
+
+    released = False
+
+    def release():
+        nonlocal released
+        # Also run as a background task, since the relay never starts if the
+        # client disconnects before the response does.
+        if not released:
+            released = True
+            abort_event.set()
+            worker.admission.release(start_time)
+            if inspect.getgeneratorstate(generator) != inspect.GEN_CLOSED:
+                worker.metrics.requests.labels("aborted").inc()
+
+    return StreamingResponse(
+        relay_until_disconnect(generator, release),
+        background=BackgroundTask(release),
+    )
 
 
 @app.post("/worker_get_status")
@@ -210,6 +395,11 @@ async def api_get_status(request: Request):
     return worker.get_status()
 
 
+@app.get("/metrics")
+async def api_metrics():
+    return metrics_response(worker.metrics.registry)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", type=str, default="localhost")
@@ -235,10 +425,83 @@ if __name__ == "__main__":
         help="The maximum memory per gpu. Use a string like '13Gib'",
     )
     parser.add_argument("--load-8bit", action="store_true")
-    parser.add_argument("--limit-model-concurrency", type=int, default=5)
+    parser.add_argument("--load-4bit", action="store_true")
+    parser.add_argument(
+        "--tile-cache-gb",
+        type=float,
+        default=0,
+        help="Memory budget in GiB for keeping dequantized weights of the "
+        "8-bit or 4-bit layers. 0 disables it.",
+    )
+    parser.add_argument(
+        "--limit-model-concurrency",
+        type=int,
+        help="The maximum number of requests running at once. Defaults to 5, "
+        "or to --max-batch-size with --continuous-batching.",
+    )
+    parser.add_argument(
+        "--max-queue-size",
+        type=int,
+        default=64,
+        help="The maximum number of requests waiting for a slot. More are rejected.",
+    )
+    parser.add_argument(
+        "--queue-timeout",
+        type=float,
+        default=10,
+        help="Seconds a request may wait for a slot, unless it sets `queue_timeout`. "
+        "The response starts only when the request gets a slot, so keep it below "
+        "the read timeouts of the controller (15 s) and the API server (20 s).",
+    )
     parser.add_argument("--stream-interval", type=int, default=2)
     parser.add_argument("--no-register", action="store_true")
+    parser.add_argument(
+        "--continuous-batching",
+        action="store_true",
+        help="Merge all active requests into one batch at every decoding step.",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=8,
+        help="The maximum number of requests decoded together in one batch.",
+    )
+    parser.add_argument(
+        "--prefix-cache-gb",
+        type=float,
+        default=0,
+        help="Memory budget in GiB for the prompt prefix kv cache. 0 disables it.",
+    )
+    parser.add_argument(
+        "--session-cache-gb",
+        type=float,
+        default=0,
+        help="Memory budget in GiB for keeping the kv of each conversation "
+        "between turns. 0 disables it.",
+    )
+    parser.add_argument(
+        "--session-cache-ttl",
+        type=int,
+        default=SESSION_EXPIRATION,
+        help="Seconds to keep the kv of an idle conversation.",
+    )
+    parser.add_argument(
+        "--draft-model-path",
+        type=str,
+        help="A small model with the same tokenizer for speculative decoding.",
+    )
+    parser.add_argument(
+        "--num-speculative-tokens",
+        type=int,
+        default=4,
+        help="The number of tokens the draft model proposes per step.",
+    )
     args = parser.parse_args()
+    if args.limit_model_concurrency is None:
+        # Admit enough requests to fill a batch.
+        args.limit_model_concurrency = (
+            args.max_batch_size if args.continuous_batching else 5
+        )
     logger.info(f"args: {args}")
 
     worker = ModelWorker(
@@ -252,5 +515,14 @@ if __name__ == "__main__":
         args.num_gpus,
         args.max_gpu_memory,
         args.load_8bit,
+        args.continuous_batching,
+        args.max_batch_size,
+        args.prefix_cache_gb,
+        args.session_cache_gb,
+        args.session_cache_ttl,
+        args.load_4bit,
+        args.draft_model_path,
+        args.num_speculative_tokens,
+        args.tile_cache_gb,
     )
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
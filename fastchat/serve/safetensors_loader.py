@@ -0,0 +1,89 @@
+"""
+Memory-mapped loading of safetensors checkpoints.
+
+The model skeleton is built on the meta device and every tensor is read from
+the memory-mapped files straight to its target device, one at a time. The full
+state dict is never deserialized into host memory, and several workers on one
+host share the page cache of the same files.
+"""
+import itertools
+import json
+import os
+import resource
+
+from accelerate import init_empty_weights
+from safetensors import safe_open
+import torch
+import torch.nn as nn
+from transformers import AutoConfig, AutoModelForCausalLM
+
+SAFE_WEIGHTS_NAME = "model.safetensors"
+SAFE_WEIGHTS_INDEX_NAME = "model.safetensors.index.json"
+
+
+def get_safetensors_files(model_path):
+    """Return the safetensors files of a checkpoint, or None if there are none."""
+    index_file = os.path.join(model_path, SAFE_WEIGHTS_INDEX_NAME)
+    if os.path.exists(index_file):
+        with open(index_file) as fin:
+            weight_map = json.load(fin)["weight_map"]
+        return [os.path.join(model_path, f) for f in sorted(set(weight_map.values()))]
+    weights_file = os.path.join(model_path, SAFE_WEIGHTS_NAME)
+    if os.path.exists(weights_file):
+        return [weights_file]
+    return None
+
+
+def init_empty_model(model_path, dtype):
+    config = AutoConfig.from_pretrained(model_path)
+    with init_empty_weights():
+        return AutoModelForCausalLM.from_config(config, torch_dtype=dtype)
+
+
+def load_tensors(model, filenames, device, dtype):
+    """Materialize the meta tensors of `model` from safetensors files."""
+    for filename in filenames:
+        with safe_open(filename, framework="pt") as f:
+            for name in f.keys():
+                module_name, _, tensor_name = name.rpartition(".")
+                module = model.get_submodule(module_name)
+                if not getattr(module, tensor_name).is_meta:
+                    # Buffers like `inv_freq` are already computed in full precision.
+                    continue
+
+                tensor = f.get_tensor(name)
+                if tensor.is_floating_point():
+                    tensor = tensor.to(device, dtype)
+                else:
+                    tensor = tensor.to(device)
+                if tensor_name in module._parameters:
+                    module._parameters[tensor_name] = nn.Parameter(
+                        tensor, requires_grad=False
+                    )
+                else:
+                    module._buffers[tensor_name] = tensor
+
+
+def check_no_meta_tensors(model, model_path):
+    for name, tensor in itertools.chain(
+        model.named_parameters(), model.named_buffers()
+    ):
+        if tensor.is_meta:
+            raise ValueError(f"Missing tensor {name} in {model_path}")
+
+
+def load_safetensors_model(model_path, device, dtype):
+    model = init_empty_model(model_path, dtype)
+    load_tensors(model, get_safetensors_files(model_path), device, dtype)
+    # Tied weights (e.g., lm_head of OPT) still point to the meta tensors.
+    model.tie_weights()
+    check_no_meta_tensors(model, model_path)
+    # `from_config` builds the model in training mode, with dropout on.
+    model.eval()
+    return model
+
+
+def get_peak_rss():
+    """Return the peak resident set size of this process in bytes."""
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -0,0 +1,233 @@
+"""
+Batched logits processing and sampling on the device of the model.
+
+Every row of a batch has its own temperature, top-k, top-p, repetition penalty
+and frequency penalty. The penalties are tracked with [batch, vocab] tensors
+that are updated on the device, so the sampled tokens can stay there and the
+host only copies them every `stream_interval` steps.
+"""
+import dataclasses
+from typing import List
+
+import torch
+
+# Candidates taken from the head of the vocabulary for top-p on the CPU
+NUM_CPU_CANDIDATES = 256
+
+
+@dataclasses.dataclass
+class SamplingParams:
+    temperature: float = 1.0
+    # Disabled when not positive
+    top_k: int = -1
+    top_p: float = 1.0
+    # Divides the positive logits of the prompt and output tokens, and
+    # multiplies the negative ones, like the CTRL paper.
+    repetition_penalty: float = 1.0
+    # Subtracted from the logits once per occurrence in the output
+    frequency_penalty: float = 0.0
+
+    @classmethod
+    def from_dict(cls, params):
+        return cls(
+            temperature=float(params.get("temperature", 1.0)),
+            top_k=int(params.get("top_k", -1)),
+            top_p=float(params.get("top_p", 1.0)),
+            repetition_penalty=float(params.get("repetition_penalty", 1.0)),
+            frequency_penalty=float(params.get("frequency_penalty", 0.0)),
+        )
+
+    @property
+    def greedy(self):
+        return self.temperature < 1e-4
+
+    @property
+    def has_penalties(self):
+        return self.repetition_penalty != 1.0 or self.frequency_penalty != 0.0
+
+
+class Sampler:
+    """Sample the next token of every row of a batch without host syncs.
+
+    Create it with `Sampler.create`. Rows are added with `Sampler.cat` and
+    removed with `index_select`, following the rows of the batched kv cache.
+    """
+
+    def __init__(self, rows: List[SamplingParams], seen, counts, device):
+        self.rows = rows
+        # [batch, vocab] bool of the prompt and output tokens, or None
+        self.seen = seen
+        # [batch, vocab] float occurrences of the output tokens, or None
+        self.counts = counts
+        self.device = device
+
+        self.all_greedy = all(r.greedy for r in rows)
+        self.any_greedy = any(r.greedy for r in rows)
+        sampled = [r for r in rows if not r.greedy]
+        self.any_top_k_top_p = any(r.top_k > 0 or r.top_p < 1.0 for r in sampled)
+        self.max_top_k = max((r.top_k for r in sampled), default=0)
+        # When every sampled row has a top-k, a partial top-k replaces the
+        # full sort of the vocabulary.
+        self.all_top_k = bool(sampled) and all(r.top_k > 0 for r in sampled)
+
+        def column(values, dtype=torch.float32):
+            return torch.tensor(values, dtype=dtype, device=device).unsqueeze(1)
+
+        self.temperature = column([max(r.temperature, 1e-4) for r in rows])
+        self.greedy = column([r.greedy for r in rows], torch.bool).squeeze(1)
+        self.has_top_k = column([r.top_k > 0 for r in rows], torch.bool)
+        self.top_k = column(
+            [r.top_k if r.top_k > 0 else 2**31 - 1 for r in rows], torch.int64
+        )
+        self.top_p = column([r.top_p for r in rows])
+        self.repetition_penalty = column([r.repetition_penalty for r in rows])
+        self.frequency_penalty = column([r.frequency_penalty for r in rows])
+
+    @classmethod
+    def create(cls, rows, prompt_ids, vocab_size, device):
+        """Create a sampler for `rows` whose prompts are `prompt_ids`."""
+        seen = counts = None
+        if any(r.repetition_penalty != 1.0 for r in rows):
+            seen = torch.zeros((len(rows), vocab_size), dtype=torch.bool, device=device)
+            for i, ids in enumerate(prompt_ids):
+                seen[i, torch.as_tensor(ids, device=device)] = True
+        if any(r.frequency_penalty != 0.0 for r in rows):
+            counts = torch.zeros((len(rows), vocab_size), device=device)
+        return cls(rows, seen, counts, device)
+
+    @classmethod
+    def cat(cls, samplers):
+        """Stack the rows of several samplers, in order."""
+        rows = [r for s in samplers for r in s.rows]
+        device = samplers[0].device
+
+        def cat_state(name, dtype):
+            states = [getattr(s, name) for s in samplers]
+            if all(state is None for state in states):
+                return None
+            vocab_size = next(st for st in states if st is not None).shape[1]
+            return torch.cat(
+                [
+                    st
+                    if st is not None
+                    else torch.zeros(
+                        (len(s.rows), vocab_size), dtype=dtype, device=device
+                    )
+                    for s, st in zip(samplers, states)
+                ]
+            )
+
+        return cls(
+            rows,
+            cat_state("seen", torch.bool),
+            cat_state("counts", torch.float32),
+            device,
+        )
+
+    def index_select(self, keep: List[int]):
+        """Return a sampler of the rows in `keep`."""
+        index = torch.as_tensor(keep, device=self.device)
+        return Sampler(
+            [self.rows[i] for i in keep],
+            None if self.seen is None else self.seen.index_select(0, index),
+            None if self.counts is None else self.counts.index_select(0, index),
+            self.device,
+        )
+
+    def __call__(self, logits):
+        """Return the next token of each row as a tensor on the device."""
+        logits = logits.float()
+        if self.seen is not None:
+            penalty = self.repetition_penalty
+            penalized = torch.where(logits > 0, logits / penalty, logits * penalty)
+            logits = torch.where(self.seen, penalized, logits)
+        if self.counts is not None:
+            logits = logits - self.frequency_penalty * self.counts
+
+        if self.all_greedy:
+            tokens = torch.argmax(logits, dim=-1)
+        else:
+            tokens = self.sample(logits / self.temperature)
+            if self.any_greedy:
+                tokens = torch.where(self.greedy, torch.argmax(logits, dim=-1), tokens)
+
+        if self.seen is not None:
+            self.seen.scatter_(1, tokens.unsqueeze(1), True)
+        if self.counts is not None:
+            self.counts.scatter_add_(
+                1, tokens.unsqueeze(1), self.counts.new_ones((len(self.rows), 1))
+            )
+        return tokens
+
+    def sample(self, logits):
+        if not self.any_top_k_top_p:
+            return sample_from_probs(torch.softmax(logits, dim=-1))
+
+        values, ids, mass = self.get_candidates(logits)
+        probs = self.filter_candidates(values, mass)
+        return ids.gather(1, sample_from_probs(probs).unsqueeze(1)).squeeze(1)
+
+    def get_probs(self, logits):
+        """Return the distributions that sampling draws from, as [batch, vocab].
+
+        The penalties are not applied. A sampler of one row also applies to
+        logits of several positions of that row.
+        """
+        logits = logits.float() / self.temperature
+        if not self.any_top_k_top_p:
+            return torch.softmax(logits, dim=-1)
+        values, ids, mass = self.get_candidates(logits)
+        probs = self.filter_candidates(values, mass)
+        probs = probs / probs.sum(dim=-1, keepdim=True)
+        return torch.zeros_like(logits).scatter_(-1, ids, probs)
+
+    def filter_candidates(self, values, mass):
+        """Return the unnormalized probabilities of the candidates to keep."""
+        # top-k and then top-p, like the warpers of transformers, so top-p is
+        # relative to the probability of the top-k candidates.
+        ranks = torch.arange(values.shape[-1], device=values.device)
+        values = values.masked_fill(ranks.unsqueeze(0) >= self.top_k, -float("inf"))
+        probs = torch.softmax(values, dim=-1)
+        # Keep the smallest set of candidates whose probability reaches top_p.
+        remove = (probs.cumsum(dim=-1) - probs) * mass > self.top_p
+        return probs.masked_fill(remove, 0.0)
+
+    def get_candidates(self, logits):
+        """Return the candidate logits and ids of each row in descending order,
+        and the share of the probability of the row the candidates hold."""
+        vocab_size = logits.shape[-1]
+        if self.all_top_k and self.max_top_k < vocab_size:
+            values, ids = torch.topk(logits, self.max_top_k, dim=-1)
+            return values, ids, 1.0
+
+        if logits.device.type == "cpu":
+            # Sorting the vocabulary is slow on the CPU, while the head of the
+            # vocabulary usually holds the top-p probability. Checking that
+            # costs no device sync here.
+            k = min(max(NUM_CPU_CANDIDATES, self.max_top_k), vocab_size)
+            values, ids = torch.topk(logits, k, dim=-1)
+            mass = torch.exp(
+                torch.logsumexp(values, dim=-1, keepdim=True)
+                - torch.logsumexp(logits, dim=-1, keepdim=True)
+            )
+            # Rows with a top-k renormalize within it.
+            mass = torch.where(self.has_top_k, 1.0, mass)
+            covered = self.greedy.unsqueeze(1) | self.has_top_k | (mass > self.top_p)
+            if bool(covered.all()):
+                return values, ids, mass
+
+        values, ids = torch.sort(logits, dim=-1, descending=True)
+        return values, ids, 1.0
+
+
+def sample_from_probs(probs):
+    """Draw one index per row of unnormalized `probs` by inverting the CDF.
+
+    This needs one random number per row, which is much cheaper than
+    `torch.multinomial` over a large vocabulary on the CPU.
+    """
+    cdf = probs.cumsum(dim=-1)
+    u = torch.rand((probs.shape[0], 1), device=probs.device) * cdf[:, -1:]
+    # The first index whose cdf exceeds u never has a zero probability.
+    index = torch.searchsorted(cdf, u, right=True).squeeze(1)
+    return index.clamp(max=probs.shape[-1] - 1)
@@ -1,12 +1,41 @@
+import time
+
 import torch
 from typing import List, Tuple
 
+from fastchat.protocol.worker_stream import get_usage
+
+
+def count_prompt_tokens(model, tokenizer, query, history):
+    """Count the tokens of the prompt that `model.stream_chat` builds from
+    the query and the history of (query, response) pairs."""
+    if hasattr(model, "build_inputs"):
+        # Newer versions of the remote code build the inputs in one place.
+        return model.build_inputs(tokenizer, query, history)["input_ids"].shape[-1]
+
+    # The prompt of ChatGLM-6B
+    if not history:
+        prompt = query
+    else:
+        prompt = ""
+        for i, (old_query, response) in enumerate(history):
+            prompt += "[Round {}]\n问：{}\n答：{}\n".format(i, old_query, response)
+        prompt += "[Round {}]\n问：{}\n答：".format(len(history), query)
+    return len(tokenizer(prompt).input_ids)
+
 
 @torch.inference_mode()
 def chatglm_generate_stream(
-    model, tokenizer, params, device, context_len=2048, stream_interval=2
+    model,
+    tokenizer,
+    params,
+    device,
+    context_len=2048,
+    stream_interval=2,
+    abort_event=None,
 ):
     """Generate text using model's chat api"""
+    start_time = time.time()
     messages = params["prompt"]
     max_new_tokens = int(params.get("max_new_tokens", 256))
     temperature = float(params.get("temperature", 1.0))
@@ -25,6 +54,30 @@ def chatglm_generate_stream(
         hist.append((messages[i][1], messages[i + 1][1]))
     query = messages[-2][1]
 
+    echo = params.get("echo", True)
+
+    first_token_time = None
+    response = ""
     for response, new_hist in model.stream_chat(tokenizer, query, hist):
-        output = query + " " + response
-        yield output
+        if abort_event is not None and abort_event.is_set():
+            return
+        if first_token_time is None:
+            first_token_time = time.time()
+        output = query + " " + response if echo else response
+        yield {"text": output, "usage": None, "finish_reason": None}
+
+    if first_token_time is None:
+        # Nothing was generated.
+        first_token_time = time.time()
+
+    # The chat api does not report token counts, so count the tokens of the
+    # prompt and the response once at the end.
+    prompt_tokens = count_prompt_tokens(model, tokenizer, query, hist)
+    completion_tokens = len(tokenizer(response, add_special_tokens=False).input_ids)
+    yield {
+        "text": query + " " + response if echo else response,
+        "usage": get_usage(
+            prompt_tokens, completion_tokens, start_time, first_token_time, True
+        ),
+        "finish_reason": "stop",
+    }
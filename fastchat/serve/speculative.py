@@ -0,0 +1,176 @@
+"""
+Speculative decoding with a small draft model.
+
+Decoding one token at a time is bound by reading the weights of the target
+model. A draft model that shares its tokenizer proposes a few tokens, and the
+target model scores all of them in one forward pass. The proposals are kept up
+to the first one the target disagrees with, and the kv caches of both models
+are rolled back to the kept tokens.
+
+With greedy decoding a proposal is kept when it equals the argmax of the
+target, so the output is the same as decoding with the target alone. Otherwise
+proposals are accepted with probability min(1, p / q) and a rejected one is
+resampled from max(p - q, 0), which samples exactly from the distribution of
+the target (Leviathan et al., 2023).
+"""
+import torch
+from torch.nn import functional as F
+
+from fastchat.serve.kv_cache import slice_past_key_values
+from fastchat.serve.sampling import Sampler, SamplingParams, sample_from_probs
+
+
+class SpeculativeDecoder:
+    """Generate the tokens of one sequence with a target and a draft model.
+
+    `prefill` returns the first token. Each `step` then returns between one
+    and `num_speculative_tokens + 1` tokens.
+    """
+
+    def __init__(
+        self,
+        model,
+        draft_model,
+        params: SamplingParams,
+        device,
+        num_speculative_tokens=4,
+    ):
+        if params.has_penalties:
+            raise ValueError("Speculative decoding does not support penalties.")
+        self.model = model
+        self.draft_model = draft_model
+        self.params = params
+        self.device = device
+        # Switch to CPU by avoiding some bugs in mps backend.
+        self.sampling_device = "cpu" if device == "mps" else device
+        self.sampler = Sampler.create([params], [[]], 0, self.sampling_device)
+        self.num_speculative_tokens = num_speculative_tokens
+        self.vocab_size = None
+
+        # The target kv covers all tokens except `last_token`. The draft kv
+        # covers all tokens except `draft_pending`, which ends with it.
+        self.past_key_values = None
+        self.last_token = None
+        self.draft_past_key_values = None
+        self.draft_pending = []
+
+        self.num_proposed = 0
+        self.num_accepted = 0
+
+    def prefill(self, input_ids, prefix_len=0, past_key_values=None):
+        """Prefill both models and return the first token.
+
+        The target may reuse the kv of the first `prefix_len` tokens.
+        """
+        out = self.model(
+            torch.as_tensor([input_ids[prefix_len:]], device=self.device),
+            use_cache=True,
+            past_key_values=past_key_values,
+        )
+        self.past_key_values = out.past_key_values
+        logits = out.logits[:, -1, :].to(self.sampling_device)
+        self.vocab_size = logits.shape[-1]
+        token = int(self.sample(logits))
+
+        draft_out = self.draft_model(
+            torch.as_tensor([input_ids], device=self.device), use_cache=True
+        )
+        self.draft_past_key_values = draft_out.past_key_values
+        self.last_token = token
+        self.draft_pending = [token]
+        return token
+
+    def step(self, max_tokens):
+        """Propose, verify and return at most `max_tokens` (>= 1) new tokens."""
+        k = min(self.num_speculative_tokens, max_tokens - 1)
+        draft_len = self.draft_past_key_values[0][0].shape[2]
+        proposal, draft_probs = self.propose(k)
+
+        target_len = self.past_key_values[0][0].shape[2]
+        last_token = torch.as_tensor([self.last_token], device=self.sampling_device)
+        out = self.model(
+            input_ids=torch.cat([last_token, proposal]).unsqueeze(0).to(self.device),
+            use_cache=True,
+            past_key_values=self.past_key_values,
+        )
+        logits = out.logits[0].to(self.sampling_device)
+        num_accepted, corrections = self.verify(logits, proposal, draft_probs)
+        # The only host sync of the step
+        values = torch.cat([proposal, corrections, num_accepted.view(1)]).tolist()
+        proposal, corrections, n = values[:k], values[k:-1], values[-1]
+        tokens = proposal[:n] + [corrections[n]]
+
+        self.past_key_values = slice_past_key_values(
+            out.past_key_values, target_len + 1 + n
+        )
+        self.last_token = tokens[-1]
+        if k > 0:
+            # The draft has not seen its last proposal.
+            fed = len(self.draft_pending) + min(n, k - 1)
+            self.draft_past_key_values = slice_past_key_values(
+                self.draft_past_key_values, draft_len + fed
+            )
+            self.draft_pending = tokens[min(n, k - 1) :]
+        else:
+            self.draft_pending.append(self.last_token)
+
+        self.num_proposed += k
+        self.num_accepted += n
+        return tokens
+
+    def propose(self, k):
+        """Sample `k` tokens from the draft model, without a host sync."""
+        tokens, probs = [], []
+        input_ids = torch.as_tensor([self.draft_pending], device=self.device)
+        for _ in range(k):
+            out = self.draft_model(
+                input_ids=input_ids,
+                use_cache=True,
+                past_key_values=self.draft_past_key_values,
+            )
+            self.draft_past_key_values = out.past_key_values
+            logits = self.align_vocab(out.logits[:, -1, :].to(self.sampling_device))
+            if self.params.greedy:
+                token = torch.argmax(logits, dim=-1)
+            else:
+                probs.append(self.sampler.get_probs(logits))
+                token = sample_from_probs(probs[-1])
+            tokens.append(token)
+            input_ids = token.view(1, 1).to(self.device)
+
+        if not tokens:
+            return torch.zeros((0,), dtype=torch.long, device=self.sampling_device), []
+        return torch.cat(tokens), probs
+
+    def verify(self, logits, proposal, draft_probs):
+        """Return the number of accepted proposals and a next token for each
+        possible number of accepted proposals."""
+        k = len(proposal)
+        if self.params.greedy:
+            targets = torch.argmax(logits, dim=-1)
+            matches = (proposal == targets[:k]).long()
+            return matches.cumprod(dim=0).sum(), targets
+
+        p = self.sampler.get_probs(logits)
+        if k == 0:
+            return torch.zeros((), dtype=torch.long), sample_from_probs(p)
+        q = torch.cat(draft_probs)
+        rows = torch.arange(k, device=p.device)
+        p_proposed, q_proposed = p[rows, proposal], q[rows, proposal]
+        # Accept with probability min(1, p / q).
+        u = torch.rand(k, device=p.device)
+        accepted = (u * q_proposed < p_proposed).long()
+        residual = torch.cat([(p[:k] - q).clamp(min=0), p[k:]])
+        return accepted.cumprod(dim=0).sum(), sample_from_probs(residual)
+
+    def align_vocab(self, logits):
+        """Match the draft logits to the vocabulary of the target."""
+        diff = self.vocab_size - logits.shape[-1]
+        if diff > 0:
+            return F.pad(logits, (0, diff), value=-float("inf"))
+        return logits[:, : self.vocab_size]
+
+    def sample(self, logits):
+        if self.params.greedy:
+            return torch.argmax(logits, dim=-1)
+        return sample_from_probs(self.sampler.get_probs(logits))
@@ -0,0 +1,147 @@
+"""Benchmark the per-request overhead of the API server with a stub worker.
+
+A stub process serves both the controller and the worker endpoints and returns
+a short completion at once, so the measured latency is the proxy overhead of
+fastchat.serve.api. Requests are sent both to the stub worker directly and
+through the API server.
+
+Usage:
+python3 -m fastchat.serve.test_api_overhead --n-request 2000 --concurrency 64
+python3 -m fastchat.serve.test_api_overhead --worker-address-ttl 0
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+from fastapi import FastAPI
+from fastapi.responses import Response
+import httpx
+import numpy as np
+import uvicorn
+
+
+def run_stub(port):
+    app = FastAPI()
+    address = f"http://localhost:{port}"
+
+    @app.post("/list_workers")
+    async def list_workers():
+        return {"addresses": [address], "speeds": [1], "registry_version": 1}
+
+    @app.post("/get_worker_address")
+    async def get_worker_address():
+        return {"address": address}
+
+    @app.post("/worker_generate_stream")
+    async def generate_stream():
+        ret = {
+            "text": "Hello! How can I help you today?",
+            "error_code": 0,
+            "usage": {"prompt_tokens": 32, "completion_tokens": 9, "total_tokens": 41},
+            "finish_reason": "stop",
+            "index": 0,
+            "stream_version": 2,
+        }
+        return Response(json.dumps(ret).encode() + b"\0")
+
+    uvicorn.run(app, host="localhost", port=port, log_level="warning")
+
+
+async def send_request(client, url, body):
+    tik = time.time()
+    ret = await client.post(url, json=body, timeout=60)
+    assert ret.status_code == 200, ret.text
+    return time.time() - tik
+
+
+async def run_load(url, body, n_request, concurrency):
+    limits = httpx.Limits(max_connections=None)
+    async with httpx.AsyncClient(limits=limits) as client:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def bounded():
+            async with semaphore:
+                return await send_request(client, url, body)
+
+        # Warm up the connections.
+        await asyncio.gather(*[bounded() for _ in range(concurrency)])
+        tik = time.time()
+        latencies = await asyncio.gather(*[bounded() for _ in range(n_request)])
+        elapsed = time.time() - tik
+    return np.array(latencies) * 1e3, n_request / elapsed
+
+
+def report(name, latencies, qps):
+    print(
+        f"{name}: {qps:.0f} req/s, latency mean: {latencies.mean():.2f} ms, "
+        f"p50: {np.percentile(latencies, 50):.2f} ms, "
+        f"p99: {np.percentile(latencies, 99):.2f} ms"
+    )
+
+
+def main(args):
+    stub = multiprocessing.Process(target=run_stub, args=(args.stub_port,))
+    stub.start()
+    env = dict(
+        os.environ,
+        FASTCHAT_CONTROLLER_URL=f"http://localhost:{args.stub_port}",
+        FASTCHAT_WORKER_ADDRESS_TTL=str(args.worker_address_ttl),
+    )
+    api = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", args.api_app]
+        + ["--port", str(args.api_port), "--log-level", "warning"],
+        env=env,
+    )
+    try:
+        time.sleep(5)
+        worker_body = {"prompt": "Hello", "stop": "###", "stream_version": 2}
+        latencies, qps = asyncio.run(
+            run_load(
+                f"http://localhost:{args.stub_port}/worker_generate_stream",
+                worker_body,
+                args.n_request,
+                args.concurrency,
+            )
+        )
+        report("direct", latencies, qps)
+        direct = latencies.mean()
+
+        api_body = {
+            "model": "vicuna-7b",
+            "messages": [{"role": "user", "content": "Hello"}],
+        }
+        latencies, qps = asyncio.run(
+            run_load(
+                f"http://localhost:{args.api_port}/v1/chat/completions",
+                api_body,
+                args.n_request,
+                args.concurrency,
+            )
+        )
+        report("api", latencies, qps)
+        print(f"proxy overhead per request: {latencies.mean() - direct:.2f} ms")
+    finally:
+        api.terminate()
+        stub.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stub-port", type=int, default=31001)
+    parser.add_argument("--api-port", type=int, default=31000)
+    parser.add_argument("--api-app", type=str, default="fastchat.serve.api:app")
+    parser.add_argument("--n-request", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument(
+        "--worker-address-ttl",
+        type=float,
+        default=2.0,
+        help="Seconds the API server caches worker addresses. 0 disables it.",
+    )
+    args = parser.parse_args()
+    main(args)
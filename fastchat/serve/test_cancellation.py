@@ -0,0 +1,197 @@
+"""Count the tokens generated for clients that already disconnected.
+
+A worker serves a fake model that sleeps `--step-time` per forward pass and
+never stops before `--max-new-tokens`. Clients read a few chunks of a
+completion and disconnect, directly from the worker and through the
+controller. Tokens generated after the last client left are wasted, and the
+worker should report an empty queue once they are aborted.
+
+Usage:
+python3 -m fastchat.serve.test_cancellation
+python3 -m fastchat.serve.test_cancellation --continuous-batching --n-client 8
+"""
+import argparse
+import asyncio
+import multiprocessing
+import threading
+import time
+from types import SimpleNamespace
+
+import httpx
+import torch
+import uvicorn
+
+
+class FakeTokenizer:
+    eos_token_id = 0
+
+    def __call__(self, text):
+        return SimpleNamespace(input_ids=[1 + ord(c) % 26 for c in text])
+
+    def decode(self, ids, skip_special_tokens=True):
+        return "".join(chr(ord("a") + (i - 1) % 26) for i in ids if i != 0)
+
+
+class FakeSlowModel(torch.nn.Module):
+    """Sleep per forward pass and count the generated tokens."""
+
+    def __init__(self, step_time, context_len, vocab_size=32):
+        super().__init__()
+        self.config = SimpleNamespace(
+            is_encoder_decoder=False, max_position_embeddings=context_len
+        )
+        self.step_time = step_time
+        self.vocab_size = vocab_size
+        self.num_tokens = 0
+        self.lock = threading.Lock()
+
+    def forward(
+        self,
+        input_ids,
+        past_key_values=None,
+        attention_mask=None,
+        position_ids=None,
+        use_cache=True,
+    ):
+        time.sleep(self.step_time)
+        batch_size, seq_len = input_ids.shape
+        with self.lock:
+            self.num_tokens += batch_size
+
+        kv = torch.zeros((batch_size, 1, seq_len, 1))
+        if past_key_values is not None:
+            kv = torch.cat([past_key_values[0][0], kv], dim=2)
+        logits = torch.zeros((batch_size, seq_len, self.vocab_size))
+        logits[..., FakeTokenizer.eos_token_id] = -float("inf")
+        logits[..., 1] = 1
+        return SimpleNamespace(logits=logits, past_key_values=((kv, kv),))
+
+
+def run_worker(port, args):
+    from fastchat.serve import model_worker
+
+    model = FakeSlowModel(args.step_time, args.max_new_tokens + 64)
+    model_worker.load_model = lambda *_, **__: (model, FakeTokenizer())
+    model_worker.args = SimpleNamespace(
+        limit_model_concurrency=args.n_client,
+        max_queue_size=64,
+        queue_timeout=60,
+        stream_interval=args.stream_interval,
+    )
+    model_worker.worker = model_worker.ModelWorker(
+        None,
+        f"http://localhost:{port}",
+        "fake",
+        True,
+        "fake",
+        "fake",
+        "cpu",
+        1,
+        None,
+        continuous_batching=args.continuous_batching,
+        max_batch_size=args.n_client,
+    )
+
+    @model_worker.app.post("/fake_num_tokens")
+    async def fake_num_tokens():
+        return {"num_tokens": model.num_tokens}
+
+    uvicorn.run(model_worker.app, host="localhost", port=port, log_level="warning")
+
+
+def run_controller(port):
+    from fastchat.serve import controller
+
+    controller.controller = controller.Controller("shortest_queue")
+    uvicorn.run(controller.app, host="localhost", port=port, log_level="warning")
+
+
+async def read_and_disconnect(client, url, payload, num_chunks):
+    async with client.stream("POST", url, json=payload, timeout=60) as response:
+        received = 0
+        async for raw in response.aiter_raw():
+            received += raw.count(b"\0")
+            if received >= num_chunks:
+                break
+    # Leaving the block closes the connection before the completion ends.
+
+
+async def run_round(client, name, url, worker_url, args):
+    payload = {
+        "model": "fake",
+        "prompt": "Tell me a long story.",
+        "temperature": 0.0,
+        "max_new_tokens": args.max_new_tokens,
+        "stream_version": 2,
+    }
+    await asyncio.gather(
+        *[
+            read_and_disconnect(client, url, payload, args.num_chunks)
+            for _ in range(args.n_client)
+        ]
+    )
+    ret = await client.post(worker_url + "/fake_num_tokens")
+    num_tokens = ret.json()["num_tokens"]
+    # Any generation still running finishes well within this time.
+    await asyncio.sleep(args.max_new_tokens * args.step_time + 1)
+    ret = await client.post(worker_url + "/fake_num_tokens")
+    wasted = ret.json()["num_tokens"] - num_tokens
+    ret = await client.post(worker_url + "/worker_get_status")
+    queue_length = ret.json()["queue_length"]
+    print(
+        f"{name:>10}: wasted tokens after disconnect: {wasted} "
+        f"(at most {args.max_new_tokens * args.n_client}), "
+        f"queue length: {queue_length}"
+    )
+
+
+async def main(args):
+    worker_url = f"http://localhost:{args.port}"
+    controller_url = f"http://localhost:{args.port + 1}"
+    async with httpx.AsyncClient() as client:
+        ret = await client.post(worker_url + "/worker_get_status")
+        await client.post(
+            controller_url + "/register_worker",
+            json={
+                "worker_name": worker_url,
+                "check_heart_beat": False,
+                "worker_status": ret.json(),
+            },
+        )
+        for name, url in [
+            ("worker", worker_url + "/worker_generate_stream"),
+            ("controller", controller_url + "/worker_generate_stream"),
+        ]:
+            await run_round(client, name, url, worker_url, args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=21102)
+    parser.add_argument("--n-client", type=int, default=4)
+    parser.add_argument("--step-time", type=float, default=0.02)
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--stream-interval", type=int, default=2)
+    parser.add_argument(
+        "--num-chunks",
+        type=int,
+        default=4,
+        help="The number of chunks a client reads before it disconnects.",
+    )
+    parser.add_argument("--continuous-batching", action="store_true")
+    args = parser.parse_args()
+
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(args.port, args), daemon=True),
+        multiprocessing.Process(
+            target=run_controller, args=(args.port + 1,), daemon=True
+        ),
+    ]
+    for p in processes:
+        p.start()
+    time.sleep(5)
+    try:
+        asyncio.run(main(args))
+    finally:
+        for p in processes:
+            p.terminate()
@@ -0,0 +1,72 @@
+"""Benchmarking script to compare the accuracy and speed of quantized linear layers.
+
+Usage:
+python3 -m fastchat.serve.test_compression_speed --device cpu
+"""
+import argparse
+import time
+
+import torch
+from torch import nn
+
+from fastchat.serve.compression import CLinear, QLinear, TileCache
+
+
+@torch.inference_mode()
+def benchmark(layer, x, repeat):
+    layer(x)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    tik = time.time()
+    for _ in range(repeat):
+        y = layer(x)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    return y, (time.time() - tik) / repeat
+
+
+@torch.inference_mode()
+def main(args):
+    dtype = torch.float16 if args.device == "cuda" else torch.float32
+    # The shapes of the attention and MLP projections of LLaMA-7B.
+    shapes = [(4096, 4096), (11008, 4096), (4096, 11008)]
+
+    for out_features, in_features in shapes:
+        linear = nn.Linear(in_features, out_features, bias=False)
+        linear = linear.to(args.device, dtype)
+        layers = {
+            "fp": linear,
+            "CLinear int8": CLinear(linear.weight, linear.bias, args.device),
+            "QLinear int8": QLinear(linear.weight, linear.bias, args.device, 8),
+            "QLinear int4": QLinear(linear.weight, linear.bias, args.device, 4),
+            "QLinear int8 + tile cache": QLinear(
+                linear.weight,
+                linear.bias,
+                args.device,
+                8,
+                tile_cache=TileCache(1 << 40),
+            ),
+        }
+
+        for batch_size in [1, args.batch_size]:
+            x = torch.randn(batch_size, 1, in_features, device=args.device, dtype=dtype)
+            ref, _ = benchmark(linear, x, 1)
+            print(f"== shape: {(out_features, in_features)}, batch: {batch_size} ==")
+            for name, layer in layers.items():
+                y, latency = benchmark(layer, x, args.repeat)
+                error = ((y - ref).float().norm() / ref.float().norm()).item()
+                print(
+                    f"{name:28s} latency: {latency * 1e3:8.3f} ms, "
+                    f"relative error: {error:.5f}"
+                )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--device", type=str, choices=["cpu", "cuda", "mps"], default="cpu"
+    )
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,122 @@
+"""Load test of the controller relay with stub workers.
+
+The stub workers stream fixed chunks without running a model, so the measured
+throughput is the relay overhead of the controller.
+
+Usage:
+python3 -m fastchat.serve.controller
+python3 -m fastchat.serve.test_controller_relay --num-workers 4 --n-stream 256
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+import httpx
+import requests
+import uvicorn
+
+
+def build_stub_worker(num_chunks, chunk_interval):
+    app = FastAPI()
+
+    @app.post("/worker_get_status")
+    async def get_status():
+        return {"model_names": ["stub"], "speed": 1, "queue_length": 0}
+
+    @app.post("/worker_generate_stream")
+    async def generate_stream():
+        async def generator():
+            text = ""
+            for i in range(num_chunks):
+                text += " token"
+                yield json.dumps({"text": text, "error_code": 0}).encode() + b"\0"
+                if chunk_interval:
+                    await asyncio.sleep(chunk_interval)
+
+        return StreamingResponse(generator())
+
+    return app
+
+
+def start_stub_workers(args):
+    worker_addrs = []
+    for i in range(args.num_workers):
+        port = args.worker_base_port + i
+        app = build_stub_worker(args.num_chunks, args.chunk_interval)
+        server = uvicorn.Server(
+            uvicorn.Config(app, host="localhost", port=port, log_level="warning")
+        )
+        threading.Thread(target=server.run, daemon=True).start()
+        worker_addrs.append(f"http://localhost:{port}")
+
+    time.sleep(2)
+    for worker_addr in worker_addrs:
+        ret = requests.post(
+            args.controller_address + "/register_worker",
+            json={"worker_name": worker_addr, "check_heart_beat": False},
+        )
+        assert ret.status_code == 200
+    return worker_addrs
+
+
+async def send_stream(client, controller_addr):
+    num_chunks = 0
+    num_bytes = 0
+    async with client.stream(
+        "POST",
+        controller_addr + "/worker_generate_stream",
+        json={"model": "stub", "prompt": "Hello"},
+        timeout=60,
+    ) as response:
+        async for data in response.aiter_bytes():
+            num_chunks += data.count(b"\0")
+            num_bytes += len(data)
+    return num_chunks, num_bytes
+
+
+async def run_load(args):
+    limits = httpx.Limits(max_connections=None)
+    async with httpx.AsyncClient(limits=limits) as client:
+        tik = time.time()
+        results = await asyncio.gather(
+            *[
+                send_stream(client, args.controller_address)
+                for _ in range(args.n_stream)
+            ]
+        )
+        elapsed = time.time() - tik
+
+    num_chunks = sum(r[0] for r in results)
+    num_bytes = sum(r[1] for r in results)
+    print(
+        f"streams: {args.n_stream}, time: {elapsed:.2f} s, "
+        f"chunks/s: {num_chunks / elapsed:.1f}, "
+        f"MB/s: {num_bytes / elapsed / 1e6:.2f}"
+    )
+    if num_chunks != args.n_stream * args.num_chunks:
+        print(f"missing chunks: {args.n_stream * args.num_chunks - num_chunks}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--controller-address", type=str, default="http://localhost:21001"
+    )
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--worker-base-port", type=int, default=31000)
+    parser.add_argument("--n-stream", type=int, default=256)
+    parser.add_argument("--num-chunks", type=int, default=128)
+    parser.add_argument(
+        "--chunk-interval",
+        type=float,
+        default=0.01,
+        help="Seconds between two chunks of a stub worker.",
+    )
+    args = parser.parse_args()
+
+    start_stub_workers(args)
+    asyncio.run(run_load(args))
@@ -0,0 +1,79 @@
+"""Benchmarking script to compare full re-decoding with incremental detokenization.
+
+Usage:
+python3 -m fastchat.serve.test_detokenize_speed --model-path ~/model_weights/vicuna-7b
+"""
+import argparse
+import time
+
+from transformers import AutoTokenizer
+
+from fastchat.conversation import get_default_conv_template
+from fastchat.serve.inference import decode_incrementally
+
+
+def full_decode(tokenizer, prompt_ids, new_ids, stream_interval, stop_str):
+    output_ids = list(prompt_ids)
+    l_prompt = len(tokenizer.decode(prompt_ids, skip_special_tokens=True))
+    for i, token in enumerate(new_ids):
+        output_ids.append(token)
+        if i % stream_interval == 0 or i == len(new_ids) - 1:
+            output = tokenizer.decode(output_ids, skip_special_tokens=True)
+            output.rfind(stop_str, l_prompt)
+    return output
+
+
+def incremental_decode(tokenizer, prompt_ids, new_ids, stream_interval, stop_str):
+    output_ids = list(prompt_ids)
+    prompt_output = tokenizer.decode(output_ids, skip_special_tokens=True)
+    generated_output = ""
+    prefix_offset = max(len(output_ids) - 5, 0)
+    read_offset = len(output_ids)
+    for i, token in enumerate(new_ids):
+        output_ids.append(token)
+        if i % stream_interval == 0 or i == len(new_ids) - 1:
+            new_text, prefix_offset, read_offset = decode_incrementally(
+                tokenizer, output_ids, prefix_offset, read_offset
+            )
+            search_start = max(len(generated_output) - len(stop_str) + 1, 0)
+            generated_output += new_text
+            generated_output.find(stop_str, search_start)
+            output = prompt_output + generated_output
+    return output
+
+
+def main(args):
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path, use_fast=False)
+
+    # Build a long multi-turn prompt and a synthetic stream of new tokens.
+    conv = get_default_conv_template(args.model_path).copy()
+    turn = "Tell me a story about a llama who learns to program. " * 8
+    while len(tokenizer(conv.get_prompt()).input_ids) < args.prompt_len:
+        conv.append_message(conv.roles[0], turn)
+        conv.append_message(conv.roles[1], turn)
+    prompt_ids = tokenizer(conv.get_prompt()).input_ids[-args.prompt_len :]
+    new_ids = tokenizer(turn * 64).input_ids[1 : args.max_new_tokens + 1]
+
+    for name, func in [("full", full_decode), ("incremental", incremental_decode)]:
+        tik = time.time()
+        output = func(tokenizer, prompt_ids, new_ids, args.stream_interval, conv.sep)
+        elapsed = time.time() - tik
+        print(
+            f"{name}: {len(new_ids) / elapsed:.1f} tokens/s, "
+            f"output chars: {len(output)}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model-path",
+        type=str,
+        default="facebook/opt-350m",
+        help="The path to the tokenizer",
+    )
+    parser.add_argument("--prompt-len", type=int, default=1536)
+    parser.add_argument("--max-new-tokens", type=int, default=512)
+    parser.add_argument("--stream-interval", type=int, default=2)
+    args = parser.parse_args()
+    main(args)
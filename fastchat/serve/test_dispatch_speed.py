@@ -0,0 +1,63 @@
+"""Benchmarking script to test the dispatch speed of the controller.
+
+It builds a synthetic registry in-process and measures how many
+`get_worker_address` calls the controller can serve per second.
+
+Usage:
+python3 -m fastchat.serve.test_dispatch_speed --num-workers 200 --num-models 30
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from fastchat.serve.controller import Controller
+
+
+def build_registry(controller, args):
+    for i in range(args.num_workers):
+        worker_status = {
+            "model_names": [f"model-{i % args.num_models}"],
+            "speed": random.randint(1, 4),
+            "queue_length": random.randint(0, 8),
+        }
+        asyncio.run(
+            controller.register_worker(f"http://worker-{i}:21002", True, worker_status)
+        )
+
+
+def main(args):
+    for dispatch_method in ["lottery", "shortest_queue"]:
+        controller = Controller(dispatch_method)
+        build_registry(controller, args)
+        worker_names = list(controller.worker_info)
+        model_names = controller.list_models()
+
+        tik = time.time()
+        for i in range(args.num_requests):
+            worker_name = controller.get_worker_address(random.choice(model_names))
+            assert worker_name
+            if i % args.heart_beat_every == 0:
+                controller.receive_heart_beat(
+                    random.choice(worker_names), random.randint(0, 8)
+                )
+        elapsed = time.time() - tik
+        print(
+            f"{dispatch_method}: {args.num_requests / elapsed:.0f} requests/s, "
+            f"{elapsed / args.num_requests * 1e6:.2f} us/request"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-workers", type=int, default=200)
+    parser.add_argument("--num-models", type=int, default=30)
+    parser.add_argument("--num-requests", type=int, default=100000)
+    parser.add_argument(
+        "--heart-beat-every",
+        type=int,
+        default=10,
+        help="Interleave one heart beat every this many requests.",
+    )
+    args = parser.parse_args()
+    main(args)
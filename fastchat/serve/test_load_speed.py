@@ -0,0 +1,61 @@
+"""Benchmarking script to compare the startup time and peak RSS of load_model.
+
+Each checkpoint is loaded in a fresh process, so that the peak RSS of one run
+does not hide the other. Two forward passes of the same input must also give
+the same logits, which fails if dropout is left on.
+
+Usage:
+python3 -m fastchat.model.convert_safetensors --in ~/model_weights/vicuna-7b --out ~/model_weights/vicuna-7b-safetensors
+python3 -m fastchat.serve.test_load_speed --model-paths ~/model_weights/vicuna-7b ~/model_weights/vicuna-7b-safetensors
+"""
+import argparse
+import multiprocessing
+import time
+
+import torch
+
+from fastchat.serve.inference import load_model
+from fastchat.serve.safetensors_loader import get_peak_rss
+
+GB = 1 << 30
+
+
+@torch.inference_mode()
+def is_deterministic(model):
+    input_ids = torch.arange(1, 17, device=model.device).unsqueeze(0)
+    return torch.equal(model(input_ids).logits, model(input_ids).logits)
+
+
+def load(args, model_path, results):
+    tik = time.time()
+    model, _ = load_model(
+        model_path, args.device, args.num_gpus, load_8bit=args.load_8bit
+    )
+    elapsed, peak_rss = time.time() - tik, get_peak_rss()
+    results.put((elapsed, peak_rss, is_deterministic(model)))
+
+
+def main(args):
+    ctx = multiprocessing.get_context("spawn")
+    for model_path in args.model_paths:
+        results = ctx.Queue()
+        proc = ctx.Process(target=load, args=(args, model_path, results))
+        proc.start()
+        elapsed, peak_rss, deterministic = results.get()
+        proc.join()
+        print(
+            f"{model_path}: startup: {elapsed:.2f} s, "
+            f"peak RSS: {peak_rss / GB:.2f} GB, deterministic: {deterministic}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-paths", type=str, nargs="+", required=True)
+    parser.add_argument(
+        "--device", type=str, choices=["cpu", "cuda", "mps"], default="cuda"
+    )
+    parser.add_argument("--num-gpus", type=str, default="1")
+    parser.add_argument("--load-8bit", action="store_true")
+    args = parser.parse_args()
+    main(args)
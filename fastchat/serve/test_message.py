@@ -1,5 +1,4 @@
 import argparse
-import json
 
 import requests
 
@@ -8,6 +7,7 @@ from fastchat.conversation import (
     compute_skip_echo_len,
     SeparatorStyle,
 )
+from fastchat.protocol.worker_stream import StreamDecoder, STREAM_VERSION
 
 
 def main():
@@ -44,6 +44,7 @@ def main():
         "max_new_tokens": args.max_new_tokens,
         "temperature": args.temperature,
         "stop": conv.sep if conv.sep_style == SeparatorStyle.SINGLE else conv.sep2,
+        "stream_version": STREAM_VERSION,
     }
     response = requests.post(
         worker_addr + "/worker_generate_stream",
@@ -53,13 +54,13 @@ def main():
     )
 
     print(f"{conv.roles[0]}: {args.message}")
+    decoder = StreamDecoder(compute_skip_echo_len(model_name, conv, prompt))
     for chunk in response.iter_lines(
         chunk_size=8192, decode_unicode=False, delimiter=b"\0"
     ):
         if chunk:
-            data = json.loads(chunk.decode("utf-8"))
-            skip_echo_len = compute_skip_echo_len(model_name, conv, prompt)
-            output = data["text"][skip_echo_len:].strip()
+            data = decoder.decode(chunk)
+            output = data["text"].strip()
             print(f"{conv.roles[1]}: {output}", end="\r")
     print("")
 
@@ -0,0 +1,104 @@
+"""Measure the per-token overhead of sampling on the CPU.
+
+Random logits that follow Zipf's law over a shuffled vocabulary stand in for
+the model, so only the logits processing, the sampling and the device-to-host
+copies are timed. The baseline samples with temperature only and copies the
+tokens to the host every step, like the previous decoding loops. The batched
+sampler also applies top-k, top-p and the penalties, and copies the tokens
+every `--stream-interval` steps.
+
+Usage:
+python3 -m fastchat.serve.test_sampling
+python3 -m fastchat.serve.test_sampling --batch-sizes 1 8 32 --vocab-size 32000
+"""
+import argparse
+import time
+
+import torch
+
+from fastchat.serve.sampling import Sampler, SamplingParams
+
+CONFIGS = {
+    "greedy": SamplingParams(temperature=0.0),
+    "temperature": SamplingParams(temperature=0.7),
+    "top-p": SamplingParams(temperature=0.7, top_p=0.9),
+    "top-k/top-p": SamplingParams(temperature=0.7, top_k=50, top_p=0.9),
+    "penalties": SamplingParams(
+        temperature=0.7, repetition_penalty=1.2, frequency_penalty=0.5
+    ),
+    "all": SamplingParams(
+        temperature=0.7,
+        top_k=50,
+        top_p=0.9,
+        repetition_penalty=1.2,
+        frequency_penalty=0.5,
+    ),
+}
+
+
+def sample_baseline(logits, temperature):
+    """Temperature sampling with a host sync per step."""
+    if temperature < 1e-4:
+        return torch.argmax(logits, dim=-1).tolist()
+    probs = torch.softmax(logits / temperature, dim=-1)
+    return torch.multinomial(probs, num_samples=1).squeeze(1).tolist()
+
+
+def get_logits(batch_size, vocab_size):
+    ranks = torch.stack([torch.randperm(vocab_size) for _ in range(batch_size)])
+    noise = torch.randn(batch_size, vocab_size) * 0.1
+    return -1.1 * torch.log(ranks + 1.0) + noise
+
+
+def time_per_token(fn, num_steps, batch_size):
+    fn(1)  # warm up
+    tic = time.perf_counter()
+    fn(num_steps)
+    return (time.perf_counter() - tic) / (num_steps * batch_size) * 1e6
+
+
+def main(args):
+    torch.manual_seed(0)
+    print(
+        f"{'batch':>5} {'config':>12} {'baseline us/token':>18} "
+        f"{'sampler us/token':>17}"
+    )
+    for batch_size in args.batch_sizes:
+        logits = [
+            get_logits(batch_size, args.vocab_size) for _ in range(args.num_steps)
+        ]
+        prompt_ids = torch.randint(args.vocab_size, (args.prompt_len,)).tolist()
+        for name, params in CONFIGS.items():
+
+            def run_baseline(num_steps):
+                for i in range(num_steps):
+                    sample_baseline(logits[i], params.temperature)
+
+            def run_sampler(num_steps):
+                sampler = Sampler.create(
+                    [params] * batch_size,
+                    [prompt_ids] * batch_size,
+                    args.vocab_size,
+                    "cpu",
+                )
+                pending = []
+                for i in range(num_steps):
+                    pending.append(sampler(logits[i]))
+                    if i % args.stream_interval == 0 or i == num_steps - 1:
+                        torch.stack(pending, dim=1).tolist()
+                        pending = []
+
+            baseline = time_per_token(run_baseline, args.num_steps, batch_size)
+            batched = time_per_token(run_sampler, args.num_steps, batch_size)
+            print(f"{batch_size:>5} {name:>12} {baseline:>18.1f} {batched:>17.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--vocab-size", type=int, default=32000)
+    parser.add_argument("--prompt-len", type=int, default=512)
+    parser.add_argument("--num-steps", type=int, default=200)
+    parser.add_argument("--stream-interval", type=int, default=2)
+    args = parser.parse_args()
+    main(args)
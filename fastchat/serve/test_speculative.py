@@ -0,0 +1,101 @@
+"""Compare normal and speculative decoding of the same prompts.
+
+Each prompt is decoded greedily with the target model alone and with a draft
+model. The script checks that the outputs are the same, and reports the time
+per token and the number of tokens per forward pass of the target.
+
+Usage:
+python3 -m fastchat.serve.test_speculative --model-path lmsys/vicuna-13b-v1.1 --draft-model-path /path/to/small/vicuna
+"""
+import argparse
+import time
+
+from fastchat.conversation import get_default_conv_template
+from fastchat.serve.inference import generate_stream, load_model
+
+PROMPTS = [
+    "Tell me a story about a robot that learns to paint.",
+    "Explain how a hash table works.",
+    "Write a Python function that checks whether a string is a palindrome.",
+    "What are the main causes of the French Revolution?",
+]
+
+
+class ForwardCounter:
+    """Count the forward passes of a model."""
+
+    def __init__(self, model):
+        self.num_calls = 0
+        self.forward = model.forward
+        model.forward = self
+
+    def __call__(self, *args, **kwargs):
+        self.num_calls += 1
+        return self.forward(*args, **kwargs)
+
+
+def decode(model, tokenizer, prompt, args, draft_model=None):
+    params = {
+        "prompt": prompt,
+        "temperature": 0.0,
+        "max_new_tokens": args.max_new_tokens,
+        "echo": False,
+    }
+    tic = time.time()
+    for output in generate_stream(
+        model,
+        tokenizer,
+        params,
+        args.device,
+        args.context_len,
+        draft_model=draft_model,
+        num_speculative_tokens=args.num_speculative_tokens,
+    ):
+        pass
+    return output, time.time() - tic
+
+
+def main(args):
+    model, tokenizer = load_model(args.model_path, args.device, args.num_gpus)
+    draft_model, _ = load_model(args.draft_model_path, args.device, args.num_gpus)
+    counter = ForwardCounter(model)
+
+    totals = {"normal": [0.0, 0, 0], "speculative": [0.0, 0, 0]}
+    num_same = 0
+    for text in PROMPTS:
+        conv = get_default_conv_template(args.model_path).copy()
+        conv.append_message(conv.roles[0], text)
+        conv.append_message(conv.roles[1], None)
+        prompt = conv.get_prompt()
+
+        outputs = {}
+        for name, draft in [("normal", None), ("speculative", draft_model)]:
+            counter.num_calls = 0
+            output, seconds = decode(model, tokenizer, prompt, args, draft)
+            outputs[name] = output["text"]
+            totals[name][0] += seconds
+            totals[name][1] += output["usage"]["completion_tokens"]
+            totals[name][2] += counter.num_calls
+        num_same += outputs["normal"] == outputs["speculative"]
+
+    print(f"Same outputs: {num_same} / {len(PROMPTS)}")
+    for name, (seconds, num_tokens, num_calls) in totals.items():
+        print(
+            f"{name:>12}: {seconds / num_tokens * 1000:.1f} ms/token, "
+            f"{num_tokens / num_calls:.2f} tokens per target forward"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--draft-model-path", type=str, required=True)
+    parser.add_argument(
+        "--device", type=str, choices=["cpu", "cuda", "mps"], default="cuda"
+    )
+    parser.add_argument("--num-gpus", type=str, default="1")
+    parser.add_argument("--context-len", type=int, default=2048)
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--num-speculative-tokens", type=int, default=4)
+    args = parser.parse_args()
+    main(args)
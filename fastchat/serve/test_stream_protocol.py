@@ -0,0 +1,77 @@
+"""Benchmarking script to compare the bytes and CPU time of the worker stream versions.
+
+Outputs of `generate_stream` are simulated for a long conversation, encoded by
+the worker side and decoded by the relay side, as done by model_worker and
+fastchat.serve.api.
+
+Usage:
+python3 -m fastchat.serve.test_stream_protocol --prompt-chars 8000 --max-new-tokens 512
+"""
+import argparse
+import time
+
+from fastchat.protocol.worker_stream import StreamDecoder, StreamEncoder
+from fastchat.serve.inference import partial_stop_length
+
+
+def simulate_outputs(prompt, words, stream_interval, echo):
+    generated_output = ""
+    for i, word in enumerate(words):
+        generated_output += word
+        if i % stream_interval == 0 or i == len(words) - 1:
+            yield {
+                "text": prompt + generated_output if echo else generated_output,
+                "usage": {
+                    "prompt_tokens": len(prompt) // 4,
+                    "completion_tokens": i + 1,
+                    "total_tokens": len(prompt) // 4 + i + 1,
+                },
+                "finish_reason": "length" if i == len(words) - 1 else None,
+            }
+
+
+def run(args, stream_version):
+    prompt = ("USER: Tell me a story. ASSISTANT: Once upon a time. " * 1000)[
+        : args.prompt_chars
+    ]
+    words = [" llama"] * args.max_new_tokens
+    outputs = list(
+        simulate_outputs(prompt, words, args.stream_interval, stream_version == 1)
+    )
+
+    tik = time.process_time()
+    encoder = StreamEncoder(stream_version)
+    chunks = [encoder.encode(output) for output in outputs]
+    encode_time = time.process_time() - tik
+
+    tik = time.process_time()
+    decoder = StreamDecoder(len(prompt))
+    num_sent = 0
+    for chunk in chunks:
+        for data in decoder.feed(chunk):
+            output = data["text"].lstrip()
+            sendable = output.rstrip()
+            stop_len = partial_stop_length(sendable, "</s>")
+            end = len(sendable[: len(sendable) - stop_len].rstrip())
+            num_sent = max(num_sent, end)
+    decode_time = time.process_time() - tik
+
+    assert decoder.texts[0] == "".join(words)
+    num_bytes = sum(len(chunk) for chunk in chunks)
+    print(
+        f"version {stream_version}: chunks: {len(chunks)}, "
+        f"bytes: {num_bytes / 1e6:.2f} MB, "
+        f"worker encode: {encode_time * 1e3:.1f} ms, "
+        f"relay decode: {decode_time * 1e3:.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prompt-chars", type=int, default=8000)
+    parser.add_argument("--max-new-tokens", type=int, default=512)
+    parser.add_argument("--stream-interval", type=int, default=2)
+    args = parser.parse_args()
+
+    for stream_version in [1, 2]:
+        run(args, stream_version)
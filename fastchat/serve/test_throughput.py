@@ -1,12 +1,12 @@
 """Benchmarking script to test the throughput of serving workers."""
 import argparse
-import json
 
 import requests
 import threading
 import time
 
-from fastchat.conversation import default_conversation
+from fastchat.conversation import get_default_conv_template
+from fastchat.protocol.worker_stream import StreamDecoder, STREAM_VERSION
 
 
 def main():
@@ -29,7 +29,7 @@ def main():
     if worker_addr == "":
         return
 
-    conv = default_conversation.copy()
+    conv = get_default_conv_template(args.model_name).copy()
     conv.append_message(conv.roles[0], "Tell me a story with more than 1000 words")
     prompt_template = conv.get_prompt()
     prompts = [prompt_template for _ in range(args.n_thread)]
@@ -42,6 +42,7 @@ def main():
             "max_new_tokens": args.max_new_tokens,
             "temperature": 0.0,
             # "stop": conv.sep,
+            "stream_version": STREAM_VERSION,
         }
         for i in range(len(prompts))
     ]
@@ -61,14 +62,14 @@ def main():
             json=ploads[i],
             stream=False,
         )
-        k = list(
-            response.iter_lines(chunk_size=8192, decode_unicode=False, delimiter=b"\0")
-        )
-        # print(k)
-        response_new_words = json.loads(k[-2].decode("utf-8"))["text"]
-        error_code = json.loads(k[-2].decode("utf-8"))["error_code"]
-        # print(f"=== Thread {i} ===, words: {1}, error code: {error_code}")
-        results[i] = len(response_new_words.split(" ")) - len(prompts[i].split(" "))
+        # The final chunk carries the exact token counts and timing.
+        usage = None
+        for data in StreamDecoder().feed(response.content):
+            if data.get("finish_reason") is not None:
+                usage = data["usage"]
+        if usage is None:
+            print(f"thread {i} got no usage, error code: {data['error_code']}")
+        results[i] = usage
 
     # use N threads to prompt the backend
     tik = time.time()
@@ -84,20 +85,22 @@ def main():
         t.join()
 
     print(f"Time (POST): {time.time() - tik} s")
-    # n_words = 0
-    # for i, response in enumerate(results):
-    #     # print(prompt[i].replace(conv.sep, "\n"), end="")
-    #     # make sure the streaming finishes at EOS or stopping criteria
-    #     k = list(response.iter_lines(chunk_size=8192, decode_unicode=False, delimiter=b"\0"))
-    #     response_new_words = json.loads(k[-2].decode("utf-8"))["text"]
-    #     # print(response_new_words)
-    #     n_words += len(response_new_words.split(" ")) - len(prompts[i].split(" "))
-    n_words = sum(results)
+    usages = [usage for usage in results if usage is not None]
+    n_tokens = sum(u["completion_tokens"] for u in usages)
     time_seconds = time.time() - tik
     print(
         f"Time (Completion): {time_seconds}, n threads: {args.n_thread}, "
-        f"throughput: {n_words / time_seconds} words/s."
+        f"throughput: {n_tokens / time_seconds} tokens/s."
     )
+    if usages:
+        ttft = sum(u["ttft"] for u in usages) / len(usages)
+        n_decode_tokens = sum(u["completion_tokens"] - 1 for u in usages)
+        decode_time = sum(u["decode_time"] for u in usages)
+        print(f"Mean time to first token: {ttft * 1000:.1f} ms")
+        if n_decode_tokens > 0:
+            print(
+                f"Mean time per output token: {decode_time / n_decode_tokens * 1000:.1f} ms"
+            )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,95 @@
+"""
+Batch samples of similar lengths under a budget of tokens.
+
+The samples are sorted by length and cut into batches whose padded size,
+the number of samples times the longest of them, fits in `max_tokens`. So a
+batch holds many short samples or a few long ones, and little of it is
+padding. The batches are formed once, and their order is shuffled every
+epoch.
+"""
+import math
+from typing import Iterator, List
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+def make_batches(lengths, max_tokens: int, seed: int = 0) -> List[List[int]]:
+    """Cut the samples, sorted by length, into batches of at most
+    `max_tokens` padded tokens. A longer sample is a batch by itself."""
+    lengths = np.asarray(lengths)
+    # Shuffle before the stable sort so samples of the same length are mixed.
+    order = np.random.RandomState(seed).permutation(len(lengths))
+    order = order[np.argsort(lengths[order], kind="stable")]
+
+    batches = []
+    batch, longest = [], 0
+    for i in order:
+        length = int(lengths[i])
+        if batch and (len(batch) + 1) * max(longest, length) > max_tokens:
+            batches.append(batch)
+            batch, longest = [], 0
+        batch.append(int(i))
+        longest = max(longest, length)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class TokenBudgetBatchSampler(Sampler[List[int]]):
+    """Yield the batches of this rank, in an order that depends on the seed
+    and the epoch.
+
+    Every rank forms the same batches and takes every `num_replicas`-th one of
+    the shuffled order, so all ranks run the same number of steps. The epoch
+    advances on each iteration. `Trainer` starts one iteration for every epoch
+    it skips when resuming, so the order stays the same as without resuming.
+    """
+
+    def __init__(
+        self,
+        lengths,
+        max_tokens: int,
+        num_replicas: int = 1,
+        rank: int = 0,
+        seed: int = 0,
+    ):
+        self.batches = make_batches(lengths, max_tokens, seed)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        return math.ceil(len(self.batches) / self.num_replicas)
+
+    def __iter__(self) -> Iterator[List[int]]:
+        order = np.random.RandomState(self.seed + self.epoch).permutation(
+            len(self.batches)
+        )
+        self.epoch += 1
+        # Repeat batches so that every rank gets the same number.
+        num_padded = len(self) * self.num_replicas
+        order = np.resize(order, num_padded)
+        return iter([self.batches[i] for i in order[self.rank :: self.num_replicas]])
+
+
+class TrimPaddingCollator:
+    """Collate with `collator` and cut the columns that are padding in every
+    sample of the batch."""
+
+    def __init__(self, collator):
+        self.collator = collator
+
+    def __call__(self, features):
+        batch = self.collator(features)
+        mask = batch["attention_mask"]
+        length = int(torch.nonzero(mask.ne(0).any(dim=0)).max()) + 1
+        return {
+            k: v[:, :length] if v.dim() == 2 and v.shape[1] == mask.shape[1] else v
+            for k, v in batch.items()
+        }
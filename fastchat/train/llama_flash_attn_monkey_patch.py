@@ -78,6 +78,28 @@ def forward(
             qkv, cu_q_lens, max_s, 0.0, softmax_scale=None, causal=True
         )
         output = rearrange(output, "(b s) ... -> b s ...", b=bsz)
+    elif key_padding_mask.dtype != torch.bool:
+        # Packed rows: the mask holds 1 + the index of the sample within the
+        # row and 0 for padding, so every sample is its own sequence.
+        nheads = qkv.shape[-2]
+        x = rearrange(qkv, "b s three h d -> b s (three h d)")
+        indices, cu_q_lens, max_s = get_packed_seqlens(key_padding_mask)
+        x_unpad = rearrange(
+            rearrange(x, "b s ... -> (b s) ...")[indices],
+            "nnz (three h d) -> nnz three h d",
+            three=3,
+            h=nheads,
+        )
+        output_unpad = flash_attn_unpadded_qkvpacked_func(
+            x_unpad, cu_q_lens, max_s, 0.0, softmax_scale=None, causal=True
+        )
+        output = rearrange(
+            pad_input(
+                rearrange(output_unpad, "nnz h d -> nnz (h d)"), indices, bsz, q_len
+            ),
+            "b s (h d) -> b s h d",
+            h=nheads,
+        )
     else:
         nheads = qkv.shape[-2]
         x = rearrange(qkv, "b s three h d -> b s (three h d)")
@@ -98,6 +120,24 @@ def forward(
     return self.o_proj(rearrange(output, "b s h d -> b s (h d)")), None, None
 
 
+def get_packed_seqlens(segment_ids: torch.Tensor):
+    """Return the indices of the tokens that are not padding in the flattened
+    batch, the cumulative sequence lengths and the maximum length of the
+    samples in `segment_ids` [bsz, q_len]."""
+    q_len = segment_ids.shape[1]
+    segment_ids = segment_ids.flatten()
+    indices = torch.nonzero(segment_ids, as_tuple=False).flatten()
+    segments = segment_ids[indices]
+    rows = torch.div(indices, q_len, rounding_mode="floor")
+    starts = torch.ones_like(segments, dtype=torch.bool)
+    starts[1:] = (segments[1:] != segments[:-1]) | (rows[1:] != rows[:-1])
+    cu_seqlens = torch.nn.functional.pad(
+        torch.nonzero(starts, as_tuple=False).flatten(), (0, 1), value=len(indices)
+    ).to(torch.int32)
+    max_s = int(cu_seqlens.diff().max())
+    return indices, cu_seqlens, max_s
+
+
 # Disable the transformation of the attention mask in LlamaModel as the flash attention
 # requires the attention mask to be the same as the key_padding_mask
 def _prepare_decoder_attention_mask(
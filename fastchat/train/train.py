@@ -13,19 +13,24 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import bisect
 import copy
 from dataclasses import dataclass, field
-import json
 import pathlib
-from typing import Dict, Optional, Sequence
+from typing import Dict, List, Optional, Sequence
 
+import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import DataLoader, Dataset
 import transformers
 from transformers import Trainer
 from transformers.trainer_pt_utils import LabelSmoother
+from transformers.trainer_utils import seed_worker
 
 from fastchat.conversation import get_default_conv_template, SeparatorStyle
+from fastchat.data.records import read_records
+from fastchat.data.tokenized_dataset import TokenizedDataset, is_tokenized_dataset
+from fastchat.train.batch_sampler import TrimPaddingCollator, TokenBudgetBatchSampler
 
 IGNORE_TOKEN_ID = LabelSmoother.ignore_index
 
@@ -38,9 +43,18 @@ class ModelArguments:
 @dataclass
 class DataArguments:
     data_path: str = field(
-        default=None, metadata={"help": "Path to the training data."}
+        default=None,
+        metadata={
+            "help": "Path to the training data, or a directory written by fastchat.data.build_dataset."
+        },
     )
     lazy_preprocess: bool = False
+    packing: bool = field(
+        default=False,
+        metadata={
+            "help": "Pack several samples into each row instead of padding them. Needs the flash attention patch of train_mem.py."
+        },
+    )
 
 
 @dataclass
@@ -53,6 +67,12 @@ class TrainingArguments(transformers.TrainingArguments):
             "help": "Maximum sequence length. Sequences will be right padded (and possibly truncated)."
         },
     )
+    max_tokens_per_batch: int = field(
+        default=0,
+        metadata={
+            "help": "Batch samples of similar lengths with up to this many tokens per device, padding included, instead of per_device_train_batch_size samples. 0 to disable."
+        },
+    )
 
 
 local_rank = None
@@ -72,14 +92,11 @@ def safe_save_model_for_hf_trainer(trainer: transformers.Trainer, output_dir: st
         trainer._save(output_dir, state_dict=cpu_state_dict)  # noqa
 
 
-def preprocess(
-    sources,
-    tokenizer: transformers.PreTrainedTokenizer,
-) -> Dict:
+def apply_prompt_template(sources) -> List[str]:
+    """Format the conversations with the vicuna template."""
     conv = get_default_conv_template("vicuna").copy()
     roles = {"human": conv.roles[0], "gpt": conv.roles[1]}
 
-    # Apply prompt templates
     conversations = []
     for i, source in enumerate(sources):
         if roles[source[0]["from"]] != conv.roles[0]:
@@ -92,6 +109,46 @@ def preprocess(
             assert role == conv.roles[j % 2], f"{i}"
             conv.append_message(role, sentence["value"])
         conversations.append(conv.get_prompt())
+    return conversations
+
+
+def mask_targets(
+    conversation: str, target, tokenizer: transformers.PreTrainedTokenizer
+) -> int:
+    """Set the labels of everything but the replies of the assistant to
+    IGNORE_TOKEN_ID, in place. Return the expected number of tokens."""
+    conv = get_default_conv_template("vicuna")
+    assert conv.sep_style == SeparatorStyle.TWO
+
+    sep = conv.sep + conv.roles[1] + ": "
+    rounds = conversation.split(conv.sep2)
+    cur_len = 1
+    for i, rou in enumerate(rounds):
+        if rou == "":
+            break
+
+        parts = rou.split(sep)
+        if len(parts) != 2:
+            break
+        parts[0] += sep
+        round_len = len(tokenizer(rou).input_ids)
+        instruction_len = len(tokenizer(parts[0]).input_ids) - 2
+
+        target[cur_len : cur_len + instruction_len] = IGNORE_TOKEN_ID
+
+        # rank0_print(tokenizer.decode(target[cur_len+instruction_len:cur_len+round_len]))
+
+        cur_len += round_len
+    target[cur_len:] = IGNORE_TOKEN_ID
+    return cur_len
+
+
+def preprocess(
+    sources,
+    tokenizer: transformers.PreTrainedTokenizer,
+) -> Dict:
+    # Apply prompt templates
+    conversations = apply_prompt_template(sources)
 
     # Tokenize conversations
     input_ids = tokenizer(
@@ -103,32 +160,10 @@ def preprocess(
     ).input_ids
     targets = input_ids.clone()
 
-    assert conv.sep_style == SeparatorStyle.TWO
-
     # Mask targets
-    sep = conv.sep + conv.roles[1] + ": "
     for conversation, target in zip(conversations, targets):
         total_len = int(target.ne(tokenizer.pad_token_id).sum())
-
-        rounds = conversation.split(conv.sep2)
-        cur_len = 1
-        for i, rou in enumerate(rounds):
-            if rou == "":
-                break
-
-            parts = rou.split(sep)
-            if len(parts) != 2:
-                break
-            parts[0] += sep
-            round_len = len(tokenizer(rou).input_ids)
-            instruction_len = len(tokenizer(parts[0]).input_ids) - 2
-
-            target[cur_len : cur_len + instruction_len] = IGNORE_TOKEN_ID
-
-            # rank0_print(tokenizer.decode(target[cur_len+instruction_len:cur_len+round_len]))
-
-            cur_len += round_len
-        target[cur_len:] = IGNORE_TOKEN_ID
+        cur_len = mask_targets(conversation, target, tokenizer)
 
         if cur_len < tokenizer.model_max_length:
             if cur_len != total_len:
@@ -144,31 +179,156 @@ def preprocess(
 
 
 class SupervisedDataset(Dataset):
-    """Dataset for supervised fine-tuning."""
+    """Dataset for supervised fine-tuning.
+
+    `data_path` is a json file of conversations, which are all tokenized here,
+    or a directory written by fastchat.data.build_dataset, which is opened
+    without loading it.
+    """
 
     def __init__(self, data_path: str, tokenizer: transformers.PreTrainedTokenizer):
         super(SupervisedDataset, self).__init__()
+        self.tokenizer = tokenizer
+        self.tokenized = None
+        if is_tokenized_dataset(data_path):
+            rank0_print("Opening tokenized data...")
+            self.tokenized = TokenizedDataset(data_path)
+            self.lengths = np.minimum(
+                self.tokenized.lengths, tokenizer.model_max_length
+            )
+            meta = self.tokenized.meta
+            if meta["vocab_size"] != len(tokenizer):
+                raise ValueError(
+                    f"{data_path} was built for a vocabulary of "
+                    f"{meta['vocab_size']} tokens, not {len(tokenizer)}."
+                )
+            if meta["model_max_length"] < tokenizer.model_max_length:
+                raise ValueError(
+                    f"{data_path} was truncated to {meta['model_max_length']} "
+                    f"tokens, less than model_max_length."
+                )
+            return
+
         rank0_print("Loading data...")
-        list_data_dict = json.load(open(data_path, "r"))
+        sources = [example["conversations"] for example in read_records(data_path)]
 
         rank0_print("Formatting inputs...")
-        sources = [example["conversations"] for example in list_data_dict]
         data_dict = preprocess(sources, tokenizer)
 
         self.input_ids = data_dict["input_ids"]
         self.labels = data_dict["labels"]
         self.attention_mask = data_dict["attention_mask"]
+        # Up to the last token that is not padding
+        mask = self.attention_mask.long()
+        self.lengths = torch.where(
+            mask.any(dim=1), mask.shape[1] - mask.flip(1).argmax(dim=1), 0
+        ).numpy()
 
     def __len__(self):
+        if self.tokenized is not None:
+            return len(self.tokenized)
         return len(self.input_ids)
 
     def __getitem__(self, i) -> Dict[str, torch.Tensor]:
+        if self.tokenized is not None:
+            return self.get_tokenized(i)
         return dict(
             input_ids=self.input_ids[i],
             labels=self.labels[i],
             attention_mask=self.attention_mask[i],
         )
 
+    def get_tokenized(self, i) -> Dict[str, torch.Tensor]:
+        """Pad sample `i` of the tokenized data like `preprocess`."""
+        max_length = self.tokenizer.model_max_length
+        ids, labels = self.get_sample(i)
+        input_ids = torch.full((max_length,), self.tokenizer.pad_token_id)
+        input_ids[: len(ids)] = ids
+        padded_labels = torch.full((max_length,), IGNORE_TOKEN_ID)
+        padded_labels[: len(ids)] = labels
+        return dict(
+            input_ids=input_ids,
+            labels=padded_labels,
+            attention_mask=input_ids.ne(self.tokenizer.pad_token_id),
+        )
+
+    def get_sample(self, i):
+        """Return the input ids and labels of sample `i` without padding."""
+        length = self.lengths[i]
+        if self.tokenized is None:
+            return self.input_ids[i][:length], self.labels[i][:length]
+        ids, loss_mask = self.tokenized[i]
+        ids = torch.from_numpy(ids[:length].astype(np.int64))
+        loss_mask = torch.from_numpy(loss_mask[:length].astype(bool))
+        return ids, torch.where(loss_mask, ids, IGNORE_TOKEN_ID)
+
+
+def pack_lengths(lengths, max_length: int) -> List[List[int]]:
+    """Group the samples into rows of at most `max_length` tokens.
+
+    Best-fit decreasing: the samples are placed from the longest to the
+    shortest, each into the row with the least space left that fits it.
+    """
+    rows = []
+    # Sorted (space left, row) of the rows that are not full
+    spaces = []
+    for i in np.argsort(-np.asarray(lengths), kind="stable"):
+        length = int(lengths[i])
+        j = bisect.bisect_left(spaces, (length, -1))
+        if j < len(spaces):
+            space, row = spaces.pop(j)
+            rows[row].append(int(i))
+        else:
+            space, row = max_length, len(rows)
+            rows.append([int(i)])
+        if space > length:
+            bisect.insort(spaces, (space - length, row))
+    return rows
+
+
+class PackedDataset(Dataset):
+    """Rows of several samples of a SupervisedDataset, for the flash attention
+    patch.
+
+    The attention mask holds 1 + the index of the sample within the row and 0
+    for padding, and the position ids restart at 0 for each sample, so the
+    samples of a row do not attend to each other.
+    """
+
+    def __init__(self, dataset: SupervisedDataset, max_length: int):
+        super(PackedDataset, self).__init__()
+        self.dataset = dataset
+        self.max_length = max_length
+        self.pad_token_id = dataset.tokenizer.pad_token_id
+        self.rows = pack_lengths(dataset.lengths, max_length)
+        self.lengths = np.array([dataset.lengths[row].sum() for row in self.rows])
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i) -> Dict[str, torch.Tensor]:
+        input_ids = torch.full((self.max_length,), self.pad_token_id)
+        labels = torch.full((self.max_length,), IGNORE_TOKEN_ID)
+        position_ids = torch.zeros(self.max_length, dtype=torch.long)
+        attention_mask = torch.zeros(self.max_length, dtype=torch.int32)
+        offset = 0
+        for j, k in enumerate(self.rows[i]):
+            ids, sample_labels = self.dataset.get_sample(k)
+            end = offset + len(ids)
+            input_ids[offset:end] = ids
+            labels[offset:end] = sample_labels
+            # Not predicted from the end of the previous sample
+            labels[offset] = IGNORE_TOKEN_ID
+            position_ids[offset:end] = torch.arange(len(ids))
+            attention_mask[offset:end] = j + 1
+            offset = end
+        return dict(
+            input_ids=input_ids,
+            labels=labels,
+            position_ids=position_ids,
+            attention_mask=attention_mask,
+        )
+
 
 class LazySupervisedDataset(Dataset):
     """Dataset for supervised fine-tuning."""
@@ -178,7 +338,7 @@ class LazySupervisedDataset(Dataset):
         self.tokenizer = tokenizer
 
         rank0_print("Loading data...")
-        list_data_dict = json.load(open(data_path, "r"))
+        list_data_dict = list(read_records(data_path))
 
         rank0_print("Formatting inputs...Skip in lazy mode")
         self.tokenizer = tokenizer
@@ -201,17 +361,87 @@ class LazySupervisedDataset(Dataset):
         return data_dict
 
 
+class SupervisedTrainer(Trainer):
+    """Trainer that can batch samples by length under a budget of tokens."""
+
+    def get_train_dataloader(self) -> DataLoader:
+        if self.args.max_tokens_per_batch <= 0:
+            return super().get_train_dataloader()
+
+        lengths = getattr(self.train_dataset, "lengths", None)
+        if lengths is None:
+            raise ValueError(
+                "--max_tokens_per_batch needs the lengths of the samples, "
+                "which --lazy_preprocess does not compute."
+            )
+        batch_sampler = TokenBudgetBatchSampler(
+            lengths,
+            self.args.max_tokens_per_batch,
+            num_replicas=self.args.world_size,
+            rank=self.args.process_index,
+            seed=self.args.seed,
+        )
+        return DataLoader(
+            self.train_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=TrimPaddingCollator(self.data_collator),
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            worker_init_fn=seed_worker,
+        )
+
+
 def make_supervised_data_module(
     tokenizer: transformers.PreTrainedTokenizer, data_args
 ) -> Dict:
     """Make dataset and collator for supervised fine-tuning."""
+    is_tokenized = is_tokenized_dataset(data_args.data_path)
+    if data_args.packing and data_args.lazy_preprocess and not is_tokenized:
+        raise ValueError("--packing does not support --lazy_preprocess.")
     dataset_cls = (
-        LazySupervisedDataset if data_args.lazy_preprocess else SupervisedDataset
+        LazySupervisedDataset
+        if data_args.lazy_preprocess and not is_tokenized
+        else SupervisedDataset
     )
     train_dataset = dataset_cls(tokenizer=tokenizer, data_path=data_args.data_path)
+
+    if data_args.packing:
+        max_length = tokenizer.model_max_length
+        num_tokens = train_dataset.lengths.sum()
+        padded = 1 - num_tokens / (len(train_dataset) * max_length)
+        train_dataset = PackedDataset(train_dataset, max_length)
+        packed = 1 - num_tokens / (len(train_dataset) * max_length)
+        rank0_print(
+            f"Packed {len(train_dataset.dataset)} samples into "
+            f"{len(train_dataset)} rows. Padding: {padded:.1%} -> {packed:.1%}"
+        )
     return dict(train_dataset=train_dataset, eval_dataset=None)
 
 
+def check_packing(model, data_args):
+    """Raise if the attention of `model` would mix the samples of a row."""
+    from transformers.models.llama import modeling_llama
+
+    if data_args.packing and (
+        not isinstance(model, modeling_llama.LlamaPreTrainedModel)
+        or modeling_llama.LlamaAttention.forward.__module__
+        != "fastchat.train.llama_flash_attn_monkey_patch"
+    ):
+        raise ValueError(
+            "--packing needs a LLaMA model and the flash attention patch of "
+            "fastchat/train/train_mem.py."
+        )
+
+
+def report_tokens_per_second(train_result, train_dataset):
+    """Print the number of tokens that are not padding trained per second."""
+    lengths = getattr(train_dataset, "lengths", None)
+    samples_per_second = train_result.metrics.get("train_samples_per_second")
+    if lengths is not None and samples_per_second:
+        tokens_per_second = samples_per_second * lengths.sum() / len(lengths)
+        rank0_print(f"Effective tokens/s: {tokens_per_second:.1f}")
+
+
 def train():
     global local_rank
 
@@ -233,15 +463,17 @@ def train():
     )
     tokenizer.pad_token = tokenizer.unk_token
 
+    check_packing(model, data_args)
     data_module = make_supervised_data_module(tokenizer=tokenizer, data_args=data_args)
-    trainer = Trainer(
+    trainer = SupervisedTrainer(
         model=model, tokenizer=tokenizer, args=training_args, **data_module
     )
 
     if list(pathlib.Path(training_args.output_dir).glob("checkpoint-*")):
-        trainer.train(resume_from_checkpoint=True)
+        train_result = trainer.train(resume_from_checkpoint=True)
     else:
-        trainer.train()
+        train_result = trainer.train()
+    report_tokens_per_second(train_result, data_module["train_dataset"])
     trainer.save_state()
     safe_save_model_for_hf_trainer(trainer=trainer, output_dir=training_args.output_dir)
 
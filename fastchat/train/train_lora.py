@@ -24,13 +24,15 @@ from deepspeed import zero
 from deepspeed.runtime.zero.partition_parameters import ZeroParamStatus
 from peft import LoraConfig, get_peft_model
 import transformers
-from transformers import Trainer
 
 from fastchat.train.train import (
     DataArguments,
     ModelArguments,
+    SupervisedTrainer,
     TrainingArguments,
+    check_packing,
     make_supervised_data_module,
+    report_tokens_per_second,
 )
 
 from fastchat.train.llama_flash_attn_monkey_patch import (
@@ -99,6 +101,7 @@ def train():
         model_args.model_name_or_path,
         cache_dir=training_args.cache_dir,
     )
+    check_packing(model, data_args)
     lora_config = LoraConfig(
         r=lora_args.lora_r,
         lora_alpha=lora_args.lora_alpha,
@@ -108,6 +111,10 @@ def train():
         task_type="CAUSAL_LM",
     )
     model = get_peft_model(model, lora_config)
+    if data_args.packing:
+        # The forward of a PEFT model takes **kwargs, so Trainer would drop the
+        # `position_ids` that restart at every sample of a packed row.
+        training_args.remove_unused_columns = False
     if training_args.deepspeed is not None and training_args.local_rank == 0:
         model.print_trainable_parameters()
 
@@ -129,16 +136,17 @@ def train():
     tokenizer.pad_token = tokenizer.unk_token
 
     data_module = make_supervised_data_module(tokenizer=tokenizer, data_args=data_args)
-    trainer = Trainer(
+    trainer = SupervisedTrainer(
         model=model, tokenizer=tokenizer, args=training_args, **data_module
     )
 
     model.config.use_cache = False
 
     if list(pathlib.Path(training_args.output_dir).glob("checkpoint-*")):
-        trainer.train(resume_from_checkpoint=True)
+        train_result = trainer.train(resume_from_checkpoint=True)
     else:
-        trainer.train()
+        train_result = trainer.train()
+    report_tokens_per_second(train_result, data_module["train_dataset"])
     trainer.save_state()
 
     # Save states. Weights might be a placeholder in zero3 and need a gather